@@ -0,0 +1,48 @@
+"""Loads the bot's modules for the benchmarks.
+
+In this tree the modules are stored as user_bot..py and database..py, names the
+import system cannot find, while the Procfile runs them as user_bot.py and
+database.py. load() takes whichever file exists and registers it under the plain
+module name, so user_bot's own `import database` finds the loaded module:
+
+    import _repo
+    user_bot = _repo.load("user_bot")
+
+Benchmarks that TRUNCATE tables call use_bench_database() first, so they only
+ever run against BENCH_DATABASE_URL and never against the bot's DATABASE_URL.
+"""
+import importlib.util
+import os
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+def use_bench_database():
+    """Points DATABASE_URL at BENCH_DATABASE_URL, or exits if that is not set."""
+    url = os.environ.get("BENCH_DATABASE_URL")
+    if not url:
+        sys.exit("This benchmark TRUNCATES tables. Set BENCH_DATABASE_URL to a throwaway database to run it.")
+    os.environ["DATABASE_URL"] = url
+
+
+def load(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    if name == "user_bot":
+        load("database")
+    for filename in (f"{name}.py", f"{name}..py"):
+        path = os.path.join(ROOT, filename)
+        if os.path.exists(path):
+            break
+    else:
+        raise ModuleNotFoundError(f"Neither {name}.py nor {name}..py in {ROOT}")
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    try:
+        spec.loader.exec_module(module)
+    except BaseException:
+        del sys.modules[name]
+        raise
+    return module
@@ -0,0 +1,75 @@
+"""Throughput of activity_log writes: one INSERT per event versus database.ActivityLogWriter.
+
+--producers tasks log --events events between them, the way handlers would. The
+first run writes each event with its own INSERT on a pooled connection; the
+second hands them to the buffered writer, which COPYs them in batches. Reports
+rows/sec, how long log() kept callers waiting, and how many rows reached the
+table. Needs a local Postgres; the bench rows are deleted afterwards:
+
+    DATABASE_URL=postgresql://postgres@localhost/bench python benchmarks/activity_log_bench.py --events 200000
+"""
+import argparse
+import asyncio
+import time
+
+import _repo
+db = _repo.load("database")
+
+ACTION = "bench_event"
+
+
+@db.run_in_db_executor
+def insert_one(action, target_user_id, details):
+    with db.db_cursor() as cur:
+        cur.execute(
+            "INSERT INTO activity_log (action, target_user_id, details) VALUES (%s, %s, %s)",
+            (action, target_user_id, details)
+        )
+
+
+def count_and_delete():
+    with db.db_cursor() as cur:
+        cur.execute("DELETE FROM activity_log WHERE action = %s", (ACTION,))
+        return cur.rowcount
+
+
+async def run(label, log, args, finish=None):
+    per_producer = args.events // args.producers
+    slowest = 0.0
+
+    async def producer(index):
+        nonlocal slowest
+        for i in range(per_producer):
+            started = time.perf_counter()
+            await log(ACTION, index, f"event {i}\twith a tab")
+            slowest = max(slowest, time.perf_counter() - started)
+
+    started = time.monotonic()
+    await asyncio.gather(*(producer(index) for index in range(args.producers)))
+    if finish is not None:
+        await finish()
+    elapsed = time.monotonic() - started
+    stored = await asyncio.get_running_loop().run_in_executor(None, count_and_delete)
+    total = per_producer * args.producers
+    print(f"{label}: {total} rows in {elapsed:.2f}s ({total / elapsed:,.0f} rows/s), "
+          f"slowest log() {slowest * 1000:.1f} ms, {stored} rows stored")
+
+
+async def main(args):
+    db.bootstrap_database()
+    await run("one INSERT per event", lambda action, user_id, details: insert_one(action, user_id, details), args)
+    writer = db.ActivityLogWriter(args.flush_rows, args.flush_seconds, args.max_rows)
+    await run("ActivityLogWriter (COPY)", lambda action, user_id, details: writer.log(action, user_id, details=details),
+              args, finish=writer.close)
+    print(f"  writer: {writer.stats()}")
+    db.close_pool()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--events", type=int, default=50000)
+    parser.add_argument("--producers", type=int, default=50)
+    parser.add_argument("--flush-rows", type=int, default=db.ACTIVITY_LOG_FLUSH_ROWS)
+    parser.add_argument("--flush-seconds", type=float, default=db.ACTIVITY_LOG_FLUSH_SECONDS)
+    parser.add_argument("--max-rows", type=int, default=db.ACTIVITY_LOG_MAX_BUFFERED)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,120 @@
+"""Runs a broadcast through user_bot.BroadcastEngine against a local Postgres and a stub Bot API.
+
+Seeds --users users, starts a broadcast, kills the worker after --crash-after
+seconds without a final checkpoint, and lets a second worker resume it once the
+lease runs out. Every --blocked-every'th user has blocked the bot. Checks that
+every other user got the message, counts duplicates caused by the crash, checks
+that blocked users were marked, and reports throughput and peak Python memory.
+
+It TRUNCATES users and broadcasts, so it runs against BENCH_DATABASE_URL, a
+throwaway database, and refuses to start without it:
+
+    BENCH_DATABASE_URL=postgresql://postgres@localhost/bench BROADCAST_LEASE_SECONDS=3 \\
+        python benchmarks/broadcast_bench.py --users 1000000
+"""
+import argparse
+import asyncio
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import _repo
+_repo.use_bench_database()
+user_bot = _repo.load("user_bot")
+from telegram.error import Forbidden  # noqa: E402
+
+db = user_bot.db
+STAFF_ID = -1  # Not in users, so it never receives its own broadcast
+
+
+class StubBot:
+    def __init__(self, users, blocked_every, latency):
+        self.received = bytearray(users + 1)  # Messages per user, capped at 255
+        self.blocked_every = blocked_every
+        self.latency = latency
+        self.reports = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if chat_id == STAFF_ID:
+            self.reports.append(text)
+            return
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if chat_id % self.blocked_every == 0:
+            raise Forbidden("Forbidden: bot was blocked by the user")
+        self.received[chat_id] = min(self.received[chat_id] + 1, 255)
+
+
+def seed(users):
+    db.bootstrap_database()
+    with db.db_cursor() as cur:
+        cur.execute("TRUNCATE users, broadcasts")
+        cur.execute(
+            "INSERT INTO users (user_id, first_name, referral_code) SELECT g, 'bench', 'b' || g FROM generate_series(1, %s) g",
+            (users,)
+        )
+        cur.execute("ANALYZE users")
+
+
+async def wait_until_finished():
+    while user_bot.broadcast_engine._running:
+        await asyncio.sleep(0.1)
+
+
+async def main(args):
+    started = time.monotonic()
+    seed(args.users)
+    print(f"Seeded {args.users} users in {time.monotonic() - started:.1f}s")
+    bot = StubBot(args.users, args.blocked_every, args.latency_ms / 1000)
+
+    tracemalloc.start()
+    started = time.monotonic()
+    user_bot.WORKER_ID = "bench-worker-1"
+    broadcast_id = await user_bot.broadcast_engine.start(STAFF_ID, "bench broadcast", False, bot)
+    await asyncio.sleep(args.crash_after)
+
+    # A worker that dies cannot checkpoint: with another WORKER_ID its last checkpoint matches no row
+    user_bot.WORKER_ID = "crashed"
+    await user_bot.broadcast_engine.shutdown()
+    with db.db_cursor() as cur:
+        cur.execute("SELECT last_user_id FROM broadcasts WHERE id = %s", (broadcast_id,))
+        checkpoint = cur.fetchone()[0]
+    crashed_at = time.monotonic()
+    print(f"Crashed after {crashed_at - started:.1f}s, last checkpoint at user {checkpoint}")
+
+    user_bot.WORKER_ID = "bench-worker-2"
+    while not user_bot.broadcast_engine._running:
+        await user_bot.broadcast_engine.resume(SimpleNamespace(bot=bot))
+        await asyncio.sleep(0.5)
+    resumed_at = time.monotonic()
+    await wait_until_finished()
+    elapsed = time.monotonic() - started - (resumed_at - crashed_at)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    received = bot.received
+    blocked = args.users // args.blocked_every
+    missed = sum(1 for user_id in range(1, args.users + 1) if user_id % args.blocked_every and not received[user_id])
+    duplicates = sum(count - 1 for count in received if count > 1)
+    with db.db_cursor() as cur:
+        cur.execute("SELECT count(*) FROM users WHERE blocked_at IS NOT NULL")
+        marked = cur.fetchone()[0]
+        cur.execute("SELECT status, sent, blocked, failed FROM broadcasts WHERE id = %s", (broadcast_id,))
+        status, sent, blocked_count, failed = cur.fetchone()
+
+    print(f"\nBroadcast {broadcast_id} {status}: {sent} sent, {blocked_count} blocked, {failed} failed "
+          f"in {elapsed:.1f}s sending ({args.users / elapsed:.0f} users/s)")
+    print(f"  missed: {missed}, sent twice because of the crash: {duplicates}")
+    print(f"  blocked users marked: {marked} of {blocked}")
+    print(f"  peak Python memory while sending: {peak / 1024 / 1024:.1f} MiB")
+    print(f"  report to staff: {bot.reports[-1].splitlines()[0] if bot.reports else 'none'}")
+    db.close_pool()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--blocked-every", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--crash-after", type=float, default=2)
+    asyncio.run(main(parser.parse_args()))
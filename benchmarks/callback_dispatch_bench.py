@@ -0,0 +1,74 @@
+"""Micro-benchmark for button_handler: per-update dispatch overhead and Telegram API calls per tap.
+
+Runs the real callback handlers against in-memory stand-ins for Telegram, the
+database and 1secmail, so it needs no network or Postgres:
+
+    python benchmarks/callback_dispatch_bench.py --iterations 20000
+"""
+import argparse
+import asyncio
+import time
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+import _repo
+user_bot = _repo.load("user_bot")
+
+TELEGRAM_METHODS = ("answer", "edit_message_text", "edit_message_caption")
+ROUTES = ["bench_noop", "main_menu", "account_menu", "email_menu", "my_email_inbox", "number_menu",
+          "email_pay_generate", "email_delete_confirm"]
+
+
+def install_fakes():
+    user = {"user_id": 1, "first_name": "Bench", "balance": 10.0, "is_premium": False, "premium_expiry": None}
+    user_bot.db.get_user = AsyncMock(return_value=user)
+    user_bot.db.get_setting = AsyncMock(return_value=0.0)
+    user_bot.db.add_user_if_not_exists = AsyncMock(return_value=10.0)
+    user_bot.db.debit_balance = AsyncMock(return_value=10.0)
+    user_bot.db.activity_log.log = AsyncMock()
+    user_bot.sessions.get = AsyncMock(return_value={"email": "bench@1secmail.com"})
+    user_bot.sessions.set = AsyncMock()
+    user_bot.create_email = AsyncMock(return_value={"email": "bench@1secmail.com", "provider": "1secmail"})
+    user_bot.get_message_details = AsyncMock(return_value={"from": "a", "subject": "b", "date": "c", "textBody": "d"})
+
+    async def noop(update, context):
+        pass
+    user_bot.CALLBACK_ROUTES["bench_noop"] = noop
+
+
+def make_update(data):
+    query = SimpleNamespace(
+        data=data,
+        from_user=SimpleNamespace(id=1, first_name="Bench"),
+        message=SimpleNamespace(chat_id=1, message_id=1, photo=None),
+        **{name: AsyncMock() for name in TELEGRAM_METHODS},
+    )
+    update = SimpleNamespace(callback_query=query, message=None, effective_user=query.from_user)
+    context = SimpleNamespace(bot=SimpleNamespace(send_message=AsyncMock()), args=None)
+    return update, context
+
+
+async def bench(route, iterations):
+    update, context = make_update(route)
+    started = time.perf_counter()
+    for _ in range(iterations):
+        await user_bot.button_handler(update, context)
+    elapsed = time.perf_counter() - started
+    query = update.callback_query
+    calls = sum(getattr(query, name).call_count for name in TELEGRAM_METHODS) + context.bot.send_message.call_count
+    answers = query.answer.call_count
+    return elapsed / iterations * 1e6, calls / iterations, answers / iterations
+
+
+async def main(iterations):
+    install_fakes()
+    print(f"{'route':<24}{'us/update':>12}{'API calls':>12}{'answers':>10}")
+    for route in ROUTES:
+        per_update, calls, answers = await bench(route, iterations)
+        print(f"{route:<24}{per_update:>12.1f}{calls:>12.2f}{answers:>10.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=5000)
+    asyncio.run(main(parser.parse_args().iterations))
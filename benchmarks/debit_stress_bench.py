@@ -0,0 +1,104 @@
+"""Fires parallel debits at one account through database.debit_balance and checks nothing is overdrawn.
+
+The account starts with enough credit for half of --debits debits of --amount.
+All debits are launched at once on the pooled DB threads. Afterwards exactly
+half must have succeeded, the balance must be exactly zero, and the account's
+ledger rows must add up to the balance and chain correctly through balance_after.
+The same run through a read-then-update path shows the race debit_balance avoids.
+Needs a local Postgres; the bench user and its ledger rows are deleted afterwards:
+
+    DATABASE_URL=postgresql://postgres@localhost/bench python benchmarks/debit_stress_bench.py --debits 2000
+"""
+import argparse
+import asyncio
+import decimal
+import sys
+import time
+
+import _repo
+db = _repo.load("database")
+
+USER_ID = -1007  # Outside Telegram's id range, so it never collides with a real user
+
+
+def reset(balance):
+    with db.db_cursor() as cur:
+        cur.execute("DELETE FROM balance_ledger WHERE user_id = %s", (USER_ID,))
+        cur.execute("DELETE FROM users WHERE user_id = %s", (USER_ID,))
+        cur.execute(
+            "INSERT INTO users (user_id, first_name, balance, referral_code) VALUES (%s, 'bench', %s, 'debit-bench')",
+            (USER_ID, balance)
+        )
+        cur.execute(
+            "INSERT INTO balance_ledger (user_id, amount, reason, balance_after) VALUES (%s, %s, 'bench_seed', %s)",
+            (USER_ID, balance, balance)
+        )
+
+
+@db.run_in_db_executor
+def racy_debit(user_id, amount, reason):
+    """Read the balance, check it in Python, then update it: the check-then-act debit_balance replaced."""
+    with db.db_cursor() as cur:
+        cur.execute("SELECT balance FROM users WHERE user_id = %s", (user_id,))
+        balance = cur.fetchone()[0]
+    if balance < amount:
+        return None
+    with db.db_cursor() as cur:
+        cur.execute("UPDATE users SET balance = %s WHERE user_id = %s RETURNING balance", (balance - amount, user_id))
+        new_balance = cur.fetchone()[0]
+        cur.execute(
+            "INSERT INTO balance_ledger (user_id, amount, reason, balance_after) VALUES (%s, %s, %s, %s)",
+            (user_id, -amount, reason, new_balance)
+        )
+    return new_balance
+
+
+def check():
+    """Returns (balance, ledger sum, ledger rows whose balance_after does not follow from the previous row)."""
+    with db.db_cursor() as cur:
+        cur.execute("SELECT balance FROM users WHERE user_id = %s", (USER_ID,))
+        balance = cur.fetchone()[0]
+        cur.execute("SELECT amount, balance_after FROM balance_ledger WHERE user_id = %s ORDER BY id", (USER_ID,))
+        rows = cur.fetchall()
+        cur.execute("DELETE FROM balance_ledger WHERE user_id = %s", (USER_ID,))
+        cur.execute("DELETE FROM users WHERE user_id = %s", (USER_ID,))
+    total = sum((amount for amount, _ in rows), decimal.Decimal(0))
+    broken, running = 0, decimal.Decimal(0)
+    for amount, balance_after in rows:
+        running += amount
+        broken += running != balance_after
+    return balance, total, broken
+
+
+async def run(label, debit, args):
+    amount = decimal.Decimal(args.amount)
+    start_balance = amount * (args.debits // 2)
+    reset(start_balance)
+    started = time.monotonic()
+    results = await asyncio.gather(*(debit(USER_ID, amount, 'bench_debit') for _ in range(args.debits)))
+    elapsed = time.monotonic() - started
+    succeeded = sum(result is not None for result in results)
+    balance, ledger_total, broken = check()
+    ok = succeeded == args.debits // 2 and balance == 0 and ledger_total == balance and not broken
+    print(f"{label}: {args.debits} debits in {elapsed:.2f}s ({args.debits / elapsed:,.0f}/s), {succeeded} succeeded "
+          f"(expected {args.debits // 2}), final balance {balance}, ledger sum {ledger_total}, "
+          f"{broken} ledger rows out of sequence -> {'OK' if ok else 'WRONG'}")
+    return ok
+
+
+async def main(args):
+    db.bootstrap_database()
+    ok = await run("debit_balance", db.debit_balance, args)
+    if args.racy:
+        await run("read then update", racy_debit, args)
+    db.close_pool()
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--debits", type=int, default=2000)
+    parser.add_argument("--amount", default="1.50")
+    parser.add_argument("--racy", action=argparse.BooleanOptionalAction, default=True,
+                        help="also run the read-then-update path for comparison")
+    sys.exit(0 if asyncio.run(main(parser.parse_args())) else 1)
@@ -0,0 +1,89 @@
+"""Counts Telegram API calls per email action with and without user_bot.MessageEditBuffer.
+
+Runs the real email_generation_logic against a fake 1secmail whose answers take
+--latency-ms (spread by ±50%) and a fake Bot API behind OutboundRateLimiter, so
+it needs no network or Postgres. Every tap also repeats one identical edit, like
+a second tap on "main menu" while the main menu is already showing:
+
+    python benchmarks/edit_buffer_bench.py --taps 500 --latency-ms 300 --deadline-ms 1000
+"""
+import argparse
+import asyncio
+import random
+import time
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+import _repo
+user_bot = _repo.load("user_bot")
+
+
+class CountingTelegram:
+    def __init__(self):
+        self.calls = 0
+
+    async def post(self, endpoint, data):
+        self.calls += 1
+        await asyncio.sleep(0.005)
+        return True
+
+
+def make_query(chat_id, limiter, telegram):
+    async def edit_message_text(text, **kwargs):
+        data = {"chat_id": chat_id, "message_id": 1, "text": text, **kwargs}
+        return await limiter.process_request(telegram.post, ("editMessageText", data), {}, "editMessageText", data, None)
+
+    return SimpleNamespace(
+        from_user=SimpleNamespace(id=chat_id),
+        message=SimpleNamespace(chat_id=chat_id, message_id=1),
+        edit_message_text=edit_message_text,
+    )
+
+
+async def run(label, buffered, args):
+    telegram = CountingTelegram()
+    edits = user_bot.MessageEditBuffer(args.deadline_ms / 1000 if buffered else 0, args.taps)
+    user_bot.message_edits = edits
+    limiter = user_bot.OutboundRateLimiter(1000, 1000, 1000, 1000, 0, edit_buffer=edits if buffered else None)
+    await limiter.initialize()
+
+    async def tap(chat_id):
+        query = make_query(chat_id, limiter, telegram)
+        await user_bot.email_generation_logic(query)
+        await query.edit_message_text("👋 main menu", parse_mode="Markdown")
+        await query.edit_message_text("👋 main menu", parse_mode="Markdown")
+
+    started = time.monotonic()
+    await asyncio.gather(*(tap(chat_id) for chat_id in range(1, args.taps + 1)))
+    elapsed = time.monotonic() - started
+    await asyncio.sleep(args.deadline_ms / 1000)  # Let interim edits that were not cancelled land
+    await limiter.shutdown()
+
+    print(f"\n{label}: {args.taps} taps in {elapsed:.1f}s, {telegram.calls} API calls "
+          f"({telegram.calls / args.taps:.2f} per tap)")
+    print(f"  edit buffer: {edits.stats()}")
+
+
+async def main(args):
+    latency = args.latency_ms / 1000
+
+    async def create_email():
+        await asyncio.sleep(latency * random.uniform(0.5, 1.5))
+        return {"email": "bench@1secmail.com", "provider": "1secmail"}
+
+    user_bot.create_email = create_email
+    user_bot.sessions.set = AsyncMock()
+    user_bot.db.activity_log.log = AsyncMock()
+    user_bot.inbox_watcher.watch = lambda *a, **kw: None
+    await run("without the buffer", False, args)
+    await run("with MessageEditBuffer", True, args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--taps", type=int, default=500)
+    parser.add_argument("--latency-ms", type=float, default=300)
+    parser.add_argument("--deadline-ms", type=float, default=1000)
+    args = parser.parse_args()
+    random.seed(1)
+    asyncio.run(main(args))
@@ -0,0 +1,162 @@
+"""Handler latency for /start, the main menu and the account menu: one connection per query versus the pooled data layer.
+
+--updates updates from --users users arrive evenly over --seconds and run
+through the real handlers against a local Postgres. Telegram calls are fakes
+that take --telegram-ms. Latency is measured from when an update was due to
+when its handler finished, so time spent waiting behind a blocked event loop
+counts. Three runs:
+
+  connect per query   the original helpers: psycopg2.connect() for every query,
+                      called synchronously from the async handlers
+  pooled              the current database module (pool + DB threads + caches)
+  pooled, no caches   the same with the balance and settings caches disabled
+
+The bench users are deleted afterwards:
+
+    DATABASE_URL=postgresql://postgres@localhost/bench python benchmarks/handler_latency_bench.py --updates 3000
+"""
+import argparse
+import asyncio
+import os
+import random
+import uuid
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+import _repo
+user_bot = _repo.load("user_bot")
+db = user_bot.db
+import psycopg2  # noqa: E402
+from psycopg2.extras import DictCursor  # noqa: E402
+
+FIRST_USER_ID = 10 ** 12  # Above real Telegram ids, so the bench rows are easy to delete
+
+
+# --- The data layer as it was: a new connection for every query, called without leaving the event loop ---
+def connect():
+    return psycopg2.connect(os.environ.get('DATABASE_URL'))
+
+
+def old_get_user(user_id):
+    conn = connect()
+    with conn.cursor(cursor_factory=DictCursor) as cur:
+        cur.execute("SELECT * FROM users WHERE user_id = %s", (user_id,))
+        user = cur.fetchone()
+    conn.close()
+    return user
+
+
+def old_get_setting(key):
+    conn = connect()
+    with conn.cursor() as cur:
+        cur.execute("SELECT value FROM settings WHERE key = %s", (key,))
+        result = cur.fetchone()
+    conn.close()
+    return float(result[0]) if result else 0.0
+
+
+def old_add_user_if_not_exists(user_id, first_name, referral_code=None):
+    conn = connect()
+    with conn.cursor(cursor_factory=DictCursor) as cur:
+        cur.execute("SELECT * FROM users WHERE user_id = %s", (user_id,))
+        if not cur.fetchone():
+            cur.execute(
+                "INSERT INTO users (user_id, first_name, balance, referral_code) VALUES (%s, %s, %s, %s)",
+                (user_id, first_name, old_get_setting('signup_bonus'), str(uuid.uuid4())[:8])
+            )
+    conn.commit()
+    conn.close()
+
+
+def install_connect_per_query():
+    async def get_user(user_id):
+        return old_get_user(user_id)
+
+    async def get_setting(key):
+        return old_get_setting(key)
+
+    async def add_user_if_not_exists(user_id, first_name, referral_code=None):
+        # The old /start then read the user again for the balance on the main menu
+        old_add_user_if_not_exists(user_id, first_name, referral_code)
+        return old_get_user(user_id)['balance']
+
+    originals = {name: getattr(db, name) for name in ("get_user", "get_setting", "add_user_if_not_exists")}
+    db.get_user, db.get_setting, db.add_user_if_not_exists = get_user, get_setting, add_user_if_not_exists
+    return originals
+
+
+# --- Load ---
+def make_update(user_id, kind, telegram_seconds):
+    async def telegram_call(*args, **kwargs):
+        await asyncio.sleep(telegram_seconds)
+
+    user = SimpleNamespace(id=user_id, first_name="Bench")
+    context = SimpleNamespace(bot=SimpleNamespace(send_message=telegram_call), args=None)
+    if kind == "start":
+        message = SimpleNamespace(reply_text=telegram_call, reply_photo=telegram_call)
+        return SimpleNamespace(message=message, callback_query=None, effective_user=user), context
+    query = SimpleNamespace(
+        data=kind, from_user=user, message=SimpleNamespace(chat_id=user_id, message_id=1, photo=None),
+        answer=telegram_call, edit_message_text=telegram_call, edit_message_caption=telegram_call,
+    )
+    return SimpleNamespace(message=None, callback_query=query, effective_user=user), context
+
+
+async def run(label, args):
+    latencies = {"start": [], "main_menu": [], "account_menu": []}
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+
+    async def one(index):
+        due = started + index * args.seconds / args.updates
+        await asyncio.sleep(max(0.0, due - loop.time()))
+        user_id = FIRST_USER_ID + random.randrange(args.users)
+        kind = random.choice(list(latencies))
+        update, context = make_update(user_id, kind, args.telegram_ms / 1000)
+        if kind == "start":
+            await user_bot.start(update, context)
+        else:
+            await user_bot.button_handler(update, context)
+        latencies[kind].append(loop.time() - due)
+
+    await asyncio.gather(*(one(index) for index in range(args.updates)))
+    print(f"\n{label}: {args.updates} updates in {loop.time() - started:.1f}s")
+    for kind, values in latencies.items():
+        values.sort()
+        print(f"  {kind:<14} p50 {values[len(values) // 2] * 1000:7.1f} ms   "
+              f"p99 {values[int(len(values) * 0.99)] * 1000:7.1f} ms")
+
+
+async def main(args):
+    db.bootstrap_database()
+    with db.db_cursor() as cur:
+        cur.execute("DELETE FROM users WHERE user_id >= %s", (FIRST_USER_ID,))
+    user_bot.db.activity_log.log = AsyncMock()
+
+    originals = install_connect_per_query()
+    await run("connect per query", args)
+    for name, function in originals.items():
+        setattr(db, name, function)
+    user_bot._balance_cache.clear()
+
+    await run("pooled", args)
+    user_bot.BALANCE_CACHE_TTL_SECONDS = 0
+    db.settings_cache.ttl = 0
+    user_bot._balance_cache.clear()
+    await run("pooled, no caches", args)
+
+    with db.db_cursor() as cur:
+        cur.execute("DELETE FROM balance_ledger WHERE user_id >= %s", (FIRST_USER_ID,))
+        cur.execute("DELETE FROM users WHERE user_id >= %s", (FIRST_USER_ID,))
+    db.close_pool()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", type=int, default=3000)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--telegram-ms", type=float, default=50)
+    args = parser.parse_args()
+    random.seed(1)
+    asyncio.run(main(args))
@@ -0,0 +1,91 @@
+"""Simulates the background inbox watcher against a local stub of the 1secmail API.
+
+Mail arrives at random mailboxes at --mail-rate messages/sec. The report shows
+upstream requests/sec, how long new mail took to reach its user, and how many
+messages were delivered more than once (should be 0). Sessions live in a
+temporary SQLite file, so no Postgres or network is needed:
+
+    python benchmarks/inbox_watcher_bench.py --mailboxes 2000 --mail-rate 20 --seconds 30
+"""
+import argparse
+import asyncio
+import collections
+import os
+import random
+import statistics
+import tempfile
+import time
+from types import SimpleNamespace
+
+import httpx
+
+import _repo
+user_bot = _repo.load("user_bot")
+db = _repo.load("database")
+
+
+class StubMailApi:
+    def __init__(self):
+        self.inboxes = collections.defaultdict(list)
+        self.arrived_at = {}
+        self.requests = collections.Counter()
+
+    def deliver(self, email, message_id):
+        self.inboxes[email].append({"id": message_id})
+        self.arrived_at[message_id] = time.monotonic()
+
+    def handle(self, request):
+        params = dict(request.url.params)
+        self.requests[params["action"]] += 1
+        email = f"{params['login']}@{params['domain']}"
+        if params["action"] == "getMessages":
+            return httpx.Response(200, json=self.inboxes[email])
+        return httpx.Response(200, json={"id": params["id"], "from": "bench", "subject": params["id"], "date": "", "textBody": ""})
+
+
+async def main(args):
+    api = StubMailApi()
+    user_bot.mail_client._client = httpx.AsyncClient(base_url="http://stub/", transport=httpx.MockTransport(api.handle))
+    path = os.path.join(tempfile.mkdtemp(), "sessions.sqlite3")
+    user_bot.sessions = db.SessionStore(db.SqliteSessionBackend(path), args.mailboxes * 2, 60, 3600)
+    for user_id in range(args.mailboxes):
+        await user_bot.sessions.set(user_id, {"email": f"user{user_id}@stub.test", "seen_ids": []})
+
+    latencies, delivered = [], collections.Counter()
+
+    async def send_message(chat_id, text, parse_mode=None):
+        message_id = text.split("<b>Subject:</b> ")[1].split("\n")[0]
+        delivered[message_id] += 1
+        latencies.append(time.monotonic() - api.arrived_at[message_id])
+
+    context = SimpleNamespace(bot=SimpleNamespace(send_message=send_message))
+    watcher = user_bot.inbox_watcher
+    await watcher.sync(context)
+
+    started = time.monotonic()
+    next_id = 0
+    while time.monotonic() - started < args.seconds:
+        for _ in range(max(1, int(args.mail_rate * user_bot.INBOX_WATCH_TICK_SECONDS))):
+            if random.random() < args.mail_rate * user_bot.INBOX_WATCH_TICK_SECONDS:
+                next_id += 1
+                api.deliver(f"user{random.randrange(args.mailboxes)}@stub.test", str(next_id))
+        await watcher.tick(context)
+        await asyncio.sleep(user_bot.INBOX_WATCH_TICK_SECONDS)
+    elapsed = time.monotonic() - started
+
+    print(f"mailboxes {args.mailboxes}, mail sent {next_id}, delivered {len(delivered)}, "
+          f"duplicates {sum(count - 1 for count in delivered.values())}")
+    print(f"upstream: {api.requests['getMessages'] / elapsed:.1f} inbox polls/s, "
+          f"{api.requests['readMessage'] / elapsed:.1f} message reads/s")
+    if latencies:
+        latencies.sort()
+        print(f"delivery latency: p50 {statistics.median(latencies):.1f}s, "
+              f"p95 {latencies[int(len(latencies) * 0.95) - 1]:.1f}s, max {latencies[-1]:.1f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mailboxes", type=int, default=500)
+    parser.add_argument("--mail-rate", type=float, default=5.0)
+    parser.add_argument("--seconds", type=float, default=30.0)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,326 @@
+"""End-to-end load test: thousands of simulated users through the real handlers, against local stubs.
+
+Starts a stub Bot API, a stub 1secmail and a stub SMS-Activate in a separate
+process, each answering after a configurable latency. It then builds the bot
+with user_bot.build_application() and feeds it Telegram updates through the
+same update processor production uses. Postgres is real: the users, sessions,
+ledger and activation tables are TRUNCATED first, so it runs against
+BENCH_DATABASE_URL, a throwaway database, and refuses to start without it.
+
+Scenarios, run in order, each one update per user, with arrivals spread over
+--ramp-seconds:
+
+  start           /start (registers the user)
+  generate_email  "✅ এখন ইমেইল তৈরি করুন" after the ad
+  check_inbox     ad-free inbox check, delivering --mail-messages messages
+  pay_generate    paid email generation (debits credits)
+  buy_number      rents an SMS number (users are topped up first)
+
+For each scenario it reports throughput, p50/p99 latency per update, Bot API
+calls per update and the peak number of Postgres connections. It compares the
+results with a stored baseline and exits with status 1 on a regression beyond
+--tolerance:
+
+    BENCH_DATABASE_URL=postgresql://postgres@localhost/bench python benchmarks/load_test.py --users 1000
+    ... --save-baseline          # store this run as benchmarks/load_baseline.json
+
+The stored baseline comes from one developer machine; save a fresh one before
+comparing on different hardware.
+
+Telegram's flood limits are raised for the run (TELEGRAM_* variables) so the
+numbers show the bot's own capacity; set them in the environment to test with
+the real limits.
+"""
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import time
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# --- Stub servers (run in their own process) ---
+def run_stubs(ports, latencies, mail_messages, ready):
+    import tornado.web
+
+    counts = collections.Counter()
+    next_id = iter(range(1, 10 ** 9))
+
+    class Stub(tornado.web.RequestHandler):
+        def initialize(self, latency):
+            self.latency = latency
+
+        async def delay(self):
+            if self.latency:
+                await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+
+    class TelegramStub(Stub):
+        async def post(self, token, method):
+            counts[method] += 1
+            await self.delay()
+            if method == "getMe":
+                result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot",
+                          "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False}
+            elif method.startswith(("send", "edit")):
+                chat_id = int(self.get_body_argument("chat_id", "0") or 0)
+                result = {"message_id": next(next_id), "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}, "text": "ok"}
+            else:
+                result = True
+            self.write({"ok": True, "result": result})
+
+    class StatsStub(tornado.web.RequestHandler):
+        def get(self):
+            self.write(dict(counts))
+
+    class MailStub(Stub):
+        async def get(self):
+            await self.delay()
+            action = self.get_query_argument("action")
+            if action == "genRandomMailbox":
+                self.write(json.dumps([f"bench{next(next_id)}@1secmail.com"]))
+            elif action == "getMessages":
+                self.write(json.dumps([{"id": i, "from": "load@test", "subject": f"mail {i}", "date": "2026-01-01 00:00:00"}
+                                       for i in range(1, mail_messages + 1)]))
+            else:
+                self.write({"id": int(self.get_query_argument("id")), "from": "load@test", "subject": "mail",
+                            "date": "2026-01-01 00:00:00", "textBody": "hello from the load test"})
+
+    class SmsStub(Stub):
+        async def get(self):
+            await self.delay()
+            action = self.get_query_argument("action")
+            if action == "getNumber":
+                activation_id = next(next_id)
+                self.write(f"ACCESS_NUMBER:{activation_id}:8801{activation_id:08d}")
+            elif action == "setStatus":
+                self.write("ACCESS_CANCEL")
+            else:
+                self.write("STATUS_WAIT_CODE")
+
+    async def serve():
+        tornado.web.Application([
+            (r"/bot([^/]+)/(\w+)", TelegramStub, {"latency": latencies["telegram"]}),
+            (r"/stats", StatsStub),
+        ]).listen(ports["telegram"], address="127.0.0.1")
+        tornado.web.Application([(r"/.*", MailStub, {"latency": latencies["mail"]})]).listen(ports["mail"], address="127.0.0.1")
+        tornado.web.Application([(r"/.*", SmsStub, {"latency": latencies["sms"]})]).listen(ports["sms"], address="127.0.0.1")
+        ready.set()
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+# --- Load generation ---
+def user_json(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+
+
+def command_update(update_id, user_id, text):
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+        "from": user_json(user_id), "text": text,
+        "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}],
+    }}
+
+
+def callback_update(update_id, user_id, data):
+    return {"update_id": update_id, "callback_query": {
+        "id": str(update_id), "from": user_json(user_id), "chat_instance": str(user_id), "data": data,
+        "message": {"message_id": 1, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+                    "from": {"id": 1, "is_bot": True, "first_name": "Bench"}, "text": "menu"},
+    }}
+
+
+SCENARIOS = [
+    ("start", lambda update_id, user_id: command_update(update_id, user_id, "/start")),
+    ("generate_email", lambda update_id, user_id: callback_update(update_id, user_id, "email_proceed_generate")),
+    ("check_inbox", lambda update_id, user_id: callback_update(update_id, user_id, "email_proceed_inbox_ad_free")),
+    ("pay_generate", lambda update_id, user_id: callback_update(update_id, user_id, "email_pay_generate")),
+    ("buy_number", lambda update_id, user_id: callback_update(update_id, user_id, "number_buy:other")),
+]
+
+
+class ConnectionSampler:
+    """Samples the number of connections to the bench database from its own connection."""
+
+    def __init__(self, db):
+        self.db = db
+        self.peak = 0
+        self._conn = None
+
+    def sample(self):
+        if self._conn is None:
+            self._conn = self.db.get_db_connection()
+            self._conn.autocommit = True
+        with self._conn.cursor() as cur:
+            cur.execute("SELECT count(*) - 1 FROM pg_stat_activity WHERE datname = current_database()")
+            self.peak = max(self.peak, cur.fetchone()[0])
+
+    async def run(self, stop):
+        loop = asyncio.get_running_loop()
+        while not stop.is_set():
+            await loop.run_in_executor(None, self.sample)
+            await asyncio.sleep(0.05)
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def run_scenario(name, make_update, application, user_bot, args, update_ids, stub_stats):
+    from telegram import Update
+
+    sampler = ConnectionSampler(user_bot.db)
+    stop = asyncio.Event()
+    sampling = asyncio.create_task(sampler.run(stop))
+    calls_before = sum((await stub_stats()).values())
+    latencies = []
+    processor = application.update_processor
+
+    async def simulated_user(user_id):
+        await asyncio.sleep(random.uniform(0, args.ramp_seconds))
+        update = Update.de_json(make_update(next(update_ids), user_id), application.bot)
+        started = time.perf_counter()
+        await processor.process_update(update, application.process_update(update))
+        latencies.append(time.perf_counter() - started)
+
+    started = time.monotonic()
+    await asyncio.gather(*(simulated_user(user_id) for user_id in range(1, args.users + 1)))
+    elapsed = time.monotonic() - started
+    stop.set()
+    await sampling
+    calls = sum((await stub_stats()).values()) - calls_before
+
+    latencies.sort()
+    return {
+        "updates": len(latencies),
+        "throughput": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "api_calls_per_update": round(calls / len(latencies), 2),
+        "db_connections": sampler.peak,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Prints the change against the baseline and returns the regressions."""
+    regressions = []
+    print(f"\n{'scenario':<16}{'throughput':>14}{'p50 ms':>14}{'p99 ms':>14}{'API calls':>14}{'DB conns':>14}")
+    for name, result in results.items():
+        base = baseline.get(name, {})
+        cells = []
+        for key, higher_is_better in (("throughput", True), ("p50_ms", False), ("p99_ms", False),
+                                      ("api_calls_per_update", False), ("db_connections", False)):
+            value, before = result[key], base.get(key)
+            if not before:
+                cells.append(f"{value:>14}")
+                continue
+            change = (value - before) / before
+            worse = -change if higher_is_better else change
+            if worse > tolerance and key != "db_connections":
+                regressions.append(f"{name} {key}: {before} -> {value}")
+            cells.append(f"{value:>8} {change:+5.0%}")
+        print(f"{name:<16}" + "".join(cells))
+    return regressions
+
+
+async def main(args, user_bot, ports):
+    import httpx
+
+    db = user_bot.db
+    db.bootstrap_database()
+    with db.db_cursor() as cur:
+        cur.execute("TRUNCATE users, user_sessions, balance_ledger, sms_activations")
+
+    async with httpx.AsyncClient() as client:
+        async def stub_stats():
+            return (await client.get(f"http://127.0.0.1:{ports['telegram']}/stats")).json()
+
+        application = user_bot.build_application()
+        await application.initialize()
+        update_ids = iter(range(1, 10 ** 9))
+        results = {}
+        try:
+            for name, make_update in SCENARIOS:
+                if args.scenarios and name not in args.scenarios:
+                    continue
+                if name == "buy_number":
+                    with db.db_cursor() as cur:
+                        cur.execute("UPDATE users SET balance = 1000")
+                    user_bot._balance_cache.clear()
+                results[name] = await run_scenario(name, make_update, application, user_bot, args, update_ids, stub_stats)
+                print(f"{name}: {results[name]}")
+        finally:
+            await user_bot.post_stop(application)
+            await application.shutdown()
+            await user_bot.post_shutdown(application)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+        print(f"\nSaved the baseline to {args.baseline}")
+    elif regressions:
+        print("\nRegressions beyond the tolerance:\n  " + "\n  ".join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--ramp-seconds", type=float, default=1.0)
+    parser.add_argument("--telegram-latency-ms", type=float, default=20)
+    parser.add_argument("--mail-latency-ms", type=float, default=50)
+    parser.add_argument("--sms-latency-ms", type=float, default=50)
+    parser.add_argument("--mail-messages", type=int, default=2)
+    parser.add_argument("--scenarios", nargs="*", choices=[name for name, _ in SCENARIOS])
+    parser.add_argument("--baseline", default=os.path.join(os.path.dirname(__file__), "load_baseline.json"))
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+    random.seed(1)
+    import _repo
+    _repo.use_bench_database()
+
+    ports = {"telegram": free_port(), "mail": free_port(), "sms": free_port()}
+    latencies = {"telegram": args.telegram_latency_ms / 1000, "mail": args.mail_latency_ms / 1000, "sms": args.sms_latency_ms / 1000}
+    ready = multiprocessing.Event()
+    stubs = multiprocessing.Process(target=run_stubs, args=(ports, latencies, args.mail_messages, ready), daemon=True)
+    stubs.start()
+    ready.wait(10)
+
+    os.environ.update({
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{ports['telegram']}/bot",
+        "MAIL_API_URL": f"http://127.0.0.1:{ports['mail']}/",
+        "SMS_API_URL": f"http://127.0.0.1:{ports['sms']}/",
+        "MAIL_PROVIDERS": "1secmail",
+    })
+    for key, value in {
+        "USER_BOT_TOKEN": "123456:bench", "SMS_ACTIVATE_API_KEY": "bench", "WELCOME_IMAGE_URL": "",
+        "METRICS_PORT": "0", "SMS_API_RATE_PER_SECOND": "100000",
+        "TELEGRAM_GLOBAL_RATE": "100000", "TELEGRAM_PER_CHAT_RATE": "1000", "TELEGRAM_PER_CHAT_BURST": "1000",
+    }.items():
+        os.environ.setdefault(key, value)
+    user_bot = _repo.load("user_bot")
+    logging.getLogger("httpx").setLevel(logging.WARNING)  # One line per request would dominate the run
+
+    status = asyncio.run(main(args, user_bot, ports))
+    stubs.terminate()
+    sys.exit(status)
@@ -0,0 +1,108 @@
+"""Runs the temp mail providers against local fault-injecting stubs of 1secmail and Guerrilla Mail.
+
+Scenarios:
+  healthy   both providers answer normally
+  outage    1secmail answers 503 to everything: creation fails over, then the breaker fails fast
+  tail      a share of 1secmail answers are slow, with and without hedged requests
+
+For each scenario it prints the creation latency the user sees, where mailboxes
+were created, and each provider's p50/p99 and breaker state:
+
+    python benchmarks/mail_failover_bench.py --requests 300 --slow-share 0.05 --slow-seconds 1.5
+"""
+import argparse
+import asyncio
+import collections
+import random
+import statistics
+import time
+
+import httpx
+
+import _repo
+user_bot = _repo.load("user_bot")
+
+
+class FaultyStub:
+    """An in-process mail API that can fail or stall a share of its requests."""
+
+    def __init__(self, kind, base_latency=0.01):
+        self.kind = kind
+        self.base_latency = base_latency
+        self.error_share = 0.0
+        self.slow_share = 0.0
+        self.slow_seconds = 0.0
+        self.requests = 0
+        self.counter = 0
+
+    async def handle(self, request):
+        self.requests += 1
+        slow = random.random() < self.slow_share
+        await asyncio.sleep(self.slow_seconds if slow else self.base_latency)
+        if random.random() < self.error_share:
+            return httpx.Response(503, text="unavailable")
+        self.counter += 1
+        if self.kind == "1secmail":
+            return httpx.Response(200, json=[f"bench{self.counter}@1secmail.com"])
+        return httpx.Response(200, json={"email_addr": f"bench{self.counter}@guerrillamailblock.com", "sid_token": str(self.counter)})
+
+
+def install(stubs):
+    for name, provider in user_bot.mail_service.providers.items():
+        provider.client._client = httpx.AsyncClient(base_url="http://stub/", transport=httpx.MockTransport(stubs[name].handle))
+
+
+def reset_stats():
+    for provider in user_bot.mail_service.providers.values():
+        provider.breaker.state = "closed"
+        provider.breaker._outcomes.clear()
+        provider.breaker._failures = 0
+        provider.latency._samples.clear()
+        provider.attempts = provider.failures = provider.hedges = 0
+
+
+async def run(name, requests, concurrency):
+    reset_stats()
+    latencies, created_on = [], collections.Counter()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def create():
+        async with semaphore:
+            started = time.monotonic()
+            account = await user_bot.create_email()
+            latencies.append(time.monotonic() - started)
+            created_on[account["provider"] if account else "failed"] += 1
+
+    await asyncio.gather(*(create() for _ in range(requests)))
+    latencies.sort()
+    print(f"\n{name}: user-facing p50 {statistics.median(latencies) * 1000:.0f} ms, "
+          f"p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:.0f} ms, created on {dict(created_on)}")
+    for provider_name, stats in user_bot.mail_service.stats().items():
+        print(f"  {provider_name:<14} {stats}")
+
+
+async def main(args):
+    stubs = {"1secmail": FaultyStub("1secmail"), "guerrillamail": FaultyStub("guerrillamail")}
+    install(stubs)
+
+    await run("healthy", args.requests, args.concurrency)
+
+    stubs["1secmail"].error_share = 1.0
+    await run("outage", args.requests, args.concurrency)
+    stubs["1secmail"].error_share = 0.0
+
+    stubs["1secmail"].slow_share, stubs["1secmail"].slow_seconds = args.slow_share, args.slow_seconds
+    user_bot.MAIL_HEDGE_AFTER_SECONDS = 0
+    await run("tail, no hedging", args.requests, args.concurrency)
+    user_bot.MAIL_HEDGE_AFTER_SECONDS = args.hedge_after
+    await run(f"tail, hedging after {args.hedge_after}s", args.requests, args.concurrency)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--slow-share", type=float, default=0.05)
+    parser.add_argument("--slow-seconds", type=float, default=1.5)
+    parser.add_argument("--hedge-after", type=float, default=0.1)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,112 @@
+"""Replays a burst of outgoing messages against a simulated Telegram that enforces flood limits.
+
+The simulated Bot API allows --global-limit requests per second overall and
+--chat-limit per chat per second, and answers RetryAfter beyond that. The same
+workload is sent directly and through user_bot.OutboundRateLimiter:
+
+  bulk         --bulk-chats chats get --per-chat messages each (inbox watcher / broadcast)
+  interactive  --taps "checking..." + result edit pairs to one message per tap
+
+It reports RetryAfter answers, requests that failed outright, API calls saved by
+edit coalescing, and how long interactive edits waited:
+
+    python benchmarks/outbound_limiter_bench.py --bulk-chats 200 --per-chat 3 --taps 100
+"""
+import argparse
+import asyncio
+import collections
+import statistics
+import time
+
+import _repo
+user_bot = _repo.load("user_bot")
+from telegram.error import RetryAfter  # noqa: E402
+
+
+class FloodingTelegram:
+    def __init__(self, global_limit, chat_limit):
+        self.global_limit = global_limit
+        self.chat_limit = chat_limit
+        self.recent = collections.deque()
+        self.recent_by_chat = collections.defaultdict(collections.deque)
+        self.calls = 0
+        self.retry_afters = 0
+
+    async def post(self, endpoint, data):
+        self.calls += 1
+        now = time.monotonic()
+        chat = self.recent_by_chat[data["chat_id"]]
+        for window in (self.recent, chat):
+            while window and window[0] < now - 1:
+                window.popleft()
+        if len(self.recent) >= self.global_limit or len(chat) >= self.chat_limit:
+            self.retry_afters += 1
+            raise RetryAfter(1)
+        self.recent.append(now)
+        chat.append(now)
+        await asyncio.sleep(0.005)
+        return {"ok": True}
+
+
+async def run(label, limiter, args):
+    telegram = FloodingTelegram(args.global_limit, args.chat_limit)
+    failed = 0
+    interactive_waits = []
+
+    async def call(endpoint, data, priority):
+        nonlocal failed
+        user_bot.send_priority.set(priority)
+        try:
+            if limiter is None:
+                return await telegram.post(endpoint, data)
+            return await limiter.process_request(telegram.post, (endpoint, data), {}, endpoint, data, None)
+        except RetryAfter:
+            failed += 1
+
+    async def bulk(chat_id):
+        for i in range(args.per_chat):
+            await call("sendMessage", {"chat_id": chat_id, "text": f"mail {i}"}, user_bot.SEND_PRIORITY_BULK)
+
+    async def tap(chat_id):
+        await asyncio.sleep(chat_id * args.tap_interval)
+        started = time.monotonic()
+        message = {"chat_id": 10_000_000 + chat_id, "message_id": 1}
+        checking = asyncio.create_task(call("editMessageText", {**message, "text": "⏳ checking..."}, user_bot.SEND_PRIORITY_INTERACTIVE))
+        await asyncio.sleep(0.05)
+        await call("editMessageText", {**message, "text": "result"}, user_bot.SEND_PRIORITY_INTERACTIVE)
+        await checking
+        interactive_waits.append(time.monotonic() - started)
+
+    if limiter is not None:
+        await limiter.initialize()
+    started = time.monotonic()
+    await asyncio.gather(*(bulk(chat_id) for chat_id in range(args.bulk_chats)), *(tap(i) for i in range(args.taps)))
+    elapsed = time.monotonic() - started
+    if limiter is not None:
+        await limiter.shutdown()
+
+    sent = args.bulk_chats * args.per_chat + args.taps * 2
+    interactive_waits.sort()
+    print(f"\n{label}: {sent} requests in {elapsed:.1f}s, {telegram.calls} API calls, "
+          f"{telegram.retry_afters} RetryAfter answers, {failed} failed")
+    print(f"  interactive tap -> result: p50 {statistics.median(interactive_waits) * 1000:.0f} ms, "
+          f"p99 {interactive_waits[int(len(interactive_waits) * 0.99) - 1] * 1000:.0f} ms")
+    if limiter is not None:
+        print(f"  limiter: {limiter.stats()}")
+
+
+async def main(args):
+    await run("direct", None, args)
+    limiter = user_bot.OutboundRateLimiter(args.global_limit * 0.9, args.chat_limit * 0.9, None, 20 / 60, 3)
+    await run("through OutboundRateLimiter", limiter, args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--bulk-chats", type=int, default=200)
+    parser.add_argument("--per-chat", type=int, default=3)
+    parser.add_argument("--taps", type=int, default=100)
+    parser.add_argument("--tap-interval", type=float, default=0.05)
+    parser.add_argument("--global-limit", type=int, default=30)
+    parser.add_argument("--chat-limit", type=int, default=1)
+    asyncio.run(main(parser.parse_args()))
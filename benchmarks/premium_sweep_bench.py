@@ -0,0 +1,99 @@
+"""Times the premium-expiry sweep and counts queries made by premium checks through user_bot.PremiumEntitlements.
+
+Seeds --users users, a --premium-percent share of them premium, with expiries
+spread over the last and next --spread-hours hours. It shows the sweep's plan,
+times user_bot.expire_premium downgrading the expired half, then makes --checks
+premium checks, the way taps on the ad prompt do, over --active users and
+reports how many of them reached the database.
+
+It TRUNCATES users, so it runs against BENCH_DATABASE_URL, a throwaway
+database, and refuses to start without it:
+
+    BENCH_DATABASE_URL=postgresql://postgres@localhost/bench python benchmarks/premium_sweep_bench.py --users 1000000
+"""
+import argparse
+import asyncio
+import random
+import time
+
+import _repo
+_repo.use_bench_database()
+user_bot = _repo.load("user_bot")
+
+db = user_bot.db
+
+
+def seed(args):
+    db.bootstrap_database()
+    with db.db_cursor() as cur:
+        cur.execute("TRUNCATE users")
+        cur.execute(
+            """
+            INSERT INTO users (user_id, first_name, referral_code, is_premium, premium_expiry)
+            SELECT g, 'bench', 'b' || g, premium, CASE WHEN premium THEN NOW() + make_interval(secs => (random() * 2 - 1) * %s) END
+            FROM (SELECT g, random() * 100 < %s AS premium FROM generate_series(1, %s) g) seeded
+            """,
+            (args.spread_hours * 3600, args.premium_percent, args.users)
+        )
+        cur.execute("ANALYZE users")
+        cur.execute("SELECT count(*) FROM users WHERE is_premium AND premium_expiry <= NOW()")
+        expired = cur.fetchone()[0]
+        cur.execute(
+            "EXPLAIN SELECT user_id FROM users WHERE is_premium AND premium_expiry <= NOW() "
+            "ORDER BY premium_expiry LIMIT %s FOR UPDATE SKIP LOCKED",
+            (user_bot.PREMIUM_SWEEP_BATCH,)
+        )
+        plan = [row[0] for row in cur.fetchall()]
+    return expired, plan
+
+
+async def main(args):
+    started = time.monotonic()
+    expired, plan = seed(args)
+    print(f"Seeded {args.users} users in {time.monotonic() - started:.1f}s, {expired} with expired premium")
+    print("Sweep plan:\n  " + "\n  ".join(plan))
+
+    started = time.monotonic()
+    await user_bot.expire_premium(None)
+    elapsed = time.monotonic() - started
+    with db.db_cursor() as cur:
+        cur.execute("SELECT count(*) FROM users WHERE is_premium AND premium_expiry <= NOW()")
+        left = cur.fetchone()[0]
+        cur.execute("DELETE FROM activity_log WHERE action = 'premium_expired'")
+        logged = cur.rowcount
+    print(f"\nSweep: {expired - left} downgraded in {elapsed:.2f}s, {left} left, {logged} logged")
+
+    queries = 0
+    observe = db.query_observer
+
+    def count_queries(query, seconds):
+        nonlocal queries
+        queries += 1
+        if observe is not None:
+            observe(query, seconds)
+
+    db.query_observer = count_queries
+    active = random.sample(range(1, args.users + 1), args.active)
+    started = time.monotonic()
+    premium_users = 0
+    for _ in range(args.checks):
+        premium_users += await user_bot.premium.is_active(random.choice(active))
+    elapsed = time.monotonic() - started
+    db.query_observer = observe
+    print(f"\nPremium checks: {args.checks} over {args.active} users in {elapsed:.2f}s, "
+          f"{queries} queries ({queries / args.checks:.3f} per check), {premium_users} answered premium")
+    print(f"  cache: {user_bot.premium.stats()}")
+    await db.activity_log.close()
+    db.close_pool()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=200000)
+    parser.add_argument("--premium-percent", type=float, default=10)
+    parser.add_argument("--spread-hours", type=float, default=24)
+    parser.add_argument("--active", type=int, default=5000)
+    parser.add_argument("--checks", type=int, default=100000)
+    args = parser.parse_args()
+    random.seed(1)
+    asyncio.run(main(args))
@@ -0,0 +1,78 @@
+"""Micro-benchmark for menu rendering: latency and allocations per keyboard build.
+
+Compares building the main and email menus from scratch on every render (the old
+way) with the prebuilt and memoized keyboards in user_bot. Needs no network or
+Postgres:
+
+    python benchmarks/render_bench.py --iterations 50000
+"""
+import argparse
+import time
+import tracemalloc
+
+import _repo
+user_bot = _repo.load("user_bot")
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup  # noqa: E402
+
+
+def build_main_menu(balance):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"💰 আপনার ব্যালেন্স: {balance:.2f} ক্রেডিট", callback_data="account_menu")],
+        [InlineKeyboardButton("✉️ টেম্পোরারি ইমেইল", callback_data="email_menu"),
+         InlineKeyboardButton("📱 টেম্পোরারি নম্বর", callback_data="number_menu")],
+        [InlineKeyboardButton("💎 프리미엄 ও টপ-আপ", callback_data="premium_menu"),
+         InlineKeyboardButton("🤝 রেফারেল", callback_data="referral_menu")],
+        [InlineKeyboardButton("📞 সাপোর্ট", callback_data="support_menu"),
+         InlineKeyboardButton("📢 চ্যানেল", url=user_bot.TELEGRAM_CHANNEL_LINK)],
+    ])
+
+
+def build_email_menu(price):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("👀 বিজ্ঞাপন দেখে করুন (ফ্রি)", callback_data="email_ad_prompt")],
+        [InlineKeyboardButton(f"💳 {price:.2f} ক্রেডিট খরচ করুন", callback_data="email_pay_generate")],
+        [InlineKeyboardButton("↩️ মূল মেন্যুতে ফিরুন", callback_data="main_menu")],
+    ])
+
+
+CASES = {
+    "main_menu/rebuilt": lambda i: build_main_menu(10.0 + i % 50),
+    "main_menu/cached": lambda i: user_bot._main_menu_keyboard(f"{10.0 + i % 50:.2f}"),
+    "email_menu/rebuilt": lambda i: build_email_menu(1.0),
+    "email_menu/cached": lambda i: user_bot.get_email_menu_keyboard(f"{1.0:.2f}"),
+    "email_control/rebuilt": lambda i: InlineKeyboardMarkup([
+        [InlineKeyboardButton("🔄 ইনবক্স চেক করুন", callback_data="email_inbox_prompt")],
+        [InlineKeyboardButton("🗑️ ইমেইলটি মুছুন", callback_data="email_delete_confirm")],
+        [InlineKeyboardButton("↩️ মূল মেন্যুতে ফিরুন", callback_data="main_menu")],
+    ]),
+    "email_control/cached": lambda i: user_bot.get_email_control_keyboard(),
+}
+
+
+def bench(render, iterations):
+    started = time.perf_counter()
+    for i in range(iterations):
+        render(i)
+    elapsed = time.perf_counter() - started
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    kept = [render(i) for i in range(1000)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    del kept
+    return elapsed / iterations * 1e6, allocated / 1000
+
+
+def main(iterations):
+    print(f"{'keyboard':<24}{'us/render':>12}{'bytes/render':>14}")
+    for name, render in CASES.items():
+        per_render, per_render_bytes = bench(render, iterations)
+        print(f"{name:<24}{per_render:>12.2f}{per_render_bytes:>14.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=20000)
+    main(parser.parse_args().iterations)
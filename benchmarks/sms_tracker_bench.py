@@ -0,0 +1,136 @@
+"""Simulates the SMS activation tracker against a local stub of the SMS-Activate API.
+
+Rents --activations numbers, lets half of them receive a code at random times and
+lets the rest time out. Reports provider requests by action, and checks that
+every code is delivered once and every timed-out number is refunded once. The
+sms_activations table is replaced by an in-memory stand-in, so no Postgres or
+network is needed:
+
+    SMS_ACTIVATION_TIMEOUT_SECONDS=20 python benchmarks/sms_tracker_bench.py --activations 5000
+    SMS_BULK_STATUS=0 SMS_ACTIVATION_TIMEOUT_SECONDS=20 python benchmarks/sms_tracker_bench.py --activations 5000
+"""
+import argparse
+import asyncio
+import collections
+import os
+import random
+import time
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+import httpx
+
+os.environ.setdefault("SMS_ACTIVATE_API_KEY", "bench")
+import _repo
+user_bot = _repo.load("user_bot")
+
+
+class StubSmsApi:
+    def __init__(self):
+        self.codes = {}  # provider id -> code or None, for activations still active
+        self.next_id = 0
+        self.requests = collections.Counter()
+
+    def handle(self, request):
+        params = dict(request.url.params)
+        action = params["action"]
+        self.requests[action] += 1
+        if action == "getNumber":
+            self.next_id += 1
+            self.codes[str(self.next_id)] = None
+            return httpx.Response(200, text=f"ACCESS_NUMBER:{self.next_id}:8801{self.next_id:08d}")
+        if action == "getActiveActivations":
+            active = [{"activationId": key, "smsCode": [code] if code else None} for key, code in self.codes.items()]
+            if not active:
+                return httpx.Response(200, json={"status": "error", "error": "NO_ACTIVATIONS"})
+            return httpx.Response(200, json={"status": "success", "activeActivations": active})
+        if action == "getStatus":
+            if params["id"] not in self.codes:
+                return httpx.Response(200, text="STATUS_CANCEL")
+            code = self.codes[params["id"]]
+            return httpx.Response(200, text=f"STATUS_OK:{code}" if code else "STATUS_WAIT_CODE")
+        if action == "setStatus":
+            self.codes.pop(params["id"], None)
+            return httpx.Response(200, text="ACCESS_CANCEL" if params["status"] == "8" else "ACCESS_ACTIVATION")
+        return httpx.Response(200, text="BAD_ACTION")
+
+
+def install_fake_db():
+    activations, balances, refunds = {}, collections.defaultdict(lambda: 1000.0), collections.Counter()
+
+    async def order_activation(user_id, service, price):
+        balances[user_id] -= price
+        activations[len(activations) + 1] = {"user_id": user_id, "price": price, "status": "ordering"}
+        return len(activations), balances[user_id]
+
+    async def start_activation(activation_id, provider_id, phone_number, expires_at):
+        activations[activation_id]["status"] = "waiting"
+        return True
+
+    async def complete_activation(activation_id, code):
+        if activations[activation_id]["status"] != "waiting":
+            return False
+        activations[activation_id]["status"] = "received"
+        return True
+
+    async def refund_activation(activation_id, reason):
+        activation = activations[activation_id]
+        if activation["status"] not in ("ordering", "waiting"):
+            return None
+        activation["status"] = "refunded"
+        refunds[activation_id] += 1
+        balances[activation["user_id"]] += activation["price"]
+        return activation["user_id"], balances[activation["user_id"]]
+
+    for function in (order_activation, start_activation, complete_activation, refund_activation):
+        setattr(user_bot.db, function.__name__, function)
+    user_bot.db.get_setting = AsyncMock(return_value=15.0)
+    user_bot.db.activity_log.log = AsyncMock()
+    return activations, refunds
+
+
+async def main(args):
+    api = StubSmsApi()
+    user_bot.sms_client._client = httpx.AsyncClient(base_url="http://stub/", transport=httpx.MockTransport(api.handle))
+    activations, refunds = install_fake_db()
+    delivered = collections.Counter()
+
+    async def send_message(chat_id, text, parse_mode=None):
+        delivered[chat_id] += 1
+
+    context = SimpleNamespace(bot=SimpleNamespace(send_message=send_message))
+
+    async def rent(user_id):
+        query = SimpleNamespace(from_user=SimpleNamespace(id=user_id), answer=AsyncMock(), edit_message_text=AsyncMock())
+        user_bot._query_answered.set([False])
+        await user_bot.number_buy_handler(SimpleNamespace(callback_query=query), context, "other")
+
+    started = time.monotonic()
+    await asyncio.gather(*(rent(user_id) for user_id in range(args.activations)))
+    print(f"rented {args.activations} numbers in {time.monotonic() - started:.1f}s")
+
+    receiving = random.sample(sorted(api.codes), args.activations // 2)
+    arrival = {provider_id: started + random.uniform(0, user_bot.SMS_ACTIVATION_TIMEOUT_SECONDS * 0.8)
+               for provider_id in receiving}
+    while any(activation["status"] in ("ordering", "waiting") for activation in activations.values()):
+        now = time.monotonic()
+        for provider_id, at in list(arrival.items()):
+            if at <= now and provider_id in api.codes:
+                api.codes[provider_id] = "123456"
+                del arrival[provider_id]
+        await user_bot.activation_tracker.tick(context)
+        await asyncio.sleep(user_bot.SMS_POLL_TICK_SECONDS)
+    elapsed = time.monotonic() - started
+
+    statuses = collections.Counter(activation["status"] for activation in activations.values())
+    print(f"finished in {elapsed:.1f}s: {dict(statuses)}")
+    print(f"provider requests: {dict(api.requests)}")
+    print(f"tracker: {user_bot.activation_tracker.stats()}")
+    print(f"double refunds: {sum(count > 1 for count in refunds.values())}, "
+          f"users notified more than once: {sum(count > 1 for count in delivered.values())}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--activations", type=int, default=1000)
+    asyncio.run(main(parser.parse_args()))
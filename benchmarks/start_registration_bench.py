@@ -0,0 +1,156 @@
+"""/start registration throughput: the old multi-query registration versus database.add_user_if_not_exists.
+
+--users new users register concurrently, a --referred-percent share of them
+with a referral code of an already registered user, and every --double-every'th
+user taps /start twice at once. Both paths run on the pooled DB threads; the
+old one also opens a connection per settings read, as get_setting did then:
+
+  multi-query      SELECT the user, read signup_bonus and referral_bonus on their
+                   own connections, look up the referrer, credit it, INSERT
+  single statement the INSERT ... ON CONFLICT DO NOTHING CTE with the referral
+                   credit and ledger rows, as add_user_if_not_exists runs it
+
+It reports registrations/s, how many /start calls failed, and whether every
+referrer was credited exactly once per referral. For add_user_if_not_exists it
+also counts calls, double taps included, that did not return the signup bonus
+as the new user's balance. database.bulk_import_users loading the same number
+of users from a dump is timed for comparison. Needs a local Postgres; the bench
+users are deleted afterwards:
+
+    DATABASE_URL=postgresql://postgres@localhost/bench python benchmarks/start_registration_bench.py --users 20000
+"""
+import argparse
+import asyncio
+import random
+import time
+import uuid
+
+import _repo
+db = _repo.load("database")
+from psycopg2.extras import DictCursor  # noqa: E402
+
+FIRST_USER_ID = 10 ** 12  # Above real Telegram ids, so the bench rows are easy to delete
+REFERRERS = 100
+
+
+def get_setting(key):
+    # As before, a settings read opened a connection of its own
+    conn = db.get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT value FROM settings WHERE key = %s", (key,))
+            result = cur.fetchone()
+    finally:
+        conn.close()
+    return float(result[0]) if result else 0.0
+
+
+@db.run_in_db_executor
+def multi_query_add_user(user_id, first_name, referral_code=None):
+    """The registration add_user_if_not_exists replaced, on pooled connections."""
+    with db.db_cursor(DictCursor) as cur:
+        cur.execute("SELECT * FROM users WHERE user_id = %s", (user_id,))
+        if cur.fetchone():
+            return
+        signup_bonus = get_setting('signup_bonus')
+        referred_by_id = None
+        if referral_code:
+            cur.execute("SELECT user_id FROM users WHERE referral_code = %s", (referral_code,))
+            referrer = cur.fetchone()
+            if referrer:
+                referred_by_id = referrer['user_id']
+                cur.execute(
+                    "UPDATE users SET balance = balance + %s WHERE user_id = %s",
+                    (get_setting('referral_bonus'), referred_by_id)
+                )
+        cur.execute(
+            "INSERT INTO users (user_id, first_name, balance, referral_code, referred_by) VALUES (%s, %s, %s, %s, %s)",
+            (user_id, first_name, signup_bonus, str(uuid.uuid4())[:8], referred_by_id)
+        )
+
+
+def reset():
+    with db.db_cursor() as cur:
+        cur.execute("DELETE FROM balance_ledger WHERE user_id >= %s", (FIRST_USER_ID,))
+        cur.execute("DELETE FROM users WHERE user_id >= %s", (FIRST_USER_ID,))
+        cur.execute(
+            "INSERT INTO users (user_id, first_name, balance, referral_code) "
+            "SELECT %s + g, 'referrer', 0, 'bench-ref-' || g FROM generate_series(0, %s) g",
+            (FIRST_USER_ID, REFERRERS - 1)
+        )
+
+
+def referral_check():
+    """Returns (referred users, referrers' total credit / referral_bonus)."""
+    bonus = get_setting('referral_bonus')
+    with db.db_cursor() as cur:
+        cur.execute("SELECT count(*) FROM users WHERE referred_by >= %s", (FIRST_USER_ID,))
+        referred = cur.fetchone()[0]
+        cur.execute("SELECT sum(balance) FROM users WHERE user_id < %s + %s AND user_id >= %s",
+                    (FIRST_USER_ID, REFERRERS, FIRST_USER_ID))
+        credited = float(cur.fetchone()[0] or 0)
+    return referred, round(credited / bonus) if bonus else 0
+
+
+async def run(label, add_user, args, check_balance=False):
+    reset()
+    base = FIRST_USER_ID + REFERRERS
+    calls = []
+    for index in range(args.users):
+        code = f"bench-ref-{random.randrange(REFERRERS)}" if random.random() * 100 < args.referred_percent else None
+        calls.append((base + index, code))
+        if index % args.double_every == 0:
+            calls.append((base + index, code))
+    random.shuffle(calls)
+
+    failed = wrong_balance = 0
+    signup_bonus = get_setting('signup_bonus')
+
+    async def start(user_id, code):
+        nonlocal failed, wrong_balance
+        try:
+            balance = await add_user(user_id, "bench", code)
+        except Exception:
+            failed += 1  # A double tap racing its own registration
+            return
+        if check_balance and balance != signup_bonus:
+            wrong_balance += 1
+
+    started = time.monotonic()
+    await asyncio.gather(*(start(user_id, code) for user_id, code in calls))
+    elapsed = time.monotonic() - started
+    referred, credits = referral_check()
+    print(f"{label}: {len(calls)} /start calls for {args.users} new users in {elapsed:.2f}s "
+          f"({args.users / elapsed:,.0f} registrations/s), {failed} failed, "
+          f"{referred} referred users, {credits} referral credits"
+          + (f", {wrong_balance} wrong balances returned" if check_balance else ""))
+
+
+def bulk_import(args):
+    reset()
+    rows = ({'user_id': FIRST_USER_ID + REFERRERS + index, 'first_name': 'bench'} for index in range(args.users))
+    started = time.monotonic()
+    inserted = db.bulk_import_users(rows)
+    elapsed = time.monotonic() - started
+    print(f"bulk_import_users: {inserted} users in {elapsed:.2f}s ({inserted / elapsed:,.0f} users/s)")
+
+
+async def main(args):
+    db.bootstrap_database()
+    random.seed(1)
+    await run("multi-query", multi_query_add_user, args)
+    random.seed(1)
+    await run("single statement", db.add_user_if_not_exists, args, check_balance=True)
+    bulk_import(args)
+    with db.db_cursor() as cur:
+        cur.execute("DELETE FROM balance_ledger WHERE user_id >= %s", (FIRST_USER_ID,))
+        cur.execute("DELETE FROM users WHERE user_id >= %s", (FIRST_USER_ID,))
+    db.close_pool()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--referred-percent", type=float, default=30)
+    parser.add_argument("--double-every", type=int, default=10)
+    asyncio.run(main(parser.parse_args()))
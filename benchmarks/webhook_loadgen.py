@@ -0,0 +1,92 @@
+"""Replays synthetic Telegram updates against a local webhook endpoint.
+
+Point it at a bot running with BOT_MODE=webhook/shard, or at the router, and
+compare the reported updates/sec with the bot running in polling mode:
+
+    python benchmarks/webhook_loadgen.py --url http://127.0.0.1:8443/telegram \
+        --secret "$WEBHOOK_SECRET_TOKEN" --users 1000 --updates 20000 --concurrency 200
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import statistics
+import time
+
+import httpx
+
+CALLBACKS = ["main_menu", "account_menu", "email_menu", "my_email_inbox", "email_delete_confirm"]
+
+
+def make_update(update_id, user_id, kind):
+    user = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+    chat = {"id": user_id, "type": "private", "first_name": user["first_name"]}
+    if kind == "start" or (kind == "mixed" and update_id % 5 == 0):
+        return {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id, "date": int(time.time()), "chat": chat, "from": user,
+                "text": "/start", "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+            },
+        }
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id), "from": user, "chat_instance": str(user_id),
+            "data": random.choice(CALLBACKS),
+            "message": {"message_id": 1, "date": int(time.time()), "chat": chat, "text": "menu"},
+        },
+    }
+
+
+async def run(args):
+    headers = {"Content-Type": "application/json"}
+    if args.secret:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = args.secret
+    update_ids = itertools.count(1)
+    latencies = []
+    failures = 0
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+
+    async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+        async def worker():
+            nonlocal failures
+            while True:
+                update_id = next(update_ids)
+                if update_id > args.updates:
+                    return
+                body = json.dumps(make_update(update_id, random.randint(1, args.users), args.kind))
+                started = time.perf_counter()
+                try:
+                    response = await client.post(args.url, content=body, headers=headers)
+                    response.raise_for_status()
+                    latencies.append(time.perf_counter() - started)
+                except httpx.HTTPError:
+                    failures += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print(f"updates: {args.updates}  failed: {failures}  elapsed: {elapsed:.2f}s")
+    print(f"throughput: {len(latencies) / elapsed:.0f} updates/sec")
+    if latencies:
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        print(f"ack latency p50: {statistics.median(latencies) * 1000:.1f}ms  p99: {p99 * 1000:.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://127.0.0.1:8443/telegram")
+    parser.add_argument("--secret", default=None)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--updates", type=int, default=10000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--kind", choices=["start", "callback", "mixed"], default="mixed")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,56 @@
 # database.py
 import os
+import asyncio
+import csv
+import datetime
+import functools
+import io
+import json
+import select
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import psycopg2
-from psycopg2.extras import DictCursor
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from psycopg2.extras import DictCursor, Json, execute_values
+from psycopg2.pool import ThreadedConnectionPool
 import uuid
 import logging
 
+# --- Pool Configuration ---
+# psycopg2 pools raise PoolError instead of blocking when they run dry, so the
+# executor that runs queries never has more threads than the pool has connections.
+DB_POOL_MIN_CONN = int(os.environ.get('DB_POOL_MIN_CONN', 1))
+DB_POOL_MAX_CONN = int(os.environ.get('DB_POOL_MAX_CONN', 10))
+
+_pool = None
+_pool_lock = threading.Lock()
+_db_executor = ThreadPoolExecutor(max_workers=DB_POOL_MAX_CONN, thread_name_prefix="db")
+
+# --- Settings Cache Configuration ---
+SETTINGS_CACHE_TTL_SECONDS = float(os.environ.get('SETTINGS_CACHE_TTL_SECONDS', 300))
+SETTINGS_CHANNEL = 'settings_changed'
+
+# --- Schema Configuration ---
+MIGRATION_LOCK_ID = 4942001  # pg_advisory_xact_lock key serializing migrations across workers
+ACTIVITY_LOG_PARTITION_MONTHS_AHEAD = int(os.environ.get('ACTIVITY_LOG_PARTITION_MONTHS_AHEAD', 2))
+
+# --- Activity Log Writer Configuration ---
+ACTIVITY_LOG_FLUSH_ROWS = int(os.environ.get('ACTIVITY_LOG_FLUSH_ROWS', 500))
+ACTIVITY_LOG_FLUSH_SECONDS = float(os.environ.get('ACTIVITY_LOG_FLUSH_SECONDS', 1))
+ACTIVITY_LOG_MAX_BUFFERED = int(os.environ.get('ACTIVITY_LOG_MAX_BUFFERED', 20000))
+
+# --- Session Store Configuration ---
+# SESSION_BACKEND is 'postgres' (shared by every worker) or 'sqlite' (single-node setups).
+SESSION_BACKEND = os.environ.get('SESSION_BACKEND', 'postgres')
+SESSION_SQLITE_PATH = os.environ.get('SESSION_SQLITE_PATH', 'sessions.sqlite3')
+SESSION_CACHE_MAX_ENTRIES = int(os.environ.get('SESSION_CACHE_MAX_ENTRIES', 10000))
+SESSION_CACHE_TTL_SECONDS = float(os.environ.get('SESSION_CACHE_TTL_SECONDS', 60))
+SESSION_TTL_SECONDS = int(os.environ.get('SESSION_TTL_SECONDS', 24 * 60 * 60))
+
 # --- Database Connection ---
 def get_db_connection():
     """Establishes a connection to the PostgreSQL database."""
@@ -15,113 +61,1257 @@ def get_db_connection():
         logging.error(f"Could not connect to the database: {e}")
         raise
 
-# --- Database Setup ---
+def get_pool():
+    """Returns the shared connection pool, creating it on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                try:
+                    _pool = ThreadedConnectionPool(DB_POOL_MIN_CONN, DB_POOL_MAX_CONN, os.environ.get('DATABASE_URL'))
+                except psycopg2.OperationalError as e:
+                    logging.error(f"Could not create the database pool: {e}")
+                    raise
+    return _pool
+
+def close_pool():
+    """Closes every pooled connection and stops the query threads."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+    _db_executor.shutdown(wait=False)
+
+@contextmanager
+def db_cursor(cursor_factory=None):
+    """Borrows a pooled connection and yields a cursor, committing on success."""
+    pool = get_pool()
+    conn = pool.getconn()
+    try:
+        with conn.cursor(cursor_factory=cursor_factory) as cur:
+            yield cur
+        conn.commit()
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        # Broken connections are dropped so the pool reconnects on the next checkout.
+        pool.putconn(conn, close=bool(conn.closed))
+
+# Called as query_observer(helper name, seconds) after every awaited query helper; the bot records these
+query_observer = None
+
+def run_in_db_executor(func):
+    """Turns a blocking query helper into a coroutine that runs on the DB threads."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(_db_executor, functools.partial(func, *args, **kwargs))
+        finally:
+            if query_observer is not None:
+                query_observer(func.__qualname__, time.perf_counter() - started)
+    return wrapper
+
+# --- Database Setup (versioned migrations) ---
+def _add_months(month, count):
+    total = month.year * 12 + month.month - 1 + count
+    return datetime.date(total // 12, total % 12 + 1, 1)
+
+def ensure_activity_log_partitions(cur, since=None):
+    """Creates monthly activity_log partitions from `since` (default: this month) through the months ahead.
+
+    Takes the migration advisory lock for the rest of the caller's transaction:
+    concurrent CREATE TABLE IF NOT EXISTS ... PARTITION OF for the same month can
+    fail with a duplicate key error when several workers start at once.
+    """
+    cur.execute("SELECT pg_advisory_xact_lock(%s);", (MIGRATION_LOCK_ID,))
+    this_month = datetime.datetime.now(datetime.timezone.utc).date().replace(day=1)
+    month = since.date().replace(day=1) if since else this_month
+    last = _add_months(this_month, ACTIVITY_LOG_PARTITION_MONTHS_AHEAD)
+    while month <= last:
+        next_month = _add_months(month, 1)
+        cur.execute(
+            f"CREATE TABLE IF NOT EXISTS activity_log_{month:%Y_%m} PARTITION OF activity_log "
+            "FOR VALUES FROM (%s) TO (%s);",
+            (f"{month} 00:00+00", f"{next_month} 00:00+00")
+        )
+        month = next_month
+
+def _baseline_schema(cur):
+    # Users table to store user info, balance, referral data, and premium status
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            first_name TEXT,
+            balance REAL DEFAULT 10.0,
+            referral_code TEXT UNIQUE,
+            referred_by BIGINT DEFAULT NULL,
+            is_premium BOOLEAN DEFAULT FALSE,
+            premium_expiry TIMESTAMPTZ DEFAULT NULL
+        );
+    ''')
+    # Staff table for moderators
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS staff (
+            user_id BIGINT PRIMARY KEY,
+            role TEXT NOT NULL,
+            referral_link TEXT UNIQUE,
+            commission_balance REAL DEFAULT 0.0
+        );
+    ''')
+    # Activity log for tracking staff actions
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS activity_log (
+            id SERIAL PRIMARY KEY,
+            staff_id BIGINT,
+            action TEXT,
+            target_user_id BIGINT,
+            details TEXT,
+            timestamp TIMESTAMPTZ DEFAULT NOW()
+        );
+    ''')
+    # Settings table for prices and other configurations
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    ''')
+    # Ledger of every balance change, written in the same statement as the change
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS balance_ledger (
+            id BIGSERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            amount REAL NOT NULL,
+            reason TEXT,
+            balance_after REAL,
+            created_at TIMESTAMPTZ DEFAULT NOW()
+        );
+    ''')
+    # Per-user session data such as the active temporary email
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS user_sessions (
+            user_id BIGINT PRIMARY KEY,
+            data JSONB NOT NULL,
+            expires_at TIMESTAMPTZ NOT NULL
+        );
+    ''')
+    # Ad prompts whose proceed button has not been revealed yet (survives restarts)
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS pending_ad_reveals (
+            chat_id BIGINT,
+            message_id BIGINT,
+            user_id BIGINT,
+            action TEXT NOT NULL,
+            ad_url TEXT,
+            due_at TIMESTAMPTZ NOT NULL,
+            PRIMARY KEY (chat_id, message_id)
+        );
+    ''')
+    # Insert default prices and settings if they don't exist
+    defaults = {
+        'price_email_ad': '0.0',
+        'price_email_credit': '1.0',
+        'price_number_other': '15.0',
+        'price_number_facebook': '30.0',
+        'price_number_google': '50.0',
+        'referral_bonus': '5.0',
+        'signup_bonus': '10.0'
+    }
+    for key, value in defaults.items():
+        cur.execute("INSERT INTO settings (key, value) VALUES (%s, %s) ON CONFLICT (key) DO NOTHING;", (key, value))
+    # Notify every bot worker when settings change so their caches reload right away
+    cur.execute(f'''
+        CREATE OR REPLACE FUNCTION notify_settings_changed() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('{SETTINGS_CHANNEL}', '');
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    ''')
+    cur.execute("DROP TRIGGER IF EXISTS settings_changed ON settings;")
+    cur.execute('''
+        CREATE TRIGGER settings_changed AFTER INSERT OR UPDATE OR DELETE ON settings
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_settings_changed();
+    ''')
+
+def _index_referred_by(cur):
+    cur.execute("CREATE INDEX IF NOT EXISTS users_referred_by_idx ON users (referred_by) WHERE referred_by IS NOT NULL;")
+
+def _numeric_money(cur):
+    # Money is stored as exact decimals instead of REAL
+    cur.execute('''
+        ALTER TABLE users
+            ALTER COLUMN balance TYPE NUMERIC(14, 2),
+            ALTER COLUMN balance SET DEFAULT 10.0;
+        ALTER TABLE staff
+            ALTER COLUMN commission_balance TYPE NUMERIC(14, 2),
+            ALTER COLUMN commission_balance SET DEFAULT 0.0;
+        ALTER TABLE balance_ledger
+            ALTER COLUMN amount TYPE NUMERIC(14, 2),
+            ALTER COLUMN balance_after TYPE NUMERIC(14, 2);
+    ''')
+
+def _partition_activity_log(cur):
+    # Staff audit queries scan one month at a time, so the log is range-partitioned by month
+    cur.execute('''
+        ALTER TABLE activity_log RENAME TO activity_log_legacy;
+        ALTER INDEX activity_log_pkey RENAME TO activity_log_legacy_pkey;
+        ALTER SEQUENCE activity_log_id_seq RENAME TO activity_log_legacy_id_seq;
+        CREATE TABLE activity_log (
+            id BIGSERIAL,
+            staff_id BIGINT,
+            action TEXT,
+            target_user_id BIGINT,
+            details TEXT,
+            timestamp TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (id, timestamp)
+        ) PARTITION BY RANGE (timestamp);
+        CREATE TABLE activity_log_default PARTITION OF activity_log DEFAULT;
+        CREATE INDEX activity_log_staff_time_idx ON activity_log (staff_id, timestamp);
+        CREATE INDEX activity_log_target_user_idx ON activity_log (target_user_id);
+    ''')
+    cur.execute("SELECT min(timestamp) FROM activity_log_legacy;")
+    ensure_activity_log_partitions(cur, since=cur.fetchone()[0])
+    cur.execute('''
+        INSERT INTO activity_log (id, staff_id, action, target_user_id, details, timestamp)
+        SELECT id, staff_id, action, target_user_id, details, COALESCE(timestamp, NOW()) FROM activity_log_legacy;
+        SELECT setval(pg_get_serial_sequence('activity_log', 'id'), GREATEST((SELECT max(id) FROM activity_log), 1));
+        DROP TABLE activity_log_legacy;
+    ''')
+
+# Append new migrations here; applied versions are never edited.
+def _sms_activations(cur):
+    # One row per rented number. The status moves ordering -> waiting -> received / refunded
+    # exactly once, and the refund is applied in the same statement as the status change.
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS sms_activations (
+            id BIGSERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            service TEXT NOT NULL,
+            price NUMERIC(14, 2) NOT NULL,
+            status TEXT NOT NULL DEFAULT 'ordering',
+            provider_id TEXT UNIQUE,
+            phone_number TEXT,
+            code TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            expires_at TIMESTAMPTZ,
+            finished_at TIMESTAMPTZ
+        );
+        CREATE INDEX IF NOT EXISTS sms_activations_open_idx
+            ON sms_activations (created_at) WHERE status IN ('ordering', 'waiting');
+    ''')
+
+def _broadcasts(cur):
+    # Staff broadcasts: progress is checkpointed as the last user_id handled, and a worker
+    # holds a lease on a running broadcast so another one can take over if it dies.
+    cur.execute('''
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS blocked_at TIMESTAMPTZ DEFAULT NULL;
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id BIGSERIAL PRIMARY KEY,
+            created_by BIGINT NOT NULL,
+            text TEXT NOT NULL,
+            premium_only BOOLEAN NOT NULL DEFAULT FALSE,
+            status TEXT NOT NULL DEFAULT 'running',
+            last_user_id BIGINT NOT NULL DEFAULT 0,
+            sent BIGINT NOT NULL DEFAULT 0,
+            failed BIGINT NOT NULL DEFAULT 0,
+            blocked BIGINT NOT NULL DEFAULT 0,
+            claimed_by TEXT,
+            lease_until TIMESTAMPTZ,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            finished_at TIMESTAMPTZ
+        );
+        CREATE INDEX IF NOT EXISTS broadcasts_running_idx ON broadcasts (lease_until) WHERE status = 'running';
+    ''')
+
+def _premium_expiry_index(cur):
+    # Only premium rows are indexed, so the expiry sweep reads just the rows it downgrades
+    cur.execute("CREATE INDEX IF NOT EXISTS users_premium_expiry_idx ON users (premium_expiry) WHERE is_premium")
+
+MIGRATIONS = [
+    (1, 'baseline schema', _baseline_schema),
+    (2, 'index users.referred_by', _index_referred_by),
+    (3, 'numeric money columns', _numeric_money),
+    (4, 'partition activity_log by month', _partition_activity_log),
+    (5, 'sms activations', _sms_activations),
+    (6, 'broadcasts', _broadcasts),
+    (7, 'index users.premium_expiry', _premium_expiry_index),
+]
+
 def setup_database():
-    """Creates all necessary tables if they don't exist."""
+    """Brings the schema up to date by applying pending migrations in order.
+
+    Each migration runs in its own transaction under an advisory lock, so several
+    workers starting at once apply it exactly once.
+    """
     conn = get_db_connection()
-    with conn.cursor() as cur:
-        # Users table to store user info, balance, referral data, and premium status
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id BIGINT PRIMARY KEY,
-                first_name TEXT,
-                balance REAL DEFAULT 10.0,
-                referral_code TEXT UNIQUE,
-                referred_by BIGINT DEFAULT NULL,
-                is_premium BOOLEAN DEFAULT FALSE,
-                premium_expiry TIMESTAMPTZ DEFAULT NULL
-            );
-        ''')
-        # Staff table for moderators
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS staff (
-                user_id BIGINT PRIMARY KEY,
-                role TEXT NOT NULL,
-                referral_link TEXT UNIQUE,
-                commission_balance REAL DEFAULT 0.0
-            );
-        ''')
-        # Activity log for tracking staff actions
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS activity_log (
-                id SERIAL PRIMARY KEY,
-                staff_id BIGINT,
-                action TEXT,
-                target_user_id BIGINT,
-                details TEXT,
-                timestamp TIMESTAMPTZ DEFAULT NOW()
-            );
-        ''')
-        # Settings table for prices and other configurations
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS settings (
-                key TEXT PRIMARY KEY,
-                value TEXT
-            );
-        ''')
-        # Insert default prices and settings if they don't exist
-        defaults = {
-            'price_email_ad': '0.0',
-            'price_email_credit': '1.0',
-            'price_number_other': '15.0',
-            'price_number_facebook': '30.0',
-            'price_number_google': '50.0',
-            'referral_bonus': '5.0',
-            'signup_bonus': '10.0'
-        }
-        for key, value in defaults.items():
-            cur.execute("INSERT INTO settings (key, value) VALUES (%s, %s) ON CONFLICT (key) DO NOTHING;", (key, value))
+    try:
+        with conn.cursor() as cur:
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TIMESTAMPTZ DEFAULT NOW()
+                );
+            ''')
+        conn.commit()
+        for version, name, migrate in MIGRATIONS:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_xact_lock(%s);", (MIGRATION_LOCK_ID,))
+                cur.execute("SELECT 1 FROM schema_migrations WHERE version = %s;", (version,))
+                if cur.fetchone() is None:
+                    migrate(cur)
+                    cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s);", (version, name))
+                    logging.info(f"Applied migration {version}: {name}")
+            conn.commit()
+        with conn.cursor() as cur:
+            ensure_activity_log_partitions(cur)
+        conn.commit()
+    finally:
+        conn.close()
+    logging.info("Database setup checked/completed.")
+
+def current_schema_version(cur):
+    cur.execute("SELECT to_regclass('schema_migrations') IS NOT NULL;")
+    if not cur.fetchone()[0]:
+        return 0
+    cur.execute("SELECT COALESCE(max(version), 0) FROM schema_migrations;")
+    return cur.fetchone()[0]
+
+def bootstrap_database():
+    """Opens the pool and migrates the schema only if it is behind. Safe to call repeatedly.
+
+    The months-ahead activity_log partitions are checked on every call, not only
+    when migrating, so a worker that restarts more often than the daily
+    maintain_partitions job still creates them before rows need them.
+    """
+    with db_cursor() as cur:
+        version = current_schema_version(cur)
+        if version >= MIGRATIONS[-1][0]:
+            ensure_activity_log_partitions(cur)
+    if version < MIGRATIONS[-1][0]:
+        setup_database()
+
+_bootstrap_future = None
+
+def start_bootstrap():
+    """Runs bootstrap_database once on a DB thread and returns its future.
+
+    Calling this before the Telegram handshake lets the two overlap; await the
+    result with asyncio.wrap_future before handling updates.
+    """
+    global _bootstrap_future
+    if _bootstrap_future is None:
+        _bootstrap_future = _db_executor.submit(bootstrap_database)
+    return _bootstrap_future
+
+@run_in_db_executor
+def maintain_activity_log_partitions():
+    """Keeps ACTIVITY_LOG_PARTITION_MONTHS_AHEAD months of activity_log partitions in place."""
+    with db_cursor() as cur:
+        ensure_activity_log_partitions(cur)
+
+# --- Settings Cache ---
+class SettingsCache:
+    """In-memory copy of the settings table, reloaded with a single query once it expires."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self._values = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+
+    def _is_expired(self):
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl
+
+    def _value(self, key):
+        value = self._values.get(key)
+        # Return a default value of 0.0 if not found, to prevent errors
+        return float(value) if value is not None else 0.0
 
-    conn.commit()
-    conn.close()
-    print("Database setup checked/completed.")
+    def get(self, key, load=True, cur=None):
+        """Returns a setting as a float; with load=False a stale cache returns None instead of querying."""
+        with self._lock:
+            if not self._is_expired():
+                self.hits += 1
+                return self._value(key)
+            if not load:
+                return None
+            self.misses += 1
+        with self._reload_lock:
+            # Another thread may have reloaded the table while we were waiting.
+            if self._is_expired():
+                self._reload(cur)
+        with self._lock:
+            return self._value(key)
+
+    def _reload(self, cur=None):
+        if cur is None:
+            with db_cursor() as own_cur:
+                return self._reload(own_cur)
+        cur.execute("SELECT key, value FROM settings")
+        values = dict(cur.fetchall())
+        with self._lock:
+            self._values = values
+            self._loaded_at = time.monotonic()
+            self.reloads += 1
+        start_settings_listener()
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'reloads': self.reloads}
+
+settings_cache = SettingsCache(SETTINGS_CACHE_TTL_SECONDS)
+_listener_started = False
+_listener_lock = threading.Lock()
+
+def start_settings_listener():
+    """Starts the background thread that invalidates the cache on settings NOTIFY events."""
+    global _listener_started
+    with _listener_lock:
+        if _listener_started:
+            return
+        _listener_started = True
+    threading.Thread(target=_listen_for_settings_changes, name="settings-listener", daemon=True).start()
+
+def _listen_for_settings_changes():
+    while True:
+        conn = None
+        try:
+            conn = get_db_connection()
+            conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cur:
+                cur.execute(f"LISTEN {SETTINGS_CHANNEL};")
+            # Anything may have changed while we were not listening.
+            settings_cache.invalidate()
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                if conn.notifies:
+                    conn.notifies.clear()
+                    settings_cache.invalidate()
+        except psycopg2.Error as e:
+            logging.warning(f"Settings listener lost its connection, falling back to TTL expiry: {e}")
+        finally:
+            if conn is not None:
+                conn.close()
+        time.sleep(5)
 
 # --- Helper Functions ---
-# (These will be used by the bot logic files)
+# (These will be used by the bot logic files. Each one is awaitable and runs on the DB threads.)
+
+@run_in_db_executor
 def get_user(user_id):
-    conn = get_db_connection()
-    with conn.cursor(cursor_factory=DictCursor) as cur:
+    with db_cursor(DictCursor) as cur:
         cur.execute("SELECT * FROM users WHERE user_id = %s", (user_id,))
-        user = cur.fetchone()
-    conn.close()
-    return user
+        return cur.fetchone()
 
-def get_setting(key):
-    conn = get_db_connection()
-    with conn.cursor() as cur:
-        cur.execute("SELECT value FROM settings WHERE key = %s", (key,))
-        result = cur.fetchone()
-    conn.close()
-    # Return a default value of 0.0 if not found, to prevent errors
-    return float(result[0]) if result else 0.0
+@run_in_db_executor
+def get_premium_status(user_id):
+    """Returns (is_premium, premium_expiry) for a user, or None if they are not registered."""
+    with db_cursor() as cur:
+        cur.execute("SELECT is_premium, premium_expiry FROM users WHERE user_id = %s", (user_id,))
+        return cur.fetchone()
+
+@run_in_db_executor
+def expire_premium(batch_size):
+    """Downgrades up to batch_size users whose premium has expired and logs each one, in one statement.
 
+    Rows locked by another worker's sweep are skipped. Returns the downgraded user_ids.
+    """
+    with db_cursor() as cur:
+        cur.execute(
+            """
+            WITH expired AS (
+                SELECT user_id FROM users
+                WHERE is_premium AND premium_expiry <= NOW()
+                ORDER BY premium_expiry
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            ), downgraded AS (
+                UPDATE users SET is_premium = FALSE
+                FROM expired WHERE users.user_id = expired.user_id
+                RETURNING users.user_id
+            ), logged AS (
+                INSERT INTO activity_log (action, target_user_id)
+                SELECT 'premium_expired', user_id FROM downgraded
+            )
+            SELECT user_id FROM downgraded
+            """,
+            (batch_size,)
+        )
+        return [row[0] for row in cur.fetchall()]
+
+_load_setting = run_in_db_executor(settings_cache.get)
+
+async def get_setting(key):
+    """Returns a setting as a float, answering from the settings cache without a thread hop when it is fresh."""
+    value = settings_cache.get(key, load=False)
+    if value is None:
+        value = await _load_setting(key)
+    return value
+
+@run_in_db_executor
 def add_user_if_not_exists(user_id, first_name, referral_code=None):
-    conn = get_db_connection()
-    with conn.cursor(cursor_factory=DictCursor) as cur:
-        cur.execute("SELECT * FROM users WHERE user_id = %s", (user_id,))
-        user = cur.fetchone()
-        if not user:
-            new_referral_code = str(uuid.uuid4())[:8]
-            signup_bonus = get_setting('signup_bonus')
-
-            referred_by_id = None
-            if referral_code:
-                cur.execute("SELECT user_id FROM users WHERE referral_code = %s", (referral_code,))
-                referrer = cur.fetchone()
-                if referrer:
-                    referred_by_id = referrer['user_id']
-                    referral_bonus = get_setting('referral_bonus')
-                    cur.execute("UPDATE users SET balance = balance + %s WHERE user_id = %s", (referral_bonus, referred_by_id))
+    """Registers a new user and credits their referrer in a single statement.
+
+    Bonuses come from the settings cache. ON CONFLICT makes a repeated /start a no-op,
+    so the referrer is credited at most once. Returns the user's balance, whether the
+    row was just created or already existed, so /start needs no second query, or
+    None if the user cannot be found.
+    """
+    with db_cursor() as cur:
+        params = {
+            'user_id': user_id,
+            'first_name': first_name,
+            'referral_code': referral_code,
+            'new_referral_code': str(uuid.uuid4())[:8],
+            'signup_bonus': settings_cache.get('signup_bonus', cur=cur),
+            'referral_bonus': settings_cache.get('referral_bonus', cur=cur),
+        }
+        cur.execute(
+            """
+            WITH inserted AS (
+                INSERT INTO users (user_id, first_name, balance, referral_code, referred_by)
+                VALUES (
+                    %(user_id)s, %(first_name)s, %(signup_bonus)s, %(new_referral_code)s,
+                    (SELECT user_id FROM users WHERE referral_code = %(referral_code)s AND user_id <> %(user_id)s)
+                )
+                ON CONFLICT (user_id) DO NOTHING
+                RETURNING user_id, referred_by, balance
+            ), credited AS (
+                UPDATE users SET balance = balance + %(referral_bonus)s::numeric
+                WHERE user_id = (SELECT referred_by FROM inserted)
+                RETURNING user_id, balance
+            ), ledger AS (
+                INSERT INTO balance_ledger (user_id, amount, reason, balance_after)
+                SELECT user_id, %(signup_bonus)s, 'signup_bonus', balance FROM inserted
+                UNION ALL
+                SELECT user_id, %(referral_bonus)s, 'referral_bonus', balance FROM credited
+            ), unblocked AS (
+                -- A user who blocked the bot and came back gets broadcasts again
+                UPDATE users SET blocked_at = NULL
+                WHERE user_id = %(user_id)s AND blocked_at IS NOT NULL AND NOT EXISTS (SELECT 1 FROM inserted)
+            )
+            SELECT balance FROM inserted
+            UNION ALL
+            SELECT balance FROM users WHERE user_id = %(user_id)s AND NOT EXISTS (SELECT 1 FROM inserted)
+            """,
+            params
+        )
+        row = cur.fetchone()
+        if row is None:
+            # A concurrent /start inserted the user while this INSERT waited on it, after this
+            # statement's snapshot was taken; a new statement sees the committed row
+            cur.execute("SELECT balance FROM users WHERE user_id = %s", (user_id,))
+            row = cur.fetchone()
+        return float(row[0]) if row else None
+
+def bulk_import_users(rows, page_size=1000):
+    """Inserts users from an existing dump, skipping ones that already exist.
+
+    rows is an iterable of dicts with user_id and optionally first_name, balance,
+    referral_code, referred_by, is_premium and premium_expiry. It is consumed in
+    pages, one transaction per page, so arbitrarily large dumps use constant memory.
+    Returns the number of users inserted.
+    """
+    columns = ('user_id', 'first_name', 'balance', 'referral_code', 'referred_by', 'is_premium', 'premium_expiry')
+    signup_bonus = settings_cache.get('signup_bonus')
+    inserted = 0
+    page = []
+
+    def flush():
+        nonlocal inserted
+        with db_cursor() as cur:
+            result = execute_values(
+                cur,
+                f"INSERT INTO users ({', '.join(columns)}) VALUES %s ON CONFLICT DO NOTHING RETURNING user_id",
+                page, page_size=page_size, fetch=True
+            )
+        inserted += len(result)
+        page.clear()
+
+    for row in rows:
+        page.append((
+            int(row['user_id']),
+            row.get('first_name'),
+            float(row['balance']) if row.get('balance') not in (None, '') else signup_bonus,
+            row.get('referral_code') or str(uuid.uuid4())[:8],
+            int(row['referred_by']) if row.get('referred_by') not in (None, '') else None,
+            str(row.get('is_premium', '')).lower() in ('1', 't', 'true'),
+            row.get('premium_expiry') or None,
+        ))
+        if len(page) >= page_size:
+            flush()
+    if page:
+        flush()
+    return inserted
+
+def import_users_from_csv(path):
+    """Bulk-imports users from a CSV file with a header row naming the users columns."""
+    with open(path, newline='', encoding='utf-8') as f:
+        return bulk_import_users(csv.DictReader(f))
+
+@run_in_db_executor
+def debit_balance(user_id, amount, reason):
+    """Deducts amount only if the balance covers it, and records it in the ledger, in one statement.
+
+    Returns the new balance, or None if the user does not exist or cannot afford it.
+    """
+    with db_cursor() as cur:
+        cur.execute(
+            """
+            WITH debited AS (
+                UPDATE users SET balance = balance - %(amount)s::numeric
+                WHERE user_id = %(user_id)s AND balance >= %(amount)s::numeric
+                RETURNING user_id, balance
+            ), ledger AS (
+                INSERT INTO balance_ledger (user_id, amount, reason, balance_after)
+                SELECT user_id, -%(amount)s::numeric, %(reason)s, balance FROM debited
+            )
+            SELECT balance FROM debited
+            """,
+            {'user_id': user_id, 'amount': amount, 'reason': reason}
+        )
+        row = cur.fetchone()
+    return row[0] if row else None
+
+@run_in_db_executor
+def credit_balance(user_id, amount, reason):
+    """Adds amount to the balance and records it in the ledger, in one statement.
+
+    Returns the new balance, or None if the user does not exist.
+    """
+    with db_cursor() as cur:
+        cur.execute(
+            """
+            WITH credited AS (
+                UPDATE users SET balance = balance + %(amount)s::numeric
+                WHERE user_id = %(user_id)s
+                RETURNING user_id, balance
+            ), ledger AS (
+                INSERT INTO balance_ledger (user_id, amount, reason, balance_after)
+                SELECT user_id, %(amount)s::numeric, %(reason)s, balance FROM credited
+            )
+            SELECT balance FROM credited
+            """,
+            {'user_id': user_id, 'amount': amount, 'reason': reason}
+        )
+        row = cur.fetchone()
+    return row[0] if row else None
+
+# --- SMS Activations ---
+@run_in_db_executor
+def order_activation(user_id, service, price):
+    """Charges the user and opens an activation in one statement, before the number is requested.
+
+    Returns (activation id, new balance), or None if the user cannot afford it.
+    """
+    with db_cursor() as cur:
+        cur.execute(
+            """
+            WITH debited AS (
+                UPDATE users SET balance = balance - %(price)s::numeric
+                WHERE user_id = %(user_id)s AND balance >= %(price)s::numeric
+                RETURNING user_id, balance
+            ), ledger AS (
+                INSERT INTO balance_ledger (user_id, amount, reason, balance_after)
+                SELECT user_id, -%(price)s::numeric, 'sms_number', balance FROM debited
+            ), opened AS (
+                INSERT INTO sms_activations (user_id, service, price)
+                SELECT user_id, %(service)s, %(price)s FROM debited
+                RETURNING id
+            )
+            SELECT opened.id, debited.balance FROM opened, debited
+            """,
+            {'user_id': user_id, 'service': service, 'price': price}
+        )
+        row = cur.fetchone()
+    return (row[0], row[1]) if row else None
+
+@run_in_db_executor
+def start_activation(activation_id, provider_id, phone_number, expires_at):
+    """Records the number the provider handed out; expires_at is a Unix timestamp."""
+    with db_cursor() as cur:
+        cur.execute(
+            """
+            UPDATE sms_activations
+            SET status = 'waiting', provider_id = %s, phone_number = %s, expires_at = to_timestamp(%s)
+            WHERE id = %s AND status = 'ordering'
+            """,
+            (provider_id, phone_number, expires_at, activation_id)
+        )
+        return cur.rowcount == 1
+
+@run_in_db_executor
+def complete_activation(activation_id, code):
+    """Stores the received code. Returns False if the activation was already closed."""
+    with db_cursor() as cur:
+        cur.execute(
+            "UPDATE sms_activations SET status = 'received', code = %s, finished_at = NOW() "
+            "WHERE id = %s AND status = 'waiting'",
+            (code, activation_id)
+        )
+        return cur.rowcount == 1
+
+@run_in_db_executor
+def refund_activation(activation_id, reason):
+    """Closes an open activation and credits its price back, in one statement.
+
+    Only the first call for an activation refunds anything. Returns (user_id, new
+    balance), or None if it was already closed.
+    """
+    with db_cursor() as cur:
+        cur.execute(
+            """
+            WITH closed AS (
+                UPDATE sms_activations SET status = 'refunded', finished_at = NOW()
+                WHERE id = %(id)s AND status IN ('ordering', 'waiting')
+                RETURNING user_id, price
+            ), credited AS (
+                UPDATE users SET balance = users.balance + closed.price
+                FROM closed WHERE users.user_id = closed.user_id
+                RETURNING users.user_id, users.balance, closed.price
+            ), ledger AS (
+                INSERT INTO balance_ledger (user_id, amount, reason, balance_after)
+                SELECT user_id, price, %(reason)s, balance FROM credited
+            )
+            SELECT user_id, balance FROM credited
+            """,
+            {'id': activation_id, 'reason': reason}
+        )
+        row = cur.fetchone()
+    return (row[0], row[1]) if row else None
+
+@run_in_db_executor
+def load_open_activations(shard_count=1, shard_index=0):
+    """Returns the open activations of users with user_id % shard_count == shard_index.
+
+    created_at and expires_at are Unix timestamps.
+    """
+    with db_cursor(DictCursor) as cur:
+        cur.execute(
+            "SELECT id, user_id, service, status, provider_id, phone_number, "
+            "EXTRACT(EPOCH FROM created_at) AS created_at, EXTRACT(EPOCH FROM expires_at) AS expires_at "
+            "FROM sms_activations WHERE status IN ('ordering', 'waiting') AND mod(user_id, %s) = %s ORDER BY created_at",
+            (shard_count, shard_index)
+        )
+        return cur.fetchall()
+
+# --- Broadcasts ---
+@run_in_db_executor
+def get_staff_role(user_id):
+    """Returns the user's staff role, or None if they are not staff."""
+    with db_cursor() as cur:
+        cur.execute("SELECT role FROM staff WHERE user_id = %s", (user_id,))
+        row = cur.fetchone()
+    return row[0] if row else None
+
+_BROADCAST_COLUMNS = "id, created_by, text, premium_only, last_user_id, sent, failed, blocked"
+
+@run_in_db_executor
+def create_broadcast(staff_id, text, premium_only, worker, lease_seconds):
+    """Records a new broadcast, already leased to `worker`, and logs the staff action in one statement.
+
+    Returns the broadcast row.
+    """
+    with db_cursor(DictCursor) as cur:
+        cur.execute(
+            f"""
+            WITH created AS (
+                INSERT INTO broadcasts (created_by, text, premium_only, claimed_by, lease_until)
+                VALUES (%(staff_id)s, %(text)s, %(premium_only)s, %(worker)s, NOW() + make_interval(secs => %(lease)s))
+                RETURNING {_BROADCAST_COLUMNS}
+            ), logged AS (
+                INSERT INTO activity_log (staff_id, action, details)
+                SELECT created_by, 'broadcast', 'broadcast ' || id FROM created
+            )
+            SELECT * FROM created
+            """,
+            {'staff_id': staff_id, 'text': text, 'premium_only': premium_only, 'worker': worker, 'lease': lease_seconds}
+        )
+        return cur.fetchone()
+
+@run_in_db_executor
+def claim_broadcasts(worker, lease_seconds):
+    """Leases every running broadcast whose previous worker stopped renewing its lease.
+
+    Returns their rows. Workers claiming at the same time never get the same broadcast.
+    """
+    with db_cursor(DictCursor) as cur:
+        cur.execute(
+            f"""
+            UPDATE broadcasts SET claimed_by = %s, lease_until = NOW() + make_interval(secs => %s)
+            WHERE status = 'running' AND (lease_until IS NULL OR lease_until < NOW())
+            RETURNING {_BROADCAST_COLUMNS}
+            """,
+            (worker, lease_seconds)
+        )
+        return cur.fetchall()
+
+@run_in_db_executor
+def checkpoint_broadcast(broadcast_id, worker, last_user_id, sent, failed, blocked, blocked_user_ids, lease_seconds):
+    """Saves a broadcast's progress, marks users who blocked the bot and renews the lease, in one transaction.
+
+    Returns the broadcast's status, or None if another worker has taken it over.
+    """
+    with db_cursor() as cur:
+        if blocked_user_ids:
+            cur.execute(
+                "UPDATE users SET blocked_at = NOW() WHERE user_id = ANY(%s) AND blocked_at IS NULL",
+                (list(blocked_user_ids),)
+            )
+        cur.execute(
+            """
+            UPDATE broadcasts
+            SET last_user_id = %s, sent = %s, failed = %s, blocked = %s,
+                lease_until = CASE WHEN %s > 0 THEN NOW() + make_interval(secs => %s) END
+            WHERE id = %s AND claimed_by = %s
+            RETURNING status
+            """,
+            (last_user_id, sent, failed, blocked, lease_seconds, lease_seconds, broadcast_id, worker)
+        )
+        row = cur.fetchone()
+    return row[0] if row else None
+
+@run_in_db_executor
+def finish_broadcast(broadcast_id, status='done'):
+    with db_cursor() as cur:
+        cur.execute(
+            "UPDATE broadcasts SET status = %s, finished_at = NOW(), lease_until = NULL WHERE id = %s AND status = 'running'",
+            (status, broadcast_id)
+        )
+        return cur.rowcount == 1
+
+class BroadcastRecipients:
+    """A broadcast's recipients in user_id order, read through a server-side cursor.
+
+    Only `batch_size` ids are in memory at a time. The cursor has its own
+    connection instead of a pooled one, and is reopened after every `window`
+    rows, so no transaction stays open for the whole broadcast. Users who blocked
+    the bot are skipped.
+    """
+
+    def __init__(self, after_user_id, premium_only, batch_size, window):
+        self.last_user_id = after_user_id
+        self.premium_only = premium_only
+        self.batch_size = batch_size
+        self.window = window
+        self._conn = None
+        self._cur = None
+        self._left = 0
+        self._opened = 0
+
+    def _open(self):
+        if self._conn is None:
+            self._conn = get_db_connection()
+        self._opened += 1
+        self._cur = self._conn.cursor(name=f"broadcast_recipients_{self._opened}")
+        self._cur.itersize = self.batch_size
+        self._cur.execute(
+            "SELECT user_id FROM users WHERE user_id > %s AND blocked_at IS NULL AND (is_premium OR NOT %s) "
+            "ORDER BY user_id LIMIT %s",
+            (self.last_user_id, self.premium_only, self.window)
+        )
+        self._left = self.window
+
+    @run_in_db_executor
+    def next_batch(self):
+        """Returns the next user ids, or an empty list once every recipient has been read."""
+        while True:
+            if self._cur is None:
+                self._open()
+            rows = self._cur.fetchmany(self.batch_size)
+            if rows:
+                self._left -= len(rows)
+                self.last_user_id = rows[-1][0]
+                return [row[0] for row in rows]
+            finished = self._left > 0  # The window was not full, so there are no more rows
+            self._cur.close()
+            self._cur = None
+            self._conn.commit()
+            if finished:
+                return []
+
+    @run_in_db_executor
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+            self._cur = None
+
+# --- Activity Log ---
+_ACTIVITY_LOG_COPY = "COPY activity_log (staff_id, action, target_user_id, details, timestamp) FROM STDIN"
+
+def _copy_field(value):
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+@run_in_db_executor
+def copy_activity_rows(rows):
+    """Writes (staff_id, action, target_user_id, details, timestamp) rows to activity_log with one COPY."""
+    data = io.StringIO()
+    for row in rows:
+        data.write('\t'.join(map(_copy_field, row)))
+        data.write('\n')
+    data.seek(0)
+    with db_cursor() as cur:
+        cur.copy_expert(_ACTIVITY_LOG_COPY, data)
+
+class ActivityLogWriter:
+    """Buffers activity_log rows in memory and writes them in batches with COPY.
+
+    A batch goes out once `flush_rows` rows are waiting, or `flush_seconds` after
+    the first row of a batch was logged. Each row keeps the time it was logged.
+    At most `max_rows` rows are held; when the buffer is full, log() waits for
+    one flush, and drops its row if that flush failed. A failed batch is put back for the next flush if it still
+    fits, and dropped otherwise. Call close() on shutdown to write what is left.
+    """
+
+    def __init__(self, flush_rows, flush_seconds, max_rows):
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.max_rows = max_rows
+        self._rows = []
+        self._flushing = None
+        self._timer = None
+        self.written = 0
+        self.flushes = 0
+        self.dropped = 0
+        self.waits = 0
+
+    async def log(self, action, target_user_id=None, staff_id=None, details=None):
+        while len(self._rows) >= self.max_rows:
+            self.waits += 1
+            if not await asyncio.shield(self._start_flush()):
+                self.dropped += 1  # The database is failing; do not hold the caller up any longer
+                return
+        self._rows.append((staff_id, action, target_user_id, details, datetime.datetime.now(datetime.timezone.utc)))
+        if len(self._rows) >= self.flush_rows:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.flush_seconds, self._start_flush)
+
+    def _start_flush(self):
+        if self._flushing is None or self._flushing.done():
+            self._flushing = asyncio.create_task(self._flush())
+        return self._flushing
+
+    async def _flush(self):
+        """Writes the buffered rows; returns False if a batch could not be written."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        ok = True
+        while self._rows:
+            rows, self._rows = self._rows, []
+            try:
+                await copy_activity_rows(rows)
+            except Exception as e:
+                if len(rows) + len(self._rows) <= self.max_rows:
+                    self._rows[:0] = rows
+                    logging.warning(f"Could not write {len(rows)} activity_log rows, retrying: {e}")
+                else:
+                    self.dropped += len(rows)
+                    logging.error(f"Dropped {len(rows)} activity_log rows: {e}")
+                ok = False
+                break
+            self.written += len(rows)
+            self.flushes += 1
+            if len(self._rows) < self.flush_rows:
+                break
+        if self._rows and self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.flush_seconds, self._start_flush)
+        return ok
+
+    async def close(self):
+        """Writes every buffered row; rows that still cannot be written are dropped."""
+        if self._flushing is not None:
+            await self._flushing
+        if self._rows:
+            await self._flush()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self.dropped += len(self._rows)
+        self._rows = []
+
+    def stats(self):
+        return {
+            'buffered': len(self._rows), 'written': self.written, 'flushes': self.flushes,
+            'dropped': self.dropped, 'waits': self.waits,
+        }
+
+activity_log = ActivityLogWriter(ACTIVITY_LOG_FLUSH_ROWS, ACTIVITY_LOG_FLUSH_SECONDS, ACTIVITY_LOG_MAX_BUFFERED)
+
+# --- Pending Ad Reveals ---
+@run_in_db_executor
+def save_ad_reveal(chat_id, message_id, user_id, action, ad_url, due_at):
+    with db_cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO pending_ad_reveals (chat_id, message_id, user_id, action, ad_url, due_at)
+            VALUES (%s, %s, %s, %s, %s, to_timestamp(%s))
+            ON CONFLICT (chat_id, message_id) DO UPDATE
+            SET user_id = EXCLUDED.user_id, action = EXCLUDED.action, ad_url = EXCLUDED.ad_url, due_at = EXCLUDED.due_at
+            """,
+            (chat_id, message_id, user_id, action, ad_url, due_at)
+        )
+
+@run_in_db_executor
+def delete_ad_reveals(keys):
+    """Deletes a batch of (chat_id, message_id) reveals in one round trip."""
+    chat_ids = [chat_id for chat_id, _ in keys]
+    message_ids = [message_id for _, message_id in keys]
+    with db_cursor() as cur:
+        cur.execute(
+            """
+            DELETE FROM pending_ad_reveals p
+            USING unnest(%s::bigint[], %s::bigint[]) AS d(chat_id, message_id)
+            WHERE p.chat_id = d.chat_id AND p.message_id = d.message_id
+            """,
+            (chat_ids, message_ids)
+        )
+
+@run_in_db_executor
+def load_ad_reveals(shard_count=1, shard_index=0):
+    """Returns the pending reveals of users with user_id % shard_count == shard_index.
+
+    They are ordered by due time, with due_at as a Unix timestamp.
+    """
+    with db_cursor(DictCursor) as cur:
+        cur.execute(
+            "SELECT chat_id, message_id, user_id, action, ad_url, EXTRACT(EPOCH FROM due_at) AS due_at "
+            "FROM pending_ad_reveals WHERE mod(user_id, %s) = %s ORDER BY due_at",
+            (shard_count, shard_index)
+        )
+        return cur.fetchall()
 
+# --- Session Store ---
+class PostgresSessionBackend:
+    """Durable session tier in the user_sessions table, shared by every bot worker."""
+
+    @run_in_db_executor
+    def load(self, user_id):
+        with db_cursor() as cur:
+            cur.execute("SELECT data FROM user_sessions WHERE user_id = %s AND expires_at > NOW()", (user_id,))
+            row = cur.fetchone()
+        return row[0] if row else None
+
+    @run_in_db_executor
+    def save(self, user_id, data, ttl_seconds):
+        with db_cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO user_sessions (user_id, data, expires_at)
+                VALUES (%s, %s, NOW() + make_interval(secs => %s))
+                ON CONFLICT (user_id) DO UPDATE SET data = EXCLUDED.data, expires_at = EXCLUDED.expires_at
+                """,
+                (user_id, Json(data), ttl_seconds)
+            )
+
+    @run_in_db_executor
+    def save_seen_ids(self, user_id, email, seen_ids, ttl_seconds):
+        with db_cursor() as cur:
+            cur.execute(
+                """
+                UPDATE user_sessions
+                SET data = jsonb_set(data, '{seen_ids}', %s), expires_at = NOW() + make_interval(secs => %s)
+                WHERE user_id = %s AND data->>'email' = %s AND expires_at > NOW()
+                """,
+                (Json(seen_ids), ttl_seconds, user_id, email)
+            )
+            return cur.rowcount == 1
+
+    @run_in_db_executor
+    def delete(self, user_id):
+        with db_cursor() as cur:
+            cur.execute("DELETE FROM user_sessions WHERE user_id = %s", (user_id,))
+
+    @run_in_db_executor
+    def purge_expired(self):
+        with db_cursor() as cur:
+            cur.execute("DELETE FROM user_sessions WHERE expires_at <= NOW()")
+            return cur.rowcount
+
+    @run_in_db_executor
+    def load_recent_mailboxes(self, written_within, ttl_seconds, shard_count, shard_index):
+        with db_cursor() as cur:
+            # A session written `age` seconds ago expires ttl_seconds - age from now
             cur.execute(
-                "INSERT INTO users (user_id, first_name, balance, referral_code, referred_by) VALUES (%s, %s, %s, %s, %s)",
-                (user_id, first_name, signup_bonus, new_referral_code, referred_by_id)
+                """
+                SELECT user_id, data, EXTRACT(EPOCH FROM NOW() + make_interval(secs => %(ttl)s) - expires_at)
+                FROM user_sessions
+                WHERE expires_at > NOW() + make_interval(secs => %(ttl)s - %(within)s)
+                  AND data ? 'email' AND mod(user_id, %(shards)s) = %(shard)s
+                """,
+                {'ttl': ttl_seconds, 'within': written_within, 'shards': shard_count, 'shard': shard_index}
             )
-    conn.commit()
-    conn.close()
-
-# Initialize the database on startup
-try:
-    setup_database()
-except Exception as e:
-    print(f"Could not set up database on startup: {e}")
\ No newline at end of file
+            return [(user_id, data, float(age)) for user_id, data, age in cur.fetchall()]
+
+
+class SqliteSessionBackend:
+    """Durable session tier in an embedded SQLite file, for single-worker deployments."""
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _get_conn(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS user_sessions (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+        return self._conn
+
+    @run_in_db_executor
+    def load(self, user_id):
+        with self._lock:
+            row = self._get_conn().execute(
+                "SELECT data FROM user_sessions WHERE user_id = ? AND expires_at > ?", (user_id, time.time())
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    @run_in_db_executor
+    def save(self, user_id, data, ttl_seconds):
+        with self._lock, self._get_conn() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO user_sessions (user_id, data, expires_at) VALUES (?, ?, ?)",
+                (user_id, json.dumps(data), time.time() + ttl_seconds)
+            )
+
+    @run_in_db_executor
+    def save_seen_ids(self, user_id, email, seen_ids, ttl_seconds):
+        now = time.time()
+        with self._lock, self._get_conn() as conn:
+            return conn.execute(
+                """
+                UPDATE user_sessions SET data = json_set(data, '$.seen_ids', json(?)), expires_at = ?
+                WHERE user_id = ? AND json_extract(data, '$.email') = ? AND expires_at > ?
+                """,
+                (json.dumps(seen_ids), now + ttl_seconds, user_id, email, now)
+            ).rowcount == 1
+
+    @run_in_db_executor
+    def delete(self, user_id):
+        with self._lock, self._get_conn() as conn:
+            conn.execute("DELETE FROM user_sessions WHERE user_id = ?", (user_id,))
+
+    @run_in_db_executor
+    def purge_expired(self):
+        with self._lock, self._get_conn() as conn:
+            return conn.execute("DELETE FROM user_sessions WHERE expires_at <= ?", (time.time(),)).rowcount
+
+    @run_in_db_executor
+    def load_recent_mailboxes(self, written_within, ttl_seconds, shard_count, shard_index):
+        now = time.time()
+        with self._lock:
+            rows = self._get_conn().execute(
+                """
+                SELECT user_id, data, ? - (expires_at - ?) FROM user_sessions
+                WHERE expires_at > ? AND json_extract(data, '$.email') IS NOT NULL AND user_id % ? = ?
+                """,
+                (now, ttl_seconds, now + ttl_seconds - written_within, shard_count, shard_index)
+            ).fetchall()
+        return [(user_id, json.loads(data), age) for user_id, data, age in rows]
+
+
+class SessionStore:
+    """Per-user session data: a bounded LRU+TTL in-process tier in front of a durable backend.
+
+    Writes go through to the backend, so another worker sees them once its own
+    cached copy expires (SESSION_CACHE_TTL_SECONDS). Users without a session are
+    cached too, so menu taps from them do not hit the backend every time.
+    Callers must pass a changed session back through set(); mutating the
+    returned dict only changes this worker's cached copy.
+    """
+
+    def __init__(self, backend, max_entries, cache_ttl, session_ttl):
+        self.backend = backend
+        self.max_entries = max_entries
+        self.cache_ttl = cache_ttl
+        self.session_ttl = session_ttl
+        self._cache = OrderedDict()  # user_id -> (data or None, expires_at)
+
+    def _remember(self, user_id, data):
+        self._cache[user_id] = (data, time.monotonic() + self.cache_ttl)
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+    async def get(self, user_id):
+        """Returns the user's session dict, or None if they have none."""
+        entry = self._cache.get(user_id)
+        if entry is not None and entry[1] > time.monotonic():
+            self._cache.move_to_end(user_id)
+            return entry[0]
+        data = await self.backend.load(user_id)
+        self._remember(user_id, data)
+        return data
+
+    async def set(self, user_id, data):
+        await self.backend.save(user_id, data, self.session_ttl)
+        self._remember(user_id, data)
+
+    async def set_seen_ids(self, user_id, email, seen_ids):
+        """Stores seen_ids in the user's session only if it is still for `email`. Returns whether it was."""
+        saved = await self.backend.save_seen_ids(user_id, email, seen_ids, self.session_ttl)
+        entry = self._cache.get(user_id)
+        if saved and entry is not None and entry[0] and entry[0].get("email") == email:
+            self._remember(user_id, {**entry[0], "seen_ids": seen_ids})
+        else:
+            # The session changed under us, or the cached copy is not the one just written: reload it next time
+            self._cache.pop(user_id, None)
+        return saved
+
+    async def delete(self, user_id):
+        await self.backend.delete(user_id)
+        self._remember(user_id, None)
+
+    async def purge_expired(self):
+        """Deletes expired sessions from the backend and returns how many were removed."""
+        return await self.backend.purge_expired()
+
+    async def recent_mailboxes(self, written_within, shard_count=1, shard_index=0):
+        """Returns (user_id, data, age_seconds) for sessions with an email written in the last written_within seconds.
+
+        Only users with user_id % shard_count == shard_index are returned, so each
+        worker can pick out the users the webhook router sends to it.
+        """
+        return await self.backend.load_recent_mailboxes(written_within, self.session_ttl, shard_count, shard_index)
+
+
+def create_session_store():
+    if SESSION_BACKEND == 'sqlite':
+        backend = SqliteSessionBackend(SESSION_SQLITE_PATH)
+    else:
+        backend = PostgresSessionBackend()
+    return SessionStore(backend, SESSION_CACHE_MAX_ENTRIES, SESSION_CACHE_TTL_SECONDS, SESSION_TTL_SECONDS)
+
+session_store = create_session_store()
+
+if __name__ == "__main__":
+    # Bulk import mode: python database.py import-users users.csv
+    import sys
+    if len(sys.argv) == 3 and sys.argv[1] == 'import-users':
+        bootstrap_database()
+        print(f"Imported {import_users_from_csv(sys.argv[2])} users.")
+    else:
+        print("Usage: python database.py import-users <users.csv>")
@@ -7,11 +7,24 @@
 import logging
 import os
 import asyncio
-import requests
+import bisect
+import contextvars
+import functools
+import heapq
+import hmac
+import html
+import json
+import httpx
 import random
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
-from telegram.error import BadRequest
+import signal
+import socket
+import time
+import weakref
+from collections import OrderedDict, deque
+import tornado.web
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
+from telegram.ext import Application, BaseRateLimiter, BaseUpdateProcessor, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, TypeHandler, filters
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
 import database as db
 
 # --- Configuration (গোপন তথ্যগুলো Railway-এর Variables থেকে আসবে) ---
@@ -23,49 +36,607 @@ try:
     TELEGRAM_CHANNEL_LINK = os.environ.get("TELEGRAM_CHANNEL_LINK", "https://t.me/telegram")
     # Welcome image URL (optional)
     WELCOME_IMAGE_URL = os.environ.get("WELCOME_IMAGE_URL", "https://i.ibb.co/example/welcome.jpg") # একটি উদাহরণ ছবি
+    # Upstream API endpoints and limits (can point at local stubs for testing)
+    MAIL_API_URL = os.environ.get("MAIL_API_URL", "https://www.1secmail.com/api/v1/")
+    SMS_API_URL = os.environ.get("SMS_API_URL", "https://api.sms-activate.org/stubs/handler_api.php")
+    TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org/bot")
+    HTTP_TIMEOUT_SECONDS = float(os.environ.get("HTTP_TIMEOUT_SECONDS", 10))
+    MAIL_API_CONCURRENCY = int(os.environ.get("MAIL_API_CONCURRENCY", 20))
+    # Temp mail providers in order of preference; new mailboxes fail over down the list
+    MAIL_PROVIDERS = [name for name in os.environ.get("MAIL_PROVIDERS", "1secmail,guerrillamail").split(',') if name]
+    GUERRILLA_API_URL = os.environ.get("GUERRILLA_API_URL", "https://api.guerrillamail.com/ajax.php")
+    MAIL_RETRY_ATTEMPTS = int(os.environ.get("MAIL_RETRY_ATTEMPTS", 2))
+    MAIL_RETRY_BASE_SECONDS = float(os.environ.get("MAIL_RETRY_BASE_SECONDS", 0.2))
+    MAIL_RETRY_MAX_SECONDS = float(os.environ.get("MAIL_RETRY_MAX_SECONDS", 2))
+    MAIL_HEDGE_AFTER_SECONDS = float(os.environ.get("MAIL_HEDGE_AFTER_SECONDS", 0))  # 0 disables hedging
+    BREAKER_FAILURE_RATE = float(os.environ.get("BREAKER_FAILURE_RATE", 0.5))
+    BREAKER_MIN_REQUESTS = int(os.environ.get("BREAKER_MIN_REQUESTS", 10))
+    BREAKER_WINDOW_SECONDS = float(os.environ.get("BREAKER_WINDOW_SECONDS", 30))
+    BREAKER_OPEN_SECONDS = float(os.environ.get("BREAKER_OPEN_SECONDS", 30))
+    PROVIDER_LATENCY_SAMPLES = int(os.environ.get("PROVIDER_LATENCY_SAMPLES", 1000))
+    SMS_API_CONCURRENCY = int(os.environ.get("SMS_API_CONCURRENCY", 10))
+    AD_REVEAL_TICK_SECONDS = float(os.environ.get("AD_REVEAL_TICK_SECONDS", 1))
+    SESSION_PURGE_INTERVAL_SECONDS = float(os.environ.get("SESSION_PURGE_INTERVAL_SECONDS", 3600))
+    BALANCE_CACHE_TTL_SECONDS = float(os.environ.get("BALANCE_CACHE_TTL_SECONDS", 10))
+    BALANCE_CACHE_MAX_ENTRIES = int(os.environ.get("BALANCE_CACHE_MAX_ENTRIES", 10000))
+    KEYBOARD_CACHE_SIZE = int(os.environ.get("KEYBOARD_CACHE_SIZE", 1024))
+    INBOX_FETCH_CONCURRENCY_PER_USER = int(os.environ.get("INBOX_FETCH_CONCURRENCY_PER_USER", 5))
+    # Background inbox watcher
+    INBOX_WATCH_TICK_SECONDS = float(os.environ.get("INBOX_WATCH_TICK_SECONDS", 1))
+    INBOX_WATCH_SYNC_SECONDS = float(os.environ.get("INBOX_WATCH_SYNC_SECONDS", 60))
+    INBOX_WATCH_MIN_INTERVAL_SECONDS = float(os.environ.get("INBOX_WATCH_MIN_INTERVAL_SECONDS", 5))
+    INBOX_WATCH_MAX_INTERVAL_SECONDS = float(os.environ.get("INBOX_WATCH_MAX_INTERVAL_SECONDS", 120))
+    INBOX_WATCH_BACKOFF = float(os.environ.get("INBOX_WATCH_BACKOFF", 1.5))
+    INBOX_WATCH_JITTER = float(os.environ.get("INBOX_WATCH_JITTER", 0.2))
+    INBOX_WATCH_POLLS_PER_SECOND = float(os.environ.get("INBOX_WATCH_POLLS_PER_SECOND", 10))
+    INBOX_WATCH_IDLE_SECONDS = int(os.environ.get("INBOX_WATCH_IDLE_SECONDS", 30 * 60))
+    # SMS activations
+    SMS_API_RATE_PER_SECOND = float(os.environ.get("SMS_API_RATE_PER_SECOND", 5))
+    SMS_ACTIVATION_TIMEOUT_SECONDS = int(os.environ.get("SMS_ACTIVATION_TIMEOUT_SECONDS", 20 * 60))
+    SMS_POLL_TICK_SECONDS = float(os.environ.get("SMS_POLL_TICK_SECONDS", 1))
+    SMS_POLL_MIN_INTERVAL_SECONDS = float(os.environ.get("SMS_POLL_MIN_INTERVAL_SECONDS", 5))
+    SMS_POLL_MAX_INTERVAL_SECONDS = float(os.environ.get("SMS_POLL_MAX_INTERVAL_SECONDS", 30))
+    SMS_POLL_BACKOFF = float(os.environ.get("SMS_POLL_BACKOFF", 1.5))
+    SMS_BULK_STATUS = os.environ.get("SMS_BULK_STATUS", "1") == "1"  # Use getActiveActivations
+    # With several shard workers, each one watches only the users the router sends it
+    WORKER_SHARD_INDEX = int(os.environ.get("WORKER_SHARD_INDEX", 0))
+    WORKER_SHARD_COUNT = int(os.environ.get("WORKER_SHARD_COUNT", 1))
+    # Update processing: how many updates may be in flight, and how many handlers may run at once
+    UPDATE_MAX_PENDING = int(os.environ.get("UPDATE_MAX_PENDING", 4096))
+    UPDATE_CONCURRENCY = int(os.environ.get("UPDATE_CONCURRENCY", 64))
+    UPDATE_METRICS_LOG_SECONDS = float(os.environ.get("UPDATE_METRICS_LOG_SECONDS", 60))
+    # Outgoing messages (Telegram allows about 30/s overall, 1/s per chat and 20/min per group)
+    TELEGRAM_GLOBAL_RATE = float(os.environ.get("TELEGRAM_GLOBAL_RATE", 30))
+    TELEGRAM_GLOBAL_BURST = int(os.environ.get("TELEGRAM_GLOBAL_BURST", 1))  # Kept small: burst + rate can go out within one second
+    TELEGRAM_PER_CHAT_RATE = float(os.environ.get("TELEGRAM_PER_CHAT_RATE", 1))
+    TELEGRAM_PER_CHAT_BURST = int(os.environ.get("TELEGRAM_PER_CHAT_BURST", 3))
+    TELEGRAM_GROUP_RATE = float(os.environ.get("TELEGRAM_GROUP_RATE", 20 / 60))
+    TELEGRAM_MAX_RETRIES = int(os.environ.get("TELEGRAM_MAX_RETRIES", 3))
+    TELEGRAM_CHAT_BUCKETS_MAX = int(os.environ.get("TELEGRAM_CHAT_BUCKETS_MAX", 10000))
+    # An interim "⏳ ..." edit is only sent if the final edit takes longer than this
+    EDIT_INTERIM_DEADLINE_SECONDS = float(os.environ.get("EDIT_INTERIM_DEADLINE_SECONDS", 1))
+    EDIT_BUFFER_MAX_MESSAGES = int(os.environ.get("EDIT_BUFFER_MAX_MESSAGES", 10000))
+    # Staff broadcasts
+    BROADCAST_STAFF_ROLES = [role for role in os.environ.get("BROADCAST_STAFF_ROLES", "admin").split(',') if role]
+    BROADCAST_SENDERS = int(os.environ.get("BROADCAST_SENDERS", 8))
+    BROADCAST_IN_FLIGHT = int(os.environ.get("BROADCAST_IN_FLIGHT", 1000))  # Recipients read but not yet checkpointed
+    BROADCAST_BATCH_SIZE = int(os.environ.get("BROADCAST_BATCH_SIZE", 500))
+    BROADCAST_CURSOR_WINDOW = int(os.environ.get("BROADCAST_CURSOR_WINDOW", 50000))
+    BROADCAST_CHECKPOINT_SECONDS = float(os.environ.get("BROADCAST_CHECKPOINT_SECONDS", 10))
+    BROADCAST_BLOCKED_BATCH = int(os.environ.get("BROADCAST_BLOCKED_BATCH", 500))
+    BROADCAST_LEASE_SECONDS = int(os.environ.get("BROADCAST_LEASE_SECONDS", 60))
+    BROADCAST_RESUME_SECONDS = float(os.environ.get("BROADCAST_RESUME_SECONDS", 30))
+    # Premium: cached status is trusted until premium_expiry, or this long for users without an expiry
+    PREMIUM_CACHE_TTL_SECONDS = float(os.environ.get("PREMIUM_CACHE_TTL_SECONDS", 300))
+    PREMIUM_CACHE_MAX_ENTRIES = int(os.environ.get("PREMIUM_CACHE_MAX_ENTRIES", 10000))
+    PREMIUM_SWEEP_SECONDS = float(os.environ.get("PREMIUM_SWEEP_SECONDS", 60))
+    PREMIUM_SWEEP_BATCH = int(os.environ.get("PREMIUM_SWEEP_BATCH", 1000))
+    # Latency metrics in Prometheus text format on http://METRICS_LISTEN:METRICS_PORT/metrics (0 disables).
+    # Each shard worker listens on METRICS_PORT + WORKER_SHARD_INDEX, so workers on one host do not clash
+    METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "127.0.0.1")
+    METRICS_PORT = int(os.environ.get("METRICS_PORT", 9464))
+    # Opt-in: log where updates slower than this many seconds spent their time (0 disables)
+    SLOW_UPDATE_PROFILE_SECONDS = float(os.environ.get("SLOW_UPDATE_PROFILE_SECONDS", 0))
+    SLOW_UPDATE_SAMPLE_SECONDS = float(os.environ.get("SLOW_UPDATE_SAMPLE_SECONDS", 0.01))
+    # Update delivery: "polling", "webhook" (one worker registered with Telegram),
+    # "router" (registered with Telegram, shards updates across workers) or "shard" (a worker behind the router)
+    BOT_MODE = os.environ.get("BOT_MODE", "polling")
+    # Shard workers only take updates from the router, so by default they are not reachable from outside the host
+    WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "127.0.0.1" if BOT_MODE == "shard" else "0.0.0.0")
+    WEBHOOK_PORT = int(os.environ.get("PORT", 8443))
+    WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram")
+    WEBHOOK_URL = os.environ.get("WEBHOOK_URL")  # Public URL registered with Telegram in webhook and router mode
+    WEBHOOK_SECRET_TOKEN = os.environ.get("WEBHOOK_SECRET_TOKEN")  # Required in webhook, router and shard mode
+    WEBHOOK_SHARD_URLS = [url for url in os.environ.get("WEBHOOK_SHARD_URLS", "").split(',') if url]
+    WEBHOOK_SHARD_QUEUE_SIZE = int(os.environ.get("WEBHOOK_SHARD_QUEUE_SIZE", 10000))
+    WEBHOOK_FORWARD_LANES = int(os.environ.get("WEBHOOK_FORWARD_LANES", 8))
+    WEBHOOK_FORWARD_RETRIES = int(os.environ.get("WEBHOOK_FORWARD_RETRIES", 8))  # Per update, for connect errors, timeouts and 5xx
 except Exception as e:
     print(f"Error reading environment variables: {e}")
     # Provide default values if running locally without environment variables
     USER_BOT_TOKEN = "YOUR_LOCAL_TOKEN" # Local testing only
 
 # --- Setup ---
+PROCESS_STARTED_AT = time.monotonic()
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
 logger = logging.getLogger(__name__)
-user_temp_data = {}  # In-memory storage for temporary data like activation IDs
+sessions = db.session_store  # Per-user temporary data like the active email, shared across workers
 
-# --- 1secmail.com API Functions ( নির্ভরযোগ্য ইমেইল সিস্টেম) ---
-async def create_email():
-    """Generates a new random email address from 1secmail."""
+# --- Metrics (কোন ধাপে কত সময় লাগছে তা মাপা) ---
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """Counts observations per latency bucket; no samples are kept, so observe() is O(1)."""
+
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)  # The last bucket is +Inf
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+
+class MetricsRegistry:
+    """Latency histograms by metric and label, rendered in the Prometheus text format.
+
+    The render also includes the numbers from every component's stats() as gauges.
+    """
+
+    def __init__(self):
+        self._histograms = {}  # name -> (label name, {label value: Histogram})
+        self._help = {}
+        self._components = {}  # gauge prefix -> object with stats()
+
+    def histogram(self, name, label, help_text):
+        self._help[name] = help_text
+        self._histograms[name] = (label, {})
+
+    def observe(self, name, value, seconds):
+        histograms = self._histograms[name][1]
+        histogram = histograms.get(value)
+        if histogram is None:
+            histogram = histograms[value] = Histogram()
+        histogram.observe(seconds)
+
+    def component(self, prefix, source):
+        self._components[prefix] = source
+
+    def render(self):
+        lines = []
+        for name, (label, histograms) in self._histograms.items():
+            lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} histogram")
+            for value, histogram in sorted(histograms.items()):
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{label}="{value}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_sum{{{label}="{value}"}} {histogram.total:.6f}')
+                lines.append(f'{name}_count{{{label}="{value}"}} {histogram.count}')
+        for prefix, source in self._components.items():
+            self._render_stats(lines, f"bot_{prefix}", source.stats(), "")
+        return "\n".join(lines) + "\n"
+
+    def _render_stats(self, lines, prefix, stats, labels):
+        for key, value in stats.items():
+            if isinstance(value, dict):
+                self._render_stats(lines, prefix, value, f'{{name="{key}"}}')
+            elif isinstance(value, (int, float)):
+                lines.append(f"{prefix}_{key}{labels} {float(value)}")
+
+metrics = MetricsRegistry()
+metrics.histogram("bot_update_seconds", "kind", "Time to handle one update, from the first handler to the last")
+metrics.histogram("bot_callback_seconds", "route", "Time spent in each button_handler route")
+metrics.histogram("bot_db_query_seconds", "query", "Time for each database helper, including waiting for a DB thread")
+metrics.histogram("bot_upstream_seconds", "upstream", "HTTP round trips to the mail and SMS providers")
+metrics.histogram("bot_telegram_seconds", "method", "Telegram Bot API calls, per attempt, excluding rate limiting")
+db.query_observer = functools.partial(metrics.observe, "bot_db_query_seconds")
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(metrics.render())
+
+
+def start_metrics_server():
+    if not METRICS_PORT:
+        return
+    port = METRICS_PORT + WORKER_SHARD_INDEX
     try:
-        response = requests.get("https://www.1secmail.com/api/v1/?action=genRandomMailbox&count=1")
+        tornado.web.Application([(r"/metrics", MetricsHandler)]).listen(port, address=METRICS_LISTEN)
+    except OSError as e:
+        # Metrics are optional; a taken port must not keep the bot from starting
+        logger.error(f"Could not serve metrics on {METRICS_LISTEN}:{port}: {e}")
+        return
+    logger.info(f"Metrics on http://{METRICS_LISTEN}:{port}/metrics")
+
+
+class SlowUpdateProfiler:
+    """Opt-in sampling profiler that explains slow updates.
+
+    Every `interval` seconds one sampler looks at where each running update is
+    suspended: the chain of coroutines it is awaiting in, innermost last. An
+    update that ends up taking longer than `threshold` seconds is logged with
+    its most frequent chains; samples of fast updates are thrown away.
+    """
+
+    def __init__(self, threshold, interval, top=5):
+        self.threshold = threshold
+        self.interval = interval
+        self.top = top
+        self._samples = {}  # task -> Counter of await chains
+        self._sampler = None
+        self.profiled = 0
+
+    def track(self, task):
+        self._samples[task] = {}
+        if self._sampler is None or self._sampler.done():
+            self._sampler = asyncio.create_task(self._sample())
+
+    def finish(self, task, elapsed, description):
+        samples = self._samples.pop(task, None)
+        if not samples or elapsed < self.threshold:
+            return
+        self.profiled += 1
+        total = sum(samples.values())
+        ranked = sorted(samples.items(), key=lambda item: item[1], reverse=True)[:self.top]
+        report = "\n".join(f"  {count / total:5.1%}  {' > '.join(chain)}" for chain, count in ranked)
+        logger.warning(f"Slow update ({elapsed * 1000:.0f} ms, {description}), {total} samples:\n{report}")
+
+    async def _sample(self):
+        while self._samples:
+            await asyncio.sleep(self.interval)
+            for task, samples in self._samples.items():
+                chain = self._await_chain(task)
+                samples[chain] = samples.get(chain, 0) + 1
+
+    @staticmethod
+    def _await_chain(task):
+        chain = []
+        awaitable = task.get_coro()
+        while awaitable is not None:
+            frame = getattr(awaitable, "cr_frame", None) or getattr(awaitable, "ag_frame", None)
+            if frame is None:
+                break
+            chain.append(f"{frame.f_code.co_name}:{frame.f_lineno}")
+            awaitable = getattr(awaitable, "cr_await", None) or getattr(awaitable, "ag_await", None)
+        return tuple(chain)
+
+slow_update_profiler = SlowUpdateProfiler(SLOW_UPDATE_PROFILE_SECONDS, SLOW_UPDATE_SAMPLE_SECONDS) if SLOW_UPDATE_PROFILE_SECONDS else None
+
+# --- Shared HTTP Clients (প্রতিটি আপস্ট্রিমের জন্য একটি keep-alive সেশন) ---
+class RateLimiter:
+    """Token bucket: acquire() waits until another request fits under `rate` per second.
+
+    Up to `burst` requests (default: one second's worth) can go out back to back.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(rate, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class UpstreamClient:
+    """A keep-alive HTTP session for one upstream host with a cap on in-flight requests.
+
+    With max_rate set, requests are also spaced out to at most max_rate per second.
+    """
+
+    def __init__(self, base_url, max_concurrency, timeout, max_rate=None):
+        self.base_url = base_url
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._rate_limiter = RateLimiter(max_rate) if max_rate else None
+        self._client = None
+        self.name = httpx.URL(base_url).host
+
+    def _get_client(self):
+        # Created lazily so the connection pool belongs to the running event loop.
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency),
+            )
+        return self._client
+
+    async def get(self, params):
+        """Sends a GET with the given query parameters and raises on HTTP errors."""
+        if self._rate_limiter is not None:
+            await self._rate_limiter.acquire()
+        async with self._semaphore:
+            started = time.perf_counter()
+            try:
+                response = await self._get_client().get("", params=params)
+            finally:
+                metrics.observe("bot_upstream_seconds", self.name, time.perf_counter() - started)
         response.raise_for_status()
-        return response.json()[0]
-    except requests.RequestException as e:
-        logger.error(f"1secmail email creation error: {e}")
+        return response
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+mail_client = UpstreamClient(MAIL_API_URL, MAIL_API_CONCURRENCY, HTTP_TIMEOUT_SECONDS)
+sms_client = UpstreamClient(SMS_API_URL, SMS_API_CONCURRENCY, HTTP_TIMEOUT_SECONDS, max_rate=SMS_API_RATE_PER_SECOND)
+
+# --- Temporary Email Providers ( নির্ভরযোগ্য ইমেইল সিস্টেম) ---
+class ProviderUnavailable(Exception):
+    """A provider could not serve a request: its breaker is open or every attempt failed."""
+
+
+class LatencyTracker:
+    """Keeps the latest request latencies of one provider for percentile reporting."""
+
+    def __init__(self, size):
+        self._samples = deque(maxlen=size)
+
+    def record(self, seconds):
+        self._samples.append(seconds)
+
+    def percentile(self, fraction):
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class CircuitBreaker:
+    """Fails fast while a provider's recent error rate is too high.
+
+    Closed: requests go through and outcomes are counted over the last `window`
+    seconds. Once at least `min_requests` were made and `failure_rate` of them
+    failed, the breaker opens and rejects everything for `open_seconds`. It is
+    then half-open: one probe goes through, and its outcome closes or re-opens it.
+    """
+
+    STATE_CODES = {"closed": 0, "half_open": 1, "open": 2}  # State as a number, for the /metrics gauge
+
+    def __init__(self, failure_rate, min_requests, window, open_seconds):
+        self.failure_rate = failure_rate
+        self.min_requests = min_requests
+        self.window = window
+        self.open_seconds = open_seconds
+        self.state = "closed"
+        self._outcomes = deque()  # (time, ok) within the window
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    def allow(self):
+        if self.state == "open":
+            if time.monotonic() - self._opened_at < self.open_seconds:
+                return False
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self._probing:
+                return False
+            self._probing = True
+        return True
+
+    def release(self):
+        """Gives back a probe that was cancelled before it finished."""
+        self._probing = False
+
+    def record(self, ok):
+        now = time.monotonic()
+        if self.state == "open":
+            return  # A request that started before the breaker opened
+        if self.state == "half_open":
+            self._probing = False
+            if ok:
+                self.state = "closed"
+            else:
+                self._open(now)
+            return
+        self._outcomes.append((now, ok))
+        self._failures += not ok
+        while self._outcomes[0][0] < now - self.window:
+            self._failures -= not self._outcomes.popleft()[1]
+        if len(self._outcomes) >= self.min_requests and self._failures >= self.failure_rate * len(self._outcomes):
+            self._open(now)
+
+    def _open(self, now):
+        if self.state != "open":
+            logger.warning(f"Circuit breaker opened after {self._failures}/{len(self._outcomes)} failures.")
+        self.state = "open"
+        self._opened_at = now
+        self._outcomes.clear()
+        self._failures = 0
+
+
+class MailProvider:
+    """One temporary email service behind a breaker, with retries, optional hedging and latency tracking.
+
+    Subclasses implement create_mailbox(), list_messages() and read_message() in
+    terms of request(). Messages are returned in 1secmail's shape ('id', 'from',
+    'subject', 'date', 'textBody') whatever the provider.
+    """
+    name = None
+
+    def __init__(self, client):
+        self.client = client
+        self.breaker = CircuitBreaker(BREAKER_FAILURE_RATE, BREAKER_MIN_REQUESTS, BREAKER_WINDOW_SECONDS, BREAKER_OPEN_SECONDS)
+        self.latency = LatencyTracker(PROVIDER_LATENCY_SAMPLES)
+        self.attempts = 0
+        self.failures = 0
+        self.hedges = 0
+
+    async def _attempt(self, params):
+        if not self.breaker.allow():
+            raise ProviderUnavailable(f"{self.name} circuit is open")
+        self.attempts += 1
+        started = time.monotonic()
+        try:
+            data = (await self.client.get(params)).json()
+        except asyncio.CancelledError:
+            # The other half of a hedge won; this attempt says nothing about the provider
+            if self.breaker.state == "half_open":
+                self.breaker.release()
+            raise
+        except (httpx.HTTPError, ValueError):
+            self.failures += 1
+            self.breaker.record(False)
+            raise
+        self.latency.record(time.monotonic() - started)
+        self.breaker.record(True)
+        return data
+
+    async def _hedged(self, params):
+        # A second copy is sent if the first is slower than MAIL_HEDGE_AFTER_SECONDS; the first answer wins
+        first = asyncio.create_task(self._attempt(params))
+        if MAIL_HEDGE_AFTER_SECONDS <= 0:
+            return await first
+        done, _ = await asyncio.wait({first}, timeout=MAIL_HEDGE_AFTER_SECONDS)
+        if done:
+            return first.result()
+        self.hedges += 1
+        pending = {first, asyncio.create_task(self._attempt(params))}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def request(self, params):
+        """Sends one GET, retrying transient failures with capped, jittered exponential backoff."""
+        delay = MAIL_RETRY_BASE_SECONDS
+        for attempt in range(MAIL_RETRY_ATTEMPTS + 1):
+            try:
+                return await self._hedged(params)
+            except (httpx.HTTPError, ValueError) as e:
+                transient = not isinstance(e, httpx.HTTPStatusError) or e.response.status_code in (429, 500, 502, 503, 504)
+                if not transient or attempt == MAIL_RETRY_ATTEMPTS:
+                    raise ProviderUnavailable(f"{self.name}: {e}") from e
+                await asyncio.sleep(random.uniform(0, delay))
+                delay = min(delay * 2, MAIL_RETRY_MAX_SECONDS)
+
+    def stats(self):
+        p50, p99 = self.latency.percentile(0.5), self.latency.percentile(0.99)
+        return {
+            'breaker': self.breaker.state, 'breaker_state': CircuitBreaker.STATE_CODES[self.breaker.state],
+            'attempts': self.attempts, 'failures': self.failures, 'hedges': self.hedges,
+            'p50_ms': round(p50 * 1000, 1) if p50 is not None else None,
+            'p99_ms': round(p99 * 1000, 1) if p99 is not None else None,
+        }
+
+
+class OneSecMailProvider(MailProvider):
+    name = "1secmail"
+
+    async def create_mailbox(self):
+        return {"email": (await self.request({"action": "genRandomMailbox", "count": 1}))[0]}
+
+    async def list_messages(self, account):
+        login, domain = account['email'].split('@')
+        return await self.request({"action": "getMessages", "login": login, "domain": domain})
+
+    async def read_message(self, account, message_id):
+        login, domain = account['email'].split('@')
+        return await self.request({"action": "readMessage", "login": login, "domain": domain, "id": message_id})
+
+
+class GuerrillaMailProvider(MailProvider):
+    """Guerrilla Mail's ajax API. A mailbox is tied to the sid_token it was created with."""
+    name = "guerrillamail"
+
+    async def create_mailbox(self):
+        data = await self.request({"f": "get_email_address", "lang": "en"})
+        return {"email": data["email_addr"], "mail_token": data["sid_token"]}
+
+    async def list_messages(self, account):
+        data = await self.request({"f": "get_email_list", "offset": 0, "sid_token": account["mail_token"]})
+        return [
+            {"id": str(msg["mail_id"]), "from": msg.get("mail_from"), "subject": msg.get("mail_subject"), "date": msg.get("mail_date")}
+            for msg in data.get("list") or []
+        ]
+
+    async def read_message(self, account, message_id):
+        data = await self.request({"f": "fetch_email", "email_id": message_id, "sid_token": account["mail_token"]})
+        if not data:
+            return None
+        return {
+            "id": message_id, "from": data.get("mail_from"), "subject": data.get("mail_subject"),
+            "date": data.get("mail_date"), "textBody": data.get("mail_body"),
+        }
+
+
+class MailService:
+    """Creates mailboxes on the first provider that works and sends inbox reads to the provider that owns the mailbox."""
+
+    def __init__(self, providers):
+        self.providers = {provider.name: provider for provider in providers}  # In order of preference
+
+    async def create_mailbox(self):
+        errors = []
+        for provider in self.providers.values():
+            try:
+                account = await provider.create_mailbox()
+            except (ProviderUnavailable, KeyError, IndexError, TypeError) as e:
+                logger.warning(f"Email creation on {provider.name} failed, trying the next provider: {e}")
+                errors.append(str(e))
+                continue
+            return {**account, "provider": provider.name}
+        raise ProviderUnavailable("; ".join(errors) or "no mail providers configured")
+
+    def provider_for(self, account):
+        # Sessions from before providers were recorded belong to 1secmail
+        provider = self.providers.get(account.get("provider", OneSecMailProvider.name))
+        if provider is None:
+            raise ProviderUnavailable(f"provider {account.get('provider')} is not configured")
+        return provider
+
+    def stats(self):
+        return {name: provider.stats() for name, provider in self.providers.items()}
+
+    async def aclose(self):
+        for provider in self.providers.values():
+            await provider.client.aclose()
+
+MAIL_PROVIDER_FACTORIES = {
+    OneSecMailProvider.name: lambda: OneSecMailProvider(mail_client),
+    GuerrillaMailProvider.name: lambda: GuerrillaMailProvider(
+        UpstreamClient(GUERRILLA_API_URL, MAIL_API_CONCURRENCY, HTTP_TIMEOUT_SECONDS)
+    ),
+}
+mail_service = MailService([MAIL_PROVIDER_FACTORIES[name]() for name in MAIL_PROVIDERS])
+
+
+def mail_account(data):
+    """The part of a session that identifies its mailbox: the address, its provider and any access token."""
+    return {key: data[key] for key in ("email", "provider", "mail_token") if key in data}
+
+async def create_email():
+    """Creates a mailbox on the first available provider. Returns its account dict, or None."""
+    try:
+        return await mail_service.create_mailbox()
+    except ProviderUnavailable as e:
+        logger.error(f"Email creation error: {e}")
         return None
 
-async def get_inbox(email):
-    """Fetches the list of emails from the 1secmail inbox."""
+async def get_inbox(account):
+    """Fetches the list of emails in a mailbox, or None if the request failed."""
     try:
-        login, domain = email.split('@')
-        url = f"https://www.1secmail.com/api/v1/?action=getMessages&login={login}&domain={domain}"
-        response = requests.get(url)
-        response.raise_for_status()
-        return response.json()
-    except requests.RequestException as e:
-        logger.error(f"1secmail inbox fetch error: {e}")
-        return []
+        return await mail_service.provider_for(account).list_messages(account)
+    except (ProviderUnavailable, KeyError, TypeError) as e:
+        logger.error(f"Inbox fetch error: {e}")
+        return None
 
-async def get_message_details(email, message_id):
+async def get_message_details(account, message_id):
     """Fetches the full content of a specific email."""
     try:
-        login, domain = email.split('@')
-        url = f"https://www.1secmail.com/api/v1/?action=readMessage&login={login}&domain={domain}&id={message_id}"
-        response = requests.get(url)
-        response.raise_for_status()
-        return response.json()
-    except requests.RequestException as e:
-        logger.error(f"1secmail message read error: {e}")
+        return await mail_service.provider_for(account).read_message(account, message_id)
+    except (ProviderUnavailable, KeyError, TypeError) as e:
+        logger.error(f"Message read error: {e}")
         return None
 
 # --- SMS-Activate.org API Functions (টেম্পোরারি নম্বর সিস্টেম) ---
@@ -74,39 +645,62 @@ async def get_number(service_code, country_code='0'):
     if not SMS_API_KEY:
         logger.error("SMS_ACTIVATE_API_KEY is not set.")
         return {'error': 'Service not available'}
-    url = f"https://api.sms-activate.org/stubs/handler_api.php?api_key={SMS_API_KEY}&action=getNumber&service={service_code}&country={country_code}"
+    params = {"api_key": SMS_API_KEY, "action": "getNumber", "service": service_code, "country": country_code}
     try:
-        response = requests.get(url)
-        response.raise_for_status()
+        response = await sms_client.get(params)
         parts = response.text.split(':')
         if parts[0] == "ACCESS_NUMBER":
             return {'status': 'success', 'id': parts[1], 'number': parts[2]}
         else:
             logger.error(f"SMS Activate getNumber error: {response.text}")
             return {'status': 'error', 'message': response.text}
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         logger.error(f"SMS Activate getNumber exception: {e}")
         return {'status': 'error', 'message': str(e)}
 
 async def get_sms_status(activation_id):
     """Checks the status of an activation to see if an SMS has arrived."""
-    url = f"https://api.sms-activate.org/stubs/handler_api.php?api_key={SMS_API_KEY}&action=getStatus&id={activation_id}"
+    params = {"api_key": SMS_API_KEY, "action": "getStatus", "id": activation_id}
     try:
-        response = requests.get(url)
-        response.raise_for_status()
+        response = await sms_client.get(params)
         return response.text
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         logger.error(f"SMS Activate getStatus exception: {e}")
         return "ERROR_GETTING_STATUS"
 
+async def get_active_activations():
+    """Checks every active activation on the account in one request.
+
+    Returns {activation id: latest code or None}, or None if the request failed.
+    Activations that have finished or been cancelled are not included.
+    """
+    params = {"api_key": SMS_API_KEY, "action": "getActiveActivations"}
+    try:
+        response = await sms_client.get(params)
+        data = response.json()
+    except (httpx.HTTPError, ValueError) as e:
+        logger.error(f"SMS Activate getActiveActivations exception: {e}")
+        return None
+    if not isinstance(data, dict) or data.get('status') != 'success':
+        if isinstance(data, dict) and data.get('error') == 'NO_ACTIVATIONS':
+            return {}
+        logger.error(f"SMS Activate getActiveActivations error: {data}")
+        return None
+    codes = {}
+    for activation in data.get('activeActivations') or []:
+        sms_code = activation.get('smsCode')
+        if isinstance(sms_code, list):
+            sms_code = sms_code[-1] if sms_code else None
+        codes[str(activation['activationId'])] = sms_code or None
+    return codes
+
 async def set_activation_status(activation_id, status):
     """Sets the status of an activation (e.g., cancel or report)."""
-    url = f"https://api.sms-activate.org/stubs/handler_api.php?api_key={SMS_API_KEY}&action=setStatus&id={activation_id}&status={status}"
+    params = {"api_key": SMS_API_KEY, "action": "setStatus", "id": activation_id, "status": status}
     try:
-        response = requests.get(url)
-        response.raise_for_status()
+        response = await sms_client.get(params)
         return response.text
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         logger.error(f"SMS Activate setStatus exception: {e}")
         return "ERROR_SETTING_STATUS"
 
@@ -122,46 +716,175 @@ async def set_activation_status(activation_id, status):
 # ==============================================================================
 
 # --- Keyboard Layouts (বাটনগুলোর ডিজাইন) ---
+# Static keyboards are built once at import. PTB keyboard objects are immutable, so
+# every message can share them; only the parts that change (balance, price, ad link)
+# are filled in, and those markups are memoized too.
 
-def get_main_menu_keyboard(user_id):
-    """Generates the main menu keyboard with the user's balance."""
-    user = db.get_user(user_id)
-    balance = user['balance'] if user else 0.0
-    
-    keyboard = [
-        [InlineKeyboardButton(f"💰 আপনার ব্যালেন্স: {balance:.2f} ক্রেডিট", callback_data="account_menu")],
-        [
-            InlineKeyboardButton("✉️ টেম্পোরারি ইমেইল", callback_data="email_menu"),
-            InlineKeyboardButton("📱 টেম্পোরারি নম্বর", callback_data="number_menu")
-        ],
-        [
-            InlineKeyboardButton("💎 프리미엄 ও টপ-আপ", callback_data="premium_menu"),
-            InlineKeyboardButton("🤝 রেফারেল", callback_data="referral_menu")
-        ],
-        [
-            InlineKeyboardButton("📞 সাপোর্ট", callback_data="support_menu"),
-            InlineKeyboardButton("📢 চ্যানেল", url=TELEGRAM_CHANNEL_LINK)
-        ]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+BACK_TO_MAIN_BUTTON = InlineKeyboardButton("↩️ মূল মেন্যুতে ফিরুন", callback_data="main_menu")
+BACK_TO_MAIN_KEYBOARD = InlineKeyboardMarkup([[BACK_TO_MAIN_BUTTON]])
 
-def get_email_control_keyboard(ad_free_refresh=False):
-    """Generates the control keyboard for an active email session."""
-    if ad_free_refresh:
-        # After the ad, the refresh button is ad-free.
-        refresh_button = InlineKeyboardButton("🔄 আবার রিফ্রেশ করুন (Ad-Free)", callback_data="email_proceed_inbox_ad_free")
-    else:
-        # The first time, the refresh button will trigger an ad prompt.
-        refresh_button = InlineKeyboardButton("🔄 ইনবক্স চেক করুন", callback_data="email_inbox_prompt")
+MAIN_MENU_STATIC_ROWS = (
+    (
+        InlineKeyboardButton("✉️ টেম্পোরারি ইমেইল", callback_data="email_menu"),
+        InlineKeyboardButton("📱 টেম্পোরারি নম্বর", callback_data="number_menu")
+    ),
+    (
+        InlineKeyboardButton("💎 프리미엄 ও টপ-আপ", callback_data="premium_menu"),
+        InlineKeyboardButton("🤝 রেফারেল", callback_data="referral_menu")
+    ),
+    (
+        InlineKeyboardButton("📞 সাপোর্ট", callback_data="support_menu"),
+        InlineKeyboardButton("📢 চ্যানেল", url=TELEGRAM_CHANNEL_LINK)
+    ),
+)
+
+# After the ad, the refresh button is ad-free. The first time, it triggers an ad prompt.
+EMAIL_CONTROL_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔄 ইনবক্স চেক করুন", callback_data="email_inbox_prompt")],
+    [InlineKeyboardButton("🗑️ ইমেইলটি মুছুন", callback_data="email_delete_confirm")],
+    [BACK_TO_MAIN_BUTTON]
+])
+EMAIL_CONTROL_KEYBOARD_AD_FREE = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔄 আবার রিফ্রেশ করুন (Ad-Free)", callback_data="email_proceed_inbox_ad_free")],
+    [InlineKeyboardButton("🗑️ ইমেইলটি মুছুন", callback_data="email_delete_confirm")],
+    [BACK_TO_MAIN_BUTTON]
+])
+NO_EMAIL_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("✉️ নতুন ইমেইল তৈরি করুন", callback_data="email_menu")],
+    [BACK_TO_MAIN_BUTTON]
+])
+EMAIL_DELETE_CONFIRM_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("✔️ হ্যাঁ, মুছুন", callback_data="email_delete_confirmed")],
+    [InlineKeyboardButton("❌ না, থাক", callback_data="my_email_inbox")]
+])
 
+@functools.lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def _main_menu_keyboard(balance_text):
+    balance_row = (InlineKeyboardButton(f"💰 আপনার ব্যালেন্স: {balance_text} ক্রেডিট", callback_data="account_menu"),)
+    return InlineKeyboardMarkup((balance_row,) + MAIN_MENU_STATIC_ROWS)
+
+@functools.lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def get_email_menu_keyboard(price_text):
     return InlineKeyboardMarkup([
-        [refresh_button],
-        [InlineKeyboardButton("🗑️ ইমেইলটি মুছুন", callback_data="email_delete_confirm")],
-        [InlineKeyboardButton("↩️ মূল মেন্যুতে ফিরুন", callback_data="main_menu")]
+        [InlineKeyboardButton("👀 বিজ্ঞাপন দেখে করুন (ফ্রি)", callback_data="email_ad_prompt")],
+        [InlineKeyboardButton(f"💳 {price_text} ক্রেডিট খরচ করুন", callback_data="email_pay_generate")],
+        [BACK_TO_MAIN_BUTTON]
     ])
 
+# Short-lived per-user balance cache, so showing the main menu rarely needs a query
+_balance_cache = OrderedDict()  # user_id -> (balance, expires_at)
+
+def remember_balance(user_id, balance):
+    _balance_cache[user_id] = (balance, time.monotonic() + BALANCE_CACHE_TTL_SECONDS)
+    _balance_cache.move_to_end(user_id)
+    if len(_balance_cache) > BALANCE_CACHE_MAX_ENTRIES:
+        _balance_cache.popitem(last=False)
+
+def get_cached_balance(user_id):
+    entry = _balance_cache.get(user_id)
+    if entry is not None and entry[1] > time.monotonic():
+        return entry[0]
+    return None
+
+async def get_main_menu_keyboard(user_id, balance=None):
+    """Returns the main menu keyboard with the user's balance.
+
+    Pass the balance when the handler already has it; otherwise it comes from the
+    balance cache, and the users table is queried only on a miss.
+    """
+    if balance is None:
+        balance = get_cached_balance(user_id)
+    if balance is None:
+        user = await db.get_user(user_id)
+        balance = user['balance'] if user else 0.0
+        remember_balance(user_id, balance)
+        if user:
+            premium.remember(user_id, user['is_premium'], user['premium_expiry'])
+    return _main_menu_keyboard(f"{balance:.2f}")
+
+
+class PremiumEntitlements:
+    """Per-user premium status kept in memory, so ad-free checks rarely need a query.
+
+    A premium user's entry is trusted until their premium_expiry: the expiry is the
+    TTL, and once it passes the user is refetched, which also picks up a renewal.
+    Users who are not premium, or premium without an expiry, are trusted for `ttl`
+    seconds, which bounds how long a grant or revocation made elsewhere goes unseen.
+    """
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # user_id -> (premium_until, valid_until), both time.time() values
+
+    def remember(self, user_id, is_premium, premium_expiry):
+        """Caches a status read from the users table and returns whether premium is active now."""
+        now = time.time()
+        premium_until = 0.0
+        if is_premium:
+            premium_until = premium_expiry.timestamp() if premium_expiry is not None else now + self.ttl
+        valid_until = premium_until if premium_until > now else now + self.ttl
+        self._entries[user_id] = (premium_until, valid_until)
+        self._entries.move_to_end(user_id)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return premium_until > now
+
+    def forget(self, user_id):
+        self._entries.pop(user_id, None)
+
+    async def is_active(self, user_id):
+        """Whether the user's premium is active; queries the users table only on a cache miss."""
+        entry = self._entries.get(user_id)
+        now = time.time()
+        if entry is not None and entry[1] > now:
+            self.hits += 1
+            return entry[0] > now
+        self.misses += 1
+        status = await db.get_premium_status(user_id)
+        return self.remember(user_id, *status) if status else False
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
+
+premium = PremiumEntitlements(PREMIUM_CACHE_TTL_SECONDS, PREMIUM_CACHE_MAX_ENTRIES)
+
+# Message templates; only the placeholders are filled in per render
+EMAIL_MENU_TEXT = (
+    "✉️ *টেম্পোরারি ইমেইল সার্ভিস*\n\n"
+    "আপনি বিজ্ঞাপন দেখে বিনামূল্যে একটি ইমেইল তৈরি করতে পারেন, অথবা বিজ্ঞাপন ছাড়া ব্যবহারের জন্য {price} ক্রেডিট খরচ করতে পারেন।"
+)
+ACTIVE_EMAIL_TEXT = (
+    "📬 আপনার বর্তমান সক্রিয় ইমেইল:\n"
+    "```{email}```\n"
+    "_(কপি করতে উপরের ইমেইলটির উপর একবার ট্যাপ করুন)_\n\n---\n"
+    "*ইনবক্স দেখতে নিচের বাটনে ক্লিক করুন। (শুধুমাত্র প্রথমবার বিজ্ঞাপন দেখতে হবে)*"
+)
+NO_EMAIL_TEXT = "⚠️ আপনার কোনো সক্রিয় ইমেইল নেই।\n\nপ্রথমে একটি নতুন ইমেইল তৈরি করুন।"
+
+def get_email_control_keyboard(ad_free_refresh=False):
+    """Returns the control keyboard for an active email session."""
+    return EMAIL_CONTROL_KEYBOARD_AD_FREE if ad_free_refresh else EMAIL_CONTROL_KEYBOARD
+
 # --- Main Command and Callback Handlers ---
 
+# Set by button_handler for each callback update so the query is answered only once
+_query_answered = contextvars.ContextVar("query_answered", default=None)
+
+async def answer_query(query, text=None, show_alert=False):
+    """Answers a callback query; calls after the first one for the same update are skipped.
+
+    Handlers that need an alert must answer before doing anything else that answers.
+    """
+    answered = _query_answered.get()
+    if answered is not None:
+        if answered[0]:
+            return
+        answered[0] = True
+    await query.answer(text, show_alert=show_alert)
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles the /start command. Registers the user and shows the main menu."""
     user = update.effective_user
@@ -169,11 +892,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # Extract referral code from the start command if it exists (e.g., /start ref_code)
     referral_code = context.args[0] if context.args else None
     
-    # Add user to the database if they don't exist
-    db.add_user_if_not_exists(user.id, user.first_name, referral_code)
+    # Add user to the database if they don't exist (the same round trip returns the balance)
+    balance = await db.add_user_if_not_exists(user.id, user.first_name, referral_code)
+    if balance is not None:
+        remember_balance(user.id, balance)
     
     text = f"👋 *স্বাগতম, {user.first_name}!* \n\nআপনার প্রয়োজনীয় সার্ভিসটি বেছে নিন।"
-    keyboard = get_main_menu_keyboard(user.id)
+    keyboard = await get_main_menu_keyboard(user.id, balance)
     
     # Send message with an image if a URL is provided
     if update.message:
@@ -190,7 +915,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         query = update.callback_query
         try:
             # Edit the existing message to show the main menu
-            await query.answer()
+            await answer_query(query)
             # If the current message has a photo, we need to edit its caption
             if query.message.photo:
                 await query.edit_message_caption(caption=text, reply_markup=keyboard, parse_mode='Markdown')
@@ -198,7 +923,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 await query.edit_message_text(text, reply_markup=keyboard, parse_mode='Markdown')
         except BadRequest as e:
             if "message is not modified" in str(e).lower():
-                # Ignore if the message is already what we want it to be
+                # message_edits skips repeats it knows about; this covers edits sent before a restart
                 pass
             else:
                 logger.error(f"Error editing message to main menu: {e}")
@@ -214,24 +939,28 @@ async def main_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def account_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Displays the user's account details."""
     query = update.callback_query
-    await query.answer()
-    user = db.get_user(query.from_user.id)
+    await answer_query(query)
+    user = await db.get_user(query.from_user.id)
 
     if not user:
         await query.edit_message_text("❌ আপনার তথ্য পাওয়া যায়নি। অনুগ্রহ করে /start চাপুন।")
         return
 
+    remember_balance(user['user_id'], user['balance'])
+    # An expired premium counts as inactive even before the sweeper downgrades the row
+    premium_text = 'নিষ্ক্রিয়'
+    if premium.remember(user['user_id'], user['is_premium'], user['premium_expiry']):
+        premium_text = 'সক্রিয়'
+        if user['premium_expiry'] is not None:
+            premium_text += f" ({user['premium_expiry']:%d-%m-%Y} পর্যন্ত)"
     text = (
         f"👤 *আমার অ্যাকাউন্ট*\n\n"
         f"**নাম:** {user['first_name']}\n"
         f"**ইউজার আইডি:** `{user['user_id']}`\n"
         f"**বর্তমান ব্যালেন্স:** {user['balance']:.2f} ক্রেডিট\n"
-        f"**প্রিমিয়াম স্ট্যাটাস:** {'সক্রিয়' if user['is_premium'] else 'নিষ্ক্রিয়'}"
+        f"**প্রিমিয়াম স্ট্যাটাস:** {premium_text}"
     )
-    keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton("↩️ মূল মেন্যুতে ফিরুন", callback_data="main_menu")]
-    ])
-    await query.edit_message_text(text, reply_markup=keyboard, parse_mode='Markdown')
+    await query.edit_message_text(text, reply_markup=BACK_TO_MAIN_KEYBOARD, parse_mode='Markdown')
 
 
 # ==============================================================================
@@ -245,19 +974,18 @@ async def account_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYP
 # ==============================================================================
 
 # --- Ad System (বিজ্ঞাপন দেখানোর নির্ভরযোগ্য সিস্টেম) ---
-async def show_ad_prompt(query: Update.callback_query, action: str):
-    """Displays an ad prompt and schedules the appearance of the proceed button."""
-    random_ad = random.choice(AD_LINKS) if AD_LINKS else "https://telegram.org"
-    text = (
-        f"⏳ কাজটি সম্পন্ন করতে, অনুগ্রহ করে নিচের বিজ্ঞাপনটি দেখুন।\n\n"
-        f"**{AD_WAIT_SECONDS} সেকেন্ড পর** পরবর্তী ধাপের বাটনটি স্বয়ংক্রিয়ভাবে এখানে চলে আসবে।"
-    )
-    keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("👁️ বিজ্ঞাপন দেখুন (View Ad)", url=random_ad)]])
-    await query.edit_message_text(text, reply_markup=keyboard, parse_mode='Markdown')
+AD_PROMPT_TEXT = (
+    f"⏳ কাজটি সম্পন্ন করতে, অনুগ্রহ করে নিচের বিজ্ঞাপনটি দেখুন।\n\n"
+    f"**{AD_WAIT_SECONDS} সেকেন্ড পর** পরবর্তী ধাপের বাটনটি স্বয়ংক্রিয়ভাবে এখানে চলে আসবে।"
+)
 
-    # Directly wait here (reliable for free hosting)
-    await asyncio.sleep(AD_WAIT_SECONDS)
+@functools.lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def get_ad_prompt_keyboard(ad_url):
+    return InlineKeyboardMarkup([[InlineKeyboardButton("👁️ বিজ্ঞাপন দেখুন (View Ad)", url=ad_url)]])
 
+@functools.lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def get_ad_reveal_keyboard(action, ad_url):
+    """The ad prompt keyboard once the wait is over, with the proceed button for the action."""
     if action == "generate_email":
         callback_data, button_text = "email_proceed_generate", "✅ এখন ইমেইল তৈরি করুন"
         cancel_callback = "email_menu"
@@ -265,208 +993,1696 @@ async def show_ad_prompt(query: Update.callback_query, action: str):
         callback_data, button_text = "email_proceed_inbox_ad_free", "✅ এখন ইনবক্স দেখুন"
         cancel_callback = "my_email_inbox"
 
-    new_keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton("👁️ বিজ্ঞাপন দেখুন (View Ad)", url=random_ad)],
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("👁️ বিজ্ঞাপন দেখুন (View Ad)", url=ad_url)],
         [InlineKeyboardButton(button_text, callback_data=callback_data)],
         [InlineKeyboardButton("↩️ বাতিল করুন", callback_data=cancel_callback)]
     ])
-    try:
-        await query.edit_message_text(text, reply_markup=new_keyboard, parse_mode='Markdown')
-    except BadRequest:
-        logger.warning("Message to edit was not found (likely deleted by user).")
+
+
+class AdRevealScheduler:
+    """Pending 'reveal the proceed button' edits, applied in batches by a repeating job.
+
+    Reveals are kept in a dict ordered by due time (every reveal waits the same
+    AD_WAIT_SECONDS), so each tick only looks at the entries that are actually due.
+    Every reveal is also written to the database so a restart does not lose it.
+
+    A user has at most one pending reveal, and any later update from them drops
+    it (see cancel_pending_ad_reveal): they have moved on from that prompt.
+    """
+
+    def __init__(self):
+        self._pending = {}  # (chat_id, message_id) -> reveal
+        self._by_user = {}  # user_id -> key of their pending reveal
+        self._finished = set()  # keys to delete from the database on the next tick
+
+    async def restore(self):
+        """Reloads this worker's reveals that were pending when the bot last stopped."""
+        for row in await db.load_ad_reveals(WORKER_SHARD_COUNT, WORKER_SHARD_INDEX):
+            key = (row['chat_id'], row['message_id'])
+            self._pending[key] = {
+                'user_id': row['user_id'], 'action': row['action'],
+                'ad_url': row['ad_url'], 'due_at': float(row['due_at']),
+            }
+            self._by_user[row['user_id']] = key
+        if self._pending:
+            logger.info(f"Restored {len(self._pending)} pending ad reveals.")
+
+    async def schedule(self, query, action, ad_url):
+        key = (query.message.chat_id, query.message.message_id)
+        due_at = time.time() + AD_WAIT_SECONDS
+        self.cancel(query.from_user.id)
+        # Re-inserting moves the key to the end, keeping the dict in due order.
+        self._pending.pop(key, None)
+        self._pending[key] = {'user_id': query.from_user.id, 'action': action, 'ad_url': ad_url, 'due_at': due_at}
+        self._by_user[query.from_user.id] = key
+        self._finished.discard(key)
+        try:
+            await db.save_ad_reveal(*key, query.from_user.id, action, ad_url, due_at)
+        except Exception as e:
+            logger.warning(f"Could not persist ad reveal, it will be lost on restart: {e}")
+
+    def cancel(self, user_id):
+        """Drops the user's pending reveal, if they have one."""
+        key = self._by_user.pop(user_id, None)
+        if key is not None and self._pending.pop(key, None) is not None:
+            self._finished.add(key)
+
+    async def tick(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        now = time.time()
+        due = []
+        for key, reveal in self._pending.items():
+            if reveal['due_at'] > now:
+                break
+            due.append((key, reveal))
+        for key, reveal in due:
+            del self._pending[key]
+            if self._by_user.get(reveal['user_id']) == key:
+                del self._by_user[reveal['user_id']]
+            self._finished.add(key)
+
+        if due:
+            await asyncio.gather(*(self._reveal(context.bot, key, reveal) for key, reveal in due))
+        if self._finished:
+            finished, self._finished = list(self._finished), set()
+            try:
+                await db.delete_ad_reveals(finished)
+            except Exception as e:
+                logger.warning(f"Could not delete finished ad reveals: {e}")
+
+    async def _reveal(self, bot, key, reveal):
+        chat_id, message_id = key
+        try:
+            await bot.edit_message_text(
+                AD_PROMPT_TEXT, chat_id=chat_id, message_id=message_id,
+                reply_markup=get_ad_reveal_keyboard(reveal['action'], reveal['ad_url']), parse_mode='Markdown'
+            )
+        except BadRequest:
+            logger.warning("Message to edit was not found (likely deleted by user).")
+        except TelegramError as e:
+            # Blocked by the user or a network failure: this reveal is dropped, the rest of the tick goes on
+            logger.warning(f"Could not reveal the ad button in chat {chat_id}: {e}")
+
+ad_reveal_scheduler = AdRevealScheduler()
+
+
+async def show_ad_prompt(query: Update.callback_query, action: str):
+    """Displays an ad prompt and schedules the appearance of the proceed button."""
+    random_ad = random.choice(AD_LINKS) if AD_LINKS else "https://telegram.org"
+    await query.edit_message_text(AD_PROMPT_TEXT, reply_markup=get_ad_prompt_keyboard(random_ad), parse_mode='Markdown')
+
+    # The button is revealed by ad_reveal_scheduler's next tick after AD_WAIT_SECONDS
+    await ad_reveal_scheduler.schedule(query, action, random_ad)
 
 # --- Email Feature Handlers ---
 async def email_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles the 'Temporary Email' menu."""
     query = update.callback_query
-    await query.answer()
+    await answer_query(query)
     user_id = query.from_user.id
     
     # Check if user already has an email
-    if user_id in user_temp_data and "email" in user_temp_data[user_id]:
+    session = await sessions.get(user_id)
+    if session and "email" in session:
         await my_email_inbox_handler(update, context)
         return
 
-    price = db.get_setting('price_email_credit')
-    text = (
-        f"✉️ *টেম্পোরারি ইমেইল সার্ভিস*\n\n"
-        f"আপনি বিজ্ঞাপন দেখে বিনামূল্যে একটি ইমেইল তৈরি করতে পারেন, অথবা বিজ্ঞাপন ছাড়া ব্যবহারের জন্য {price:.2f} ক্রেডিট খরচ করতে পারেন।"
+    price_text = f"{await db.get_setting('price_email_credit'):.2f}"
+    await query.edit_message_text(
+        EMAIL_MENU_TEXT.format(price=price_text), reply_markup=get_email_menu_keyboard(price_text), parse_mode='Markdown'
     )
-    keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton("👀 বিজ্ঞাপন দেখে করুন (ফ্রি)", callback_data="email_ad_prompt")],
-        [InlineKeyboardButton(f"💳 {price:.2f} ক্রেডিট খরচ করুন", callback_data="email_pay_generate")],
-        [InlineKeyboardButton("↩️ মূল মেন্যুতে ফিরুন", callback_data="main_menu")]
-    ])
-    await query.edit_message_text(text, reply_markup=keyboard, parse_mode='Markdown')
 
 async def my_email_inbox_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Displays the user's current email and inbox controls."""
     query = update.callback_query
     user_id = query.from_user.id
     
-    if user_id in user_temp_data and "email" in user_temp_data[user_id]:
-        email = user_temp_data[user_id]["email"]
-        text = (
-            f"📬 আপনার বর্তমান সক্রিয় ইমেইল:\n"
-            f"```{email}```\n"
-            f"_(কপি করতে উপরের ইমেইলটির উপর একবার ট্যাপ করুন)_\n\n---\n"
-            f"*ইনবক্স দেখতে নিচের বাটনে ক্লিক করুন। (শুধুমাত্র প্রথমবার বিজ্ঞাপন দেখতে হবে)*"
-        )
+    session = await sessions.get(user_id)
+    if session and "email" in session:
+        text = ACTIVE_EMAIL_TEXT.format(email=session["email"])
         await query.edit_message_text(text, reply_markup=get_email_control_keyboard(ad_free_refresh=False), parse_mode='Markdown')
     else:
-        text = "⚠️ আপনার কোনো সক্রিয় ইমেইল নেই।\n\nপ্রথমে একটি নতুন ইমেইল তৈরি করুন।"
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("✉️ নতুন ইমেইল তৈরি করুন", callback_data="email_menu")],
-            [InlineKeyboardButton("↩️ মূল মেন্যুতে ফিরুন", callback_data="main_menu")]
-        ])
-        await query.edit_message_text(text, reply_markup=keyboard, parse_mode='Markdown')
-
-
-async def email_generation_logic(query: Update.callback_query):
-    """The core logic for generating an email."""
-    await query.edit_message_text("⏳ আপনার জন্য একটি নতুন ইমেইল তৈরি করা হচ্ছে...", parse_mode='Markdown')
-    email = await create_email()
-    if email:
-        user_temp_data[query.from_user.id] = {"email": email}
+        await query.edit_message_text(NO_EMAIL_TEXT, reply_markup=NO_EMAIL_KEYBOARD, parse_mode='Markdown')
+
+
+async def email_generation_logic(query: Update.callback_query, price=None):
+    """The core logic for generating an email. If the user paid `price` for it and it fails, the price is refunded."""
+    message_edits.interim(query, "⏳ আপনার জন্য একটি নতুন ইমেইল তৈরি করা হচ্ছে...", parse_mode='Markdown')
+    account = await create_email()
+    if account:
+        email = account["email"]
+        await sessions.set(query.from_user.id, {**account, "seen_ids": []})
+        inbox_watcher.watch(query.from_user.id, account, seen=())
+        await db.activity_log.log('email_created', query.from_user.id, details=account.get("provider"))
         text = (
             f"✅ আপনার নতুন ইমেইল সফলভাবে তৈরি হয়েছে!\n\n"
             f"**আপনার ইমেইল ঠিকানা:**\n```{email}```\n"
             f"_(কপি করতে উপরের ইমেইলটির উপর একবার ট্যাপ করুন)_\n\n---"
         )
-        await query.edit_message_text(text, reply_markup=get_email_control_keyboard(), parse_mode='Markdown')
+        await message_edits.edit(query, text, reply_markup=get_email_control_keyboard(), parse_mode='Markdown')
     else:
         text = "❌ দুঃখিত, এই মুহূর্তে ইমেইল সার্ভিসটিতে সমস্যা চলছে। অনুগ্রহ করে কিছুক্ষণ পর আবার চেষ্টা করুন।"
-        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("↩️ মূল মেন্যুতে ফিরুন", callback_data="main_menu")]])
-        await query.edit_message_text(text, reply_markup=keyboard, parse_mode='Markdown')
+        if price:
+            balance = await db.credit_balance(query.from_user.id, price, 'email_generate_refund')
+            if balance is not None:
+                remember_balance(query.from_user.id, balance)
+                text += "\nআপনার ক্রেডিট ফেরত দেওয়া হয়েছে।"
+        await message_edits.edit(query, text, reply_markup=BACK_TO_MAIN_KEYBOARD, parse_mode='Markdown')
+
+
+def format_email_message(details):
+    """Formats a message for parse_mode='HTML'; every field comes from the sender, so all of it is escaped."""
+    def field(key, default):
+        return html.escape(str(details.get(key) or default))
+
+    return (f"📧 <b>From:</b> {field('from', 'N/A')}\n"
+            f"<b>Subject:</b> {field('subject', 'N/A')}\n"
+            f"<b>Date:</b> {field('date', 'N/A')}\n\n"
+            f"---\n{field('textBody', '...')}")
+
+
+_inbox_fetch_semaphores = weakref.WeakValueDictionary()
+
+def get_inbox_fetch_semaphore(user_id):
+    """Returns the user's fetch semaphore; it is dropped once no inbox check holds it."""
+    semaphore = _inbox_fetch_semaphores.get(user_id)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(INBOX_FETCH_CONCURRENCY_PER_USER)
+        _inbox_fetch_semaphores[user_id] = semaphore
+    return semaphore
+
+
+# --- Inbox Watcher (নতুন মেইল আসলে নিজে থেকেই পাঠিয়ে দেওয়া) ---
+class WatchedMailbox:
+    __slots__ = ("user_id", "account", "email", "seen", "interval", "next_poll_at", "last_activity", "lock")
+
+    def __init__(self, user_id, account, seen, last_activity):
+        self.user_id = user_id
+        self.account = account
+        self.email = account['email']
+        self.seen = seen  # message ids already delivered; None until the first poll sets a baseline
+        self.interval = INBOX_WATCH_MIN_INTERVAL_SECONDS
+        self.next_poll_at = time.monotonic()
+        self.last_activity = last_activity
+        self.lock = asyncio.Lock()
+
+
+class InboxWatcher:
+    """Polls the active mailboxes in the background and sends each new message to its owner once.
+
+    Every mailbox has its own poll interval: it starts at INBOX_WATCH_MIN_INTERVAL_SECONDS,
+    grows by INBOX_WATCH_BACKOFF after each empty poll up to INBOX_WATCH_MAX_INTERVAL_SECONDS,
+    and drops back to the minimum when mail arrives. Intervals are jittered so mailboxes
+    created together do not stay in step. Each tick polls the most overdue mailboxes,
+    at most INBOX_WATCH_POLLS_PER_SECOND on average across all of them.
+
+    The ids of delivered messages are kept per mailbox and stored in the session, so
+    only new messages are fetched, and a restart does not send old mail again. A
+    mailbox with no new mail and no user activity for INBOX_WATCH_IDLE_SECONDS is
+    dropped; opening the inbox again resumes watching it.
+    """
+
+    def __init__(self):
+        self._mailboxes = {}  # user_id -> WatchedMailbox
+        self._polls = set()
+        self._budget = 0.0
+
+    def watch(self, user_id, account, seen=None, idle_for=0.0):
+        """Starts watching a mailbox (or resets its idle timer and poll interval)."""
+        mailbox = self._mailboxes.get(user_id)
+        if mailbox is None or mailbox.email != account['email']:
+            mailbox = self._mailboxes[user_id] = WatchedMailbox(
+                user_id, account, set(seen) if seen is not None else None, time.monotonic() - idle_for
+            )
+        else:
+            mailbox.last_activity = time.monotonic()
+            mailbox.interval = INBOX_WATCH_MIN_INTERVAL_SECONDS
+            mailbox.next_poll_at = min(mailbox.next_poll_at, time.monotonic() + mailbox.interval)
+        return mailbox
+
+    def unwatch(self, user_id, mailbox=None):
+        """Stops watching the user's mailbox; with `mailbox`, only if that one is still the watched one."""
+        if mailbox is None or self._mailboxes.get(user_id) is mailbox:
+            self._mailboxes.pop(user_id, None)
+
+    async def sync(self, context: ContextTypes.DEFAULT_TYPE = None) -> None:
+        """Picks up mailboxes from the session store, including ones created on other workers."""
+        recent = await sessions.recent_mailboxes(INBOX_WATCH_IDLE_SECONDS, WORKER_SHARD_COUNT, WORKER_SHARD_INDEX)
+        for user_id, data, age in recent:
+            mailbox = self._mailboxes.get(user_id)
+            if mailbox is None or mailbox.email != data['email']:
+                self.watch(user_id, mail_account(data), data.get('seen_ids'), idle_for=age)
+
+    async def tick(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        now = time.monotonic()
+        # Token bucket: unused polls carry over, but never more than one second's worth
+        rate = INBOX_WATCH_POLLS_PER_SECOND
+        self._budget = min(self._budget + rate * INBOX_WATCH_TICK_SECONDS, rate * max(INBOX_WATCH_TICK_SECONDS, 1))
+        due = []
+        for user_id, mailbox in list(self._mailboxes.items()):
+            if now - mailbox.last_activity > INBOX_WATCH_IDLE_SECONDS:
+                del self._mailboxes[user_id]
+            elif mailbox.next_poll_at <= now and not mailbox.lock.locked():
+                due.append(mailbox)
+        due.sort(key=lambda mailbox: mailbox.next_poll_at)
+        send_priority.set(SEND_PRIORITY_BULK)  # Inherited by the poll tasks below
+        for mailbox in due[:int(self._budget)]:
+            self._budget -= 1
+            task = asyncio.create_task(self.poll(mailbox, context.bot))
+            self._polls.add(task)
+            task.add_done_callback(self._polls.discard)
+
+    async def poll(self, mailbox, bot):
+        """Checks one mailbox and delivers what is new. Returns (new messages, messages in the inbox) or None on failure."""
+        async with mailbox.lock:
+            new_ids = []
+            try:
+                inbox_messages = await get_inbox(mailbox.account)
+                if inbox_messages is None:
+                    return None
+                listed = [str(msg['id']) for msg in inbox_messages]
+                # A mailbox that predates seen-id tracking starts from what is already there
+                new_ids = [] if mailbox.seen is None else [message_id for message_id in listed if message_id not in mailbox.seen]
+                if new_ids or mailbox.seen is None:
+                    session = await sessions.get(mailbox.user_id)
+                    if not session or session.get("email") != mailbox.email:
+                        # The email was deleted or replaced, possibly on another worker
+                        self.unwatch(mailbox.user_id, mailbox)
+                        return None
+                    if mailbox.seen is None:
+                        mailbox.seen = set(listed)
+                    blocked = False
+                    if new_ids:
+                        blocked = not await self._deliver(mailbox, new_ids, bot)
+                        mailbox.last_activity = time.monotonic()
+                    # Providers drop old mail, so ids no longer listed can be forgotten
+                    seen_ids = [message_id for message_id in listed if message_id in mailbox.seen]
+                    mailbox.seen = set(seen_ids)
+                    # Conditional on the email, so a session replaced or deleted meanwhile is not overwritten
+                    if not await sessions.set_seen_ids(mailbox.user_id, mailbox.email, seen_ids):
+                        self.unwatch(mailbox.user_id, mailbox)
+                        return None
+                    if blocked:
+                        self.unwatch(mailbox.user_id, mailbox)
+                        return None
+                return len(new_ids), len(listed)
+            finally:
+                # Also after a failure, so a mailbox is never due again on the very next tick
+                self._reschedule(mailbox, got_mail=bool(new_ids))
+
+    async def _deliver(self, mailbox, message_ids, bot):
+        """Sends new messages in inbox order, adding each id to mailbox.seen once it has been handled.
+
+        Returns False if the user has blocked the bot. A message Telegram rejects is
+        skipped; any other send error stops here, and the rest is sent on the next poll.
+        """
+        # Fetch every message concurrently, but deliver them in inbox order as they arrive.
+        # The provider client's semaphore caps fetches globally, this one caps them per user.
+        user_semaphore = get_inbox_fetch_semaphore(mailbox.user_id)
+
+        async def fetch_details(message_id):
+            async with user_semaphore:
+                return await get_message_details(mailbox.account, message_id)
+
+        tasks = [asyncio.create_task(fetch_details(message_id)) for message_id in message_ids]
+        try:
+            for message_id, task in zip(message_ids, tasks):
+                details = await task
+                if details:
+                    try:
+                        await bot.send_message(chat_id=mailbox.user_id, text=format_email_message(details), parse_mode='HTML')
+                    except Forbidden:
+                        mailbox.seen.update(message_ids)  # Nothing in this inbox can be delivered any more
+                        return False
+                    except BadRequest as e:
+                        logger.warning(f"Telegram rejected mail {message_id} for user {mailbox.user_id}, skipping it: {e}")
+                    except TelegramError as e:
+                        logger.warning(f"Could not deliver mail {message_id} to user {mailbox.user_id}, retrying on the next poll: {e}")
+                        return True
+                mailbox.seen.add(message_id)
+            return True
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def _reschedule(self, mailbox, got_mail):
+        if got_mail:
+            mailbox.interval = INBOX_WATCH_MIN_INTERVAL_SECONDS
+        else:
+            mailbox.interval = min(mailbox.interval * INBOX_WATCH_BACKOFF, INBOX_WATCH_MAX_INTERVAL_SECONDS)
+        jitter = random.uniform(1 - INBOX_WATCH_JITTER, 1 + INBOX_WATCH_JITTER)
+        mailbox.next_poll_at = time.monotonic() + mailbox.interval * jitter
+
+    async def shutdown(self):
+        polls = list(self._polls)
+        for task in polls:
+            task.cancel()
+        await asyncio.gather(*polls, return_exceptions=True)
+
+    def stats(self):
+        return {'mailboxes': len(self._mailboxes), 'polls_in_flight': len(self._polls)}
+
+inbox_watcher = InboxWatcher()
 
 
 async def inbox_processing_logic(query: Update.callback_query, context: ContextTypes.DEFAULT_TYPE):
     """The core logic for fetching and displaying inbox messages."""
     user_id = query.from_user.id
-    if user_id in user_temp_data and "email" in user_temp_data[user_id]:
-        email = user_temp_data[user_id]['email']
-        await query.edit_message_text(f"⏳ `{email}`-এর ইনবক্স চেক করা হচ্ছে...", parse_mode='Markdown')
-        inbox_messages = await get_inbox(email)
+    session = await sessions.get(user_id)
+    if session and "email" in session:
+        email = session['email']
+        message_edits.interim(query, f"⏳ `{email}`-এর ইনবক্স চেক করা হচ্ছে...", parse_mode='Markdown')
+        # A manual check shares the watcher's seen ids, so only new messages are sent
+        mailbox = inbox_watcher.watch(user_id, mail_account(session), session.get("seen_ids", ()))
+        if mailbox.seen is None:
+            mailbox.seen = set()  # The user asked for the inbox, so nothing counts as read yet
+        counts = await inbox_watcher.poll(mailbox, context.bot)
+        await db.activity_log.log('inbox_checked', user_id, details=f"{counts[0]} new of {counts[1]}" if counts else None)
         
         email_text = (f"📬 আপনার বর্তমান সক্রিয় ইমেইল:\n```{email}```\n"
                       f"_(কপি করতে উপরের ইমেইলটির উপর একবার ট্যাপ করুন)_\n\n---")
         
-        if not inbox_messages:
+        if not counts or not counts[1]:
             final_text = email_text + "\n📭 আপনার ইনবক্স খালি।"
-            await query.edit_message_text(final_text, reply_markup=get_email_control_keyboard(ad_free_refresh=True), parse_mode='Markdown')
+        elif not counts[0]:
+            final_text = email_text + "\n📭 কোনো নতুন মেসেজ নেই। নতুন মেইল আসলে এখানে স্বয়ংক্রিয়ভাবে পাঠানো হবে।"
         else:
-            final_text = email_text + f"\n✅ ইনবক্সে *{len(inbox_messages)}* টি নতুন মেসেজ পাওয়া গেছে। সেগুলো নিচে পাঠানো হলো:"
-            await query.edit_message_text(final_text, reply_markup=get_email_control_keyboard(ad_free_refresh=True), parse_mode='Markdown')
-            for msg in inbox_messages:
-                details = await get_message_details(email, msg['id'])
-                if details:
-                    message_text = (f"📧 **From:** {details.get('from', 'N/A')}\n"
-                                    f"**Subject:** {details.get('subject', 'N/A')}\n"
-                                    f"**Date:** {details.get('date', 'N/A')}\n\n"
-                                    f"---\n{details.get('textBody', '...')}")
-                    await context.bot.send_message(chat_id=user_id, text=message_text, parse_mode='HTML')
+            final_text = email_text + f"\n✅ ইনবক্সে *{counts[0]}* টি নতুন মেসেজ পাওয়া গেছে। সেগুলো নিচে পাঠানো হলো:"
+        await message_edits.edit(query, final_text, reply_markup=get_email_control_keyboard(ad_free_refresh=True), parse_mode='Markdown')
     else:
-        await query.edit_message_text("❌ আপনার কোনো সক্রিয় ইমেইল নেই।", reply_markup=get_main_menu_keyboard(), parse_mode='Markdown')
+        await query.edit_message_text("❌ আপনার কোনো সক্রিয় ইমেইল নেই।", reply_markup=await get_main_menu_keyboard(user_id), parse_mode='Markdown')
+
+# --- SMS Activation Tracker (টেম্পোরারি নম্বরের SMS ট্র্যাকিং) ---
+# Service name -> (SMS-Activate service code, price setting, button label)
+NUMBER_SERVICES = {
+    "facebook": ("fb", "price_number_facebook", "Facebook"),
+    "google": ("go", "price_number_google", "Google"),
+    "other": ("ot", "price_number_other", "অন্যান্য"),
+}
+
+
+class TrackedActivation:
+    __slots__ = ("id", "user_id", "provider_id", "phone_number", "expires_at", "interval", "next_poll_at")
+
+    def __init__(self, activation_id, user_id, provider_id, phone_number, expires_at):
+        self.id = activation_id
+        self.user_id = user_id
+        self.provider_id = provider_id
+        self.phone_number = phone_number
+        self.expires_at = expires_at  # Unix time, since it is stored in the database
+        self.interval = SMS_POLL_MIN_INTERVAL_SECONDS
+        self.next_poll_at = time.monotonic() + self.interval
+
+
+class ActivationTracker:
+    """Watches every open SMS activation on one shared schedule instead of a loop per user.
+
+    Each tick checks the activations that are due. One getActiveActivations call
+    covers all of them, and getStatus is only used for activations missing from it
+    (finished or cancelled at the provider) or when the bulk call fails. Every
+    request goes through sms_client, which keeps them under SMS_API_RATE_PER_SECOND.
+    An activation with no SMS yet is checked again after an interval that grows by
+    SMS_POLL_BACKOFF up to SMS_POLL_MAX_INTERVAL_SECONDS.
+
+    Activations that reach SMS_ACTIVATION_TIMEOUT_SECONDS without a code are
+    cancelled at the provider and refunded. The refund and the status change are
+    one statement, so an activation is refunded at most once. The confirm and
+    cancel setStatus calls run in their own tasks, so they do not hold up polling,
+    and a failure while finishing one activation does not stop the others.
+    """
+
+    def __init__(self):
+        self._activations = {}  # activation id -> TrackedActivation
+        self._round = None
+        self._tasks = set()  # setStatus calls and timeout cancels running outside the round
+        self.bulk_polls = 0
+        self.single_polls = 0
+        self.codes_delivered = 0
+        self.refunds = 0
+
+    async def restore(self):
+        """Resumes tracking this worker's open activations after a restart."""
+        for row in await db.load_open_activations(WORKER_SHARD_COUNT, WORKER_SHARD_INDEX):
+            if row['status'] == 'ordering':
+                # The worker stopped between charging the user and recording a number. A number
+                # it did get is never confirmed, and the provider does not bill one without an SMS
+                if await db.refund_activation(row['id'], 'sms_order_failed'):
+                    self.refunds += 1
+            else:
+                self.track(row['id'], row['user_id'], row['provider_id'], row['phone_number'], float(row['expires_at']))
+        logger.info(f"Tracking {len(self._activations)} open SMS activations.")
+
+    def track(self, activation_id, user_id, provider_id, phone_number, expires_at):
+        self._activations[activation_id] = TrackedActivation(activation_id, user_id, provider_id, phone_number, expires_at)
+
+    def get(self, activation_id):
+        return self._activations.get(activation_id)
+
+    async def tick(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        # A round can outlast the tick when the provider is slow; the next one waits for it
+        if self._activations and (self._round is None or self._round.done()):
+            self._round = asyncio.create_task(self._poll_round(context.bot))
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _guarded(self, coro, activation):
+        """Runs one activation's delivery, refund or cancel, logging its failure instead of raising it."""
+        try:
+            await coro
+        except Exception as e:
+            logger.error(f"Finishing SMS activation {activation.id} failed: {e}")
+            # Track it again; the next round finds out from the provider and the database what is left to do
+            activation.next_poll_at = time.monotonic() + activation.interval
+            self._activations.setdefault(activation.id, activation)
+
+    async def _poll_round(self, bot):
+        try:
+            await self._poll_due(bot)
+        except Exception as e:
+            logger.error(f"SMS poll round failed: {e}")
+
+    async def _poll_due(self, bot):
+        now = time.monotonic()
+        due = [activation for activation in self._activations.values() if activation.next_poll_at <= now]
+        if not due:
+            return
+
+        codes = await get_active_activations() if SMS_BULK_STATUS else None
+        if codes is not None:
+            self.bulk_polls += 1
+            # The bulk answer covers every activation, not only the due ones
+            await asyncio.gather(*(
+                self._guarded(self._deliver_code(activation, codes[activation.provider_id], bot), activation)
+                for activation in list(self._activations.values()) if codes.get(activation.provider_id)
+            ))
+            due = [activation for activation in due if activation.id in self._activations]
+            missing = [activation for activation in due if activation.provider_id not in codes]
+        else:
+            missing = due
+
+        statuses = await asyncio.gather(*(get_sms_status(activation.provider_id) for activation in missing))
+        self.single_polls += len(missing)
+        finished = []
+        for activation, status in zip(missing, statuses):
+            if status.startswith("STATUS_OK:"):
+                finished.append(self._guarded(self._deliver_code(activation, status.split(':', 1)[1], bot), activation))
+            elif status == "STATUS_CANCEL":
+                finished.append(self._guarded(self._close(activation, 'sms_cancelled', bot), activation))
+        await asyncio.gather(*finished)
+
+        for activation in due:
+            if activation.id not in self._activations:
+                continue
+            if activation.expires_at <= time.time():
+                # Not polled again until the cancel has its answer; cancel() reschedules it if refused
+                activation.next_poll_at = float('inf')
+                self._spawn(self._guarded(self.cancel(activation, 'sms_timeout', bot), activation))
+            else:
+                activation.interval = min(activation.interval * SMS_POLL_BACKOFF, SMS_POLL_MAX_INTERVAL_SECONDS)
+                activation.next_poll_at = time.monotonic() + activation.interval
+
+    async def _deliver_code(self, activation, code, bot):
+        self._activations.pop(activation.id, None)
+        if await db.complete_activation(activation.id, code):
+            self.codes_delivered += 1
+            self._spawn(set_activation_status(activation.provider_id, 6))  # Confirms the activation at the provider
+            text = f"📩 `{activation.phone_number}` নম্বরে SMS এসেছে!\n\nআপনার কোড: `{code}`"
+            await self._notify(activation.user_id, text, bot)
+
+    async def _notify(self, user_id, text, bot):
+        try:
+            await bot.send_message(chat_id=user_id, text=text, parse_mode='Markdown')
+        except TelegramError as e:
+            # The code or refund is already stored; a user who blocked the bot just is not told
+            logger.warning(f"Could not notify {user_id} about their SMS activation: {e}")
+
+    async def cancel(self, activation, reason, bot, notify=True):
+        """Cancels the number at the provider, then refunds it. Returns the new balance, or None."""
+        response = await set_activation_status(activation.provider_id, 8)
+        if response not in ("ACCESS_CANCEL", "NO_ACTIVATION"):
+            # Too early to cancel, or a code just arrived: look again on the next round
+            logger.warning(f"SMS Activate would not cancel {activation.provider_id}: {response}")
+            activation.next_poll_at = time.monotonic() + activation.interval
+            return None
+        return await self._close(activation, reason, bot, notify)
+
+    async def _close(self, activation, reason, bot, notify=True):
+        self._activations.pop(activation.id, None)
+        refunded = await db.refund_activation(activation.id, reason)
+        if refunded is None:
+            return None
+        self.refunds += 1
+        user_id, balance = refunded
+        remember_balance(user_id, balance)
+        if not notify:
+            return balance
+        text = (f"⌛ `{activation.phone_number}` নম্বরে কোনো SMS আসেনি, তাই এটি বাতিল করা হয়েছে।\n"
+                f"আপনার ক্রেডিট ফেরত দেওয়া হয়েছে। বর্তমান ব্যালেন্স: {balance:.2f} ক্রেডিট")
+        await self._notify(user_id, text, bot)
+        return balance
+
+    async def shutdown(self):
+        # Open activations stay in the database; restore() on the next start picks them up again
+        tasks = list(self._tasks) + ([self._round] if self._round else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self):
+        return {
+            'open': len(self._activations), 'bulk_polls': self.bulk_polls, 'single_polls': self.single_polls,
+            'codes_delivered': self.codes_delivered, 'refunds': self.refunds,
+        }
+
+activation_tracker = ActivationTracker()
+
+
+@functools.lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def get_number_menu_keyboard(price_texts):
+    rows = [
+        [InlineKeyboardButton(f"📱 {label} — {price_text} ক্রেডিট", callback_data=f"number_buy:{service}")]
+        for (service, (_, _, label)), price_text in zip(NUMBER_SERVICES.items(), price_texts)
+    ]
+    return InlineKeyboardMarkup(rows + [[BACK_TO_MAIN_BUTTON]])
+
+def get_number_cancel_keyboard(activation_id):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("❌ নম্বরটি বাতিল করুন", callback_data=f"number_cancel:{activation_id}")],
+        [BACK_TO_MAIN_BUTTON]
+    ])
 
-# --- Placeholder Handlers for other features ---
 async def number_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
-    await query.answer("এই ফিচারটি শীঘ্রই আসছে!", show_alert=True)
+    await answer_query(query)
+    prices = [await db.get_setting(price_key) for _, price_key, _ in NUMBER_SERVICES.values()]
+    text = (
+        "📱 *টেম্পোরারি নম্বর*\n\n"
+        "কোন সার্ভিসের জন্য নম্বর চান? "
+        f"{SMS_ACTIVATION_TIMEOUT_SECONDS // 60} মিনিটের মধ্যে SMS না আসলে নম্বরটি বাতিল করে ক্রেডিট ফেরত দেওয়া হবে।"
+    )
+    keyboard = get_number_menu_keyboard(tuple(f"{price:.2f}" for price in prices))
+    await query.edit_message_text(text, reply_markup=keyboard, parse_mode='Markdown')
+
+async def number_buy_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, service: str) -> None:
+    """Charges the user, rents a number and hands it to the activation tracker (callback data number_buy:<service>)."""
+    query = update.callback_query
+    user_id = query.from_user.id
+    if service not in NUMBER_SERVICES:
+        return
+    service_code, price_key, _ = NUMBER_SERVICES[service]
+    # The charge and the activation record are written together, before the provider is asked
+    price = await db.get_setting(price_key)
+    ordered = await db.order_activation(user_id, service, price)
+    if ordered is None:
+        await answer_query(query, "❌ আপনার অ্যাকাউন্টে পর্যাপ্ত ক্রেডিট নেই।", show_alert=True)
+        await premium_menu_handler(update, context) # Redirect to top-up
+        return
+    await answer_query(query)
+    activation_id, balance = ordered
+    remember_balance(user_id, balance)
+    await db.activity_log.log('credits_spent', user_id, details=f"{price} sms_number:{service}")
+    await query.edit_message_text("⏳ আপনার জন্য একটি নম্বর নেওয়া হচ্ছে...")
 
+    result = await get_number(service_code)
+    expires_at = time.time() + SMS_ACTIVATION_TIMEOUT_SECONDS
+    started = False
+    if result.get('status') == 'success':
+        try:
+            started = await db.start_activation(activation_id, result['id'], result['number'], expires_at)
+        except Exception as e:
+            logger.error(f"Recording SMS activation {activation_id} failed: {e}")
+        if not started:
+            # Nothing would ever poll or cancel a number that is not on record, so give it back now
+            await set_activation_status(result['id'], 8)
+    if not started:
+        refunded = await db.refund_activation(activation_id, 'sms_order_failed')
+        if refunded:
+            remember_balance(user_id, refunded[1])
+        text = "❌ দুঃখিত, এই মুহূর্তে কোনো নম্বর পাওয়া যাচ্ছে না। আপনার ক্রেডিট ফেরত দেওয়া হয়েছে।"
+        await query.edit_message_text(text, reply_markup=BACK_TO_MAIN_KEYBOARD)
+        return
+
+    activation_tracker.track(activation_id, user_id, result['id'], result['number'], expires_at)
+    text = (
+        f"✅ আপনার নম্বর:\n```+{result['number']}```\n"
+        f"SMS আসলে কোডটি এখানে স্বয়ংক্রিয়ভাবে পাঠানো হবে। "
+        f"{SMS_ACTIVATION_TIMEOUT_SECONDS // 60} মিনিটের মধ্যে না আসলে ক্রেডিট ফেরত পাবেন।"
+    )
+    await query.edit_message_text(text, reply_markup=get_number_cancel_keyboard(activation_id), parse_mode='Markdown')
+
+async def number_cancel_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, activation_id: str) -> None:
+    """Cancels a rented number before its code arrives (callback data number_cancel:<id>)."""
+    query = update.callback_query
+    activation = activation_tracker.get(int(activation_id)) if activation_id.isdigit() else None
+    if activation is None or activation.user_id != query.from_user.id:
+        await answer_query(query, "এই নম্বরটি আর সক্রিয় নেই।", show_alert=True)
+        return
+    balance = await activation_tracker.cancel(activation, 'sms_user_cancel', context.bot, notify=False)
+    if balance is None:
+        await answer_query(query, "⏳ নম্বরটি এখনই বাতিল করা যাচ্ছে না। একটু পরে আবার চেষ্টা করুন।", show_alert=True)
+        return
+    await answer_query(query)
+    await query.edit_message_text("🗑️ নম্বরটি বাতিল করা হয়েছে।", reply_markup=await get_main_menu_keyboard(query.from_user.id, balance))
+
+
+# --- Placeholder Handlers for other features ---
 async def premium_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
-    await query.answer("এই ফিচারটি শীঘ্রই আসছে!", show_alert=True)
+    await answer_query(query, "এই ফিচারটি শীঘ্রই আসছে!", show_alert=True)
 
 async def referral_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
-    await query.answer("এই ফিচারটি শীঘ্রই আসছে!", show_alert=True)
+    await answer_query(query, "এই ফিচারটি শীঘ্রই আসছে!", show_alert=True)
     
 async def support_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
-    await query.answer("এই ফিচারটি শীঘ্রই আসছে!", show_alert=True)
+    await answer_query(query, "এই ফিচারটি শীঘ্রই আসছে!", show_alert=True)
 
 
-# --- Universal Button Handler ---
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """The main router for all callback queries."""
+# --- Callback Actions ---
+async def email_ad_prompt_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Premium users skip the ad; the status comes from the premium cache
+    if await premium.is_active(update.callback_query.from_user.id):
+        await email_proceed_generate_handler(update, context)
+        return
+    await show_ad_prompt(update.callback_query, "generate_email")
+
+async def email_proceed_generate_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await answer_query(query)
+    await email_generation_logic(query)
+
+async def email_pay_generate_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    price = await db.get_setting('price_email_credit')
+    # The balance check and the deduction happen in one atomic statement
+    new_balance = await db.debit_balance(query.from_user.id, price, 'email_generate')
+    if new_balance is not None:
+        remember_balance(query.from_user.id, new_balance)
+        await db.activity_log.log('credits_spent', query.from_user.id, details=f"{price} email_generate")
+        await answer_query(query)
+        await email_generation_logic(query, price)
+    else:
+        await answer_query(query, "❌ আপনার অ্যাকাউন্টে পর্যাপ্ত ক্রেডিট নেই।", show_alert=True)
+        await premium_menu_handler(update, context) # Redirect to top-up
+
+async def email_inbox_prompt_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if await premium.is_active(update.callback_query.from_user.id):
+        await email_proceed_inbox_handler(update, context)
+        return
+    await show_ad_prompt(update.callback_query, "check_inbox")
+
+async def email_proceed_inbox_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await answer_query(query)
+    await inbox_processing_logic(query, context)
+
+async def email_delete_confirm_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    text = "🤔 আপনি কি সত্যিই আপনার বর্তমান ইমেইলটি মুছে ফেলতে চান?"
+    await query.edit_message_text(text, reply_markup=EMAIL_DELETE_CONFIRM_KEYBOARD)
+
+async def email_delete_confirmed_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
-    await query.answer()
     user_id = query.from_user.id
-    data = query.data
+    await sessions.delete(user_id)
+    inbox_watcher.unwatch(user_id)
+    text = "🗑️ আপনার ইমেইল সফলভাবে মুছে ফেলা হয়েছে।"
+    await query.edit_message_text(text, reply_markup=await get_main_menu_keyboard(user_id), parse_mode='Markdown')
+
 
+# --- Universal Button Handler ---
+# callback_data is "<route>" or "<route>:<argument>"; the argument is passed to the handler.
+CALLBACK_ROUTES = {
     # Main Navigation
-    if data == "main_menu":
-        await start(update, context)
-    elif data == "account_menu":
-        await account_menu_handler(update, context)
-    
+    "main_menu": main_menu_handler,
+    "account_menu": account_menu_handler,
+
     # Placeholder Menus
-    elif data == "number_menu":
-        await number_menu_handler(update, context)
-    elif data == "premium_menu":
-        await premium_menu_handler(update, context)
-    elif data == "referral_menu":
-        await referral_menu_handler(update, context)
-    elif data == "support_menu":
-        await support_menu_handler(update, context)
+    "premium_menu": premium_menu_handler,
+    "referral_menu": referral_menu_handler,
+    "support_menu": support_menu_handler,
+
+    # Temporary Numbers
+    "number_menu": number_menu_handler,
+    "number_buy": number_buy_handler,
+    "number_cancel": number_cancel_handler,
 
     # Email Menu Navigation
-    elif data == "email_menu":
-        await email_menu_handler(update, context)
-    elif data == "my_email_inbox":
-        await my_email_inbox_handler(update, context)
+    "email_menu": email_menu_handler,
+    "my_email_inbox": my_email_inbox_handler,
 
     # Email Actions (Ad-based and Credit-based)
-    elif data == "email_ad_prompt":
-        await show_ad_prompt(query, "generate_email")
-    elif data == "email_proceed_generate":
-        await email_generation_logic(query)
-    elif data == "email_pay_generate":
-        user = db.get_user(user_id)
-        price = db.get_setting('price_email_credit')
-        if user and user['balance'] >= price:
-            db.update_balance(user_id, -price)
-            await email_generation_logic(query)
-        else:
-            await query.answer("❌ আপনার অ্যাকাউন্টে পর্যাপ্ত ক্রেডিট নেই।", show_alert=True)
-            await premium_menu_handler(update, context) # Redirect to top-up
+    "email_ad_prompt": email_ad_prompt_handler,
+    "email_proceed_generate": email_proceed_generate_handler,
+    "email_pay_generate": email_pay_generate_handler,
 
     # Inbox Actions
-    elif data == "email_inbox_prompt":
-        await show_ad_prompt(query, "check_inbox")
-    elif data == "email_proceed_inbox_ad_free":
-        await inbox_processing_logic(query, context)
+    "email_inbox_prompt": email_inbox_prompt_handler,
+    "email_proceed_inbox_ad_free": email_proceed_inbox_handler,
 
     # Email Deletion
-    elif data == "email_delete_confirm":
-        text = "🤔 আপনি কি সত্যিই আপনার বর্তমান ইমেইলটি মুছে ফেলতে চান?"
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("✔️ হ্যাঁ, মুছুন", callback_data="email_delete_confirmed")],
-            [InlineKeyboardButton("❌ না, থাক", callback_data="my_email_inbox")]
-        ])
-        await query.edit_message_text(text, reply_markup=keyboard)
-    elif data == "email_delete_confirmed":
-        if user_id in user_temp_data:
-            del user_temp_data[user_id]
-        text = "🗑️ আপনার ইমেইল সফলভাবে মুছে ফেলা হয়েছে।"
-        await query.edit_message_text(text, reply_markup=get_main_menu_keyboard(user_id), parse_mode='Markdown')
+    "email_delete_confirm": email_delete_confirm_handler,
+    "email_delete_confirmed": email_delete_confirmed_handler,
+}
+
+async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """The main router for all callback queries: one dict lookup, and the query is answered exactly once."""
+    query = update.callback_query
+    answered = [False]
+    _query_answered.set(answered)
+
+    route, _, argument = query.data.partition(':')
+    handler = CALLBACK_ROUTES.get(route)
+    started = time.perf_counter()
+    try:
+        if handler is None:
+            logger.warning(f"No route for callback data: {query.data}")
+        elif argument:
+            await handler(update, context, argument)
+        else:
+            await handler(update, context)
+    finally:
+        # Stop the button's loading spinner if the handler did not answer itself
+        if not answered[0]:
+            await answer_query(query)
+        metrics.observe("bot_callback_seconds", route if handler is not None else "unknown", time.perf_counter() - started)
+
+
+async def purge_expired_sessions(context: ContextTypes.DEFAULT_TYPE) -> None:
+    removed = await sessions.purge_expired()
+    if removed:
+        logger.info(f"Purged {removed} expired sessions.")
+
+
+async def maintain_partitions(context: ContextTypes.DEFAULT_TYPE) -> None:
+    await db.maintain_activity_log_partitions()
+
+
+async def expire_premium(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Downgrades users whose premium has run out, PREMIUM_SWEEP_BATCH rows per statement."""
+    expired = 0
+    while True:
+        user_ids = await db.expire_premium(PREMIUM_SWEEP_BATCH)
+        for user_id in user_ids:
+            premium.forget(user_id)
+        expired += len(user_ids)
+        if len(user_ids) < PREMIUM_SWEEP_BATCH:
+            break
+    if expired:
+        logger.info(f"Premium expired for {expired} users.")
+
+
+first_update_seen = False
+
+async def cancel_pending_ad_reveal(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Any update from a user means they have moved on from their pending ad reveal (runs before the handlers)."""
+    if update.effective_user is not None:
+        ad_reveal_scheduler.cancel(update.effective_user.id)
+
+
+async def log_cold_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Logs how long after launch the first update arrived (runs before every other handler)."""
+    global first_update_seen
+    if not first_update_seen:
+        first_update_seen = True
+        logger.info(f"Cold start: first update reached the handlers {time.monotonic() - PROCESS_STARTED_AT:.2f}s after launch.")
+
+
+async def post_init(application: Application) -> None:
+    """Waits for the database bootstrap, restores pending ad reveals and open SMS activations, and starts the metrics endpoint and the periodic background jobs."""
+    # The bootstrap was started in main() and has been running alongside getMe
+    await asyncio.wrap_future(db.start_bootstrap())
+    logger.info(f"Database ready {time.monotonic() - PROCESS_STARTED_AT:.2f}s after launch.")
+    start_metrics_server()
+    await ad_reveal_scheduler.restore()
+    application.job_queue.run_repeating(ad_reveal_scheduler.tick, interval=AD_REVEAL_TICK_SECONDS, first=AD_REVEAL_TICK_SECONDS)
+    application.job_queue.run_repeating(purge_expired_sessions, interval=SESSION_PURGE_INTERVAL_SECONDS)
+    application.job_queue.run_repeating(inbox_watcher.sync, interval=INBOX_WATCH_SYNC_SECONDS, first=0)
+    await activation_tracker.restore()
+    application.job_queue.run_repeating(activation_tracker.tick, interval=SMS_POLL_TICK_SECONDS, first=SMS_POLL_TICK_SECONDS)
+    application.job_queue.run_repeating(inbox_watcher.tick, interval=INBOX_WATCH_TICK_SECONDS, first=INBOX_WATCH_TICK_SECONDS)
+    application.job_queue.run_repeating(maintain_partitions, interval=24 * 60 * 60)
+    application.job_queue.run_repeating(expire_premium, interval=PREMIUM_SWEEP_SECONDS, first=0)
+    application.job_queue.run_repeating(broadcast_engine.resume, interval=BROADCAST_RESUME_SECONDS, first=0)
+    application.job_queue.run_repeating(log_update_metrics, interval=UPDATE_METRICS_LOG_SECONDS)
+
+
+async def post_stop(application: Application) -> None:
+    """Stops the background work that sends through the bot while the bot can still send: checkpoints running broadcasts and cancels inbox polls and SMS tracker tasks."""
+    await broadcast_engine.shutdown()
+    await inbox_watcher.shutdown()
+    await activation_tracker.shutdown()
+
+async def post_shutdown(application: Application) -> None:
+    """Writes buffered activity_log rows, then releases the pooled database connections and upstream HTTP sessions."""
+    await db.activity_log.close()
+    await mail_service.aclose()
+    await sms_client.aclose()
+    logger.info(f"Settings cache stats: {db.settings_cache.stats()}")
+    db.close_pool()
+
+
+# --- Outbound Rate Limiting (টেলিগ্রামে মেসেজ পাঠানোর গতি নিয়ন্ত্রণ) ---
+SEND_PRIORITY_INTERACTIVE = 0
+SEND_PRIORITY_BULK = 1
+# Background senders (inbox watcher, broadcasts) set this so replies to taps go first
+send_priority = contextvars.ContextVar("send_priority", default=SEND_PRIORITY_INTERACTIVE)
+
+class _PendingEdit:
+    __slots__ = ("result", "turn", "sending", "superseded")
+
+    def __init__(self, loop):
+        self.result = loop.create_future()
+        self.turn = None
+        self.sending = False
+        self.superseded = False
+
+
+def _copy_future(target, source):
+    if target.done():
+        return
+    if source.cancelled():
+        target.cancel()
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+class _InterimEdit:
+    __slots__ = ("task", "sending")
+
+    def __init__(self):
+        self.task = None
+        self.sending = False
+
+
+class MessageEditBuffer:
+    """Saves edit_message_text calls that would not change what the user sees.
+
+    Handlers show a progress state with interim() and the outcome with edit().
+    The interim edit is held back for `interim_deadline` seconds and dropped if
+    the final edit arrives first, so a quick action costs one API call, not two.
+
+    The buffer also remembers the last content sent to each message (up to
+    `max_messages` messages). OutboundRateLimiter asks it before sending any
+    edit, and an edit that would leave the message unchanged is skipped instead
+    of failing with "message is not modified".
+    """
+
+    def __init__(self, interim_deadline, max_messages):
+        self.interim_deadline = interim_deadline
+        self.max_messages = max_messages
+        self._interim = {}  # (chat_id, message_id) -> _InterimEdit
+        self._last_sent = OrderedDict()  # (chat_id, message_id, inline_message_id) -> (endpoint, data)
+        self.interim_skipped = 0
+        self.unchanged = 0
+
+    def interim(self, query, text, **kwargs):
+        """Schedules a progress edit of the query's message; edit() for the same message cancels it."""
+        key = (query.message.chat_id, query.message.message_id)
+        self._cancel_interim(key)
+        pending = self._interim[key] = _InterimEdit()
+        pending.task = asyncio.create_task(self._send_interim(key, pending, query, text, kwargs))
+
+    async def _send_interim(self, key, pending, query, text, kwargs):
+        await asyncio.sleep(self.interim_deadline)
+        pending.sending = True
+        try:
+            await query.edit_message_text(text, **kwargs)
+        except BadRequest as e:
+            logger.warning(f"Could not show progress message: {e}")
+        finally:
+            if self._interim.get(key) is pending:
+                del self._interim[key]
+
+    def _cancel_interim(self, key):
+        pending = self._interim.get(key)
+        if pending is not None and not pending.sending:
+            del self._interim[key]
+            pending.task.cancel()
+            self.interim_skipped += 1
+            return None
+        return pending
+
+    async def edit(self, query, text, **kwargs):
+        """Edits the query's message, replacing a pending interim edit or waiting for one already on its way."""
+        pending = self._cancel_interim((query.message.chat_id, query.message.message_id))
+        if pending is not None:
+            await asyncio.wait([pending.task])  # So the final text is the one that lands last
+        return await query.edit_message_text(text, **kwargs)
+
+    def is_unchanged(self, endpoint, data):
+        key = (data.get("chat_id"), data.get("message_id"), data.get("inline_message_id"))
+        if self._last_sent.get(key) == (endpoint, data):
+            self.unchanged += 1
+            return True
+        return False
+
+    def record(self, endpoint, data):
+        key = (data.get("chat_id"), data.get("message_id"), data.get("inline_message_id"))
+        self._last_sent[key] = (endpoint, dict(data))
+        self._last_sent.move_to_end(key)
+        if len(self._last_sent) > self.max_messages:
+            self._last_sent.popitem(last=False)
+
+    def stats(self):
+        return {
+            'interim_skipped': self.interim_skipped, 'unchanged': self.unchanged,
+            'saved': self.interim_skipped + self.unchanged, 'interim_pending': len(self._interim),
+        }
+
+message_edits = MessageEditBuffer(EDIT_INTERIM_DEADLINE_SECONDS, EDIT_BUFFER_MAX_MESSAGES)
+
+
+class OutboundRateLimiter(BaseRateLimiter):
+    """Keeps the bot's outgoing messages under Telegram's global and per-chat flood limits.
+
+    Requests that send or edit messages first wait for their chat's token bucket
+    (TELEGRAM_PER_CHAT_RATE, or TELEGRAM_GROUP_RATE for groups) and then for a
+    global token (TELEGRAM_GLOBAL_RATE). Global tokens go to waiting interactive
+    requests before bulk ones, see send_priority. Other calls, such as answering
+    callback queries, are not limited.
+
+    An edit that is still waiting when a newer edit of the same message arrives
+    is dropped, and its caller gets the newer edit's result. A RetryAfter from
+    Telegram pauses all sending for the time it asks for, then the request waits
+    for a new turn and is retried, up to TELEGRAM_MAX_RETRIES times.
+
+    With an `edit_buffer`, edits that would not change the message are answered
+    without calling Telegram (see MessageEditBuffer).
+    """
+
+    def __init__(self, global_rate, per_chat_rate, per_chat_burst, group_rate, max_retries, edit_buffer=None, global_burst=1):
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.edit_buffer = edit_buffer
+        self._global = RateLimiter(global_rate, burst=global_burst)
+        self._chats = OrderedDict()  # chat_id -> RateLimiter, least recently used first
+        self._waiting = []  # heap of (priority, sequence, turn future)
+        self._sequence = 0
+        self._wakeup = asyncio.Event()
+        self._paused_until = 0.0
+        self._pending_edits = {}  # (endpoint, chat_id, message_id, inline_message_id) -> _PendingEdit
+        self._dispatcher = None
+        self.sent = 0
+        self.coalesced = 0
+        self.retry_afters = 0
+
+    async def initialize(self) -> None:
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if chat_id < 0:
+                bucket = RateLimiter(self.group_rate)
+            else:
+                bucket = RateLimiter(self.per_chat_rate, burst=self.per_chat_burst)
+            self._chats[chat_id] = bucket
+            if len(self._chats) > TELEGRAM_CHAT_BUCKETS_MAX:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def _dispatch(self):
+        # Hands out global tokens, lowest priority number first, then first come first served
+        while True:
+            while not self._waiting:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            await self._global.acquire()
+            while self._waiting:
+                _, _, turn = heapq.heappop(self._waiting)
+                if not turn.done():
+                    turn.set_result(True)
+                    break
+
+    async def _wait_turn(self, chat_id, priority, edit):
+        """Waits for the chat's and then a global token. Returns False if the edit was superseded meanwhile."""
+        if isinstance(chat_id, int):
+            await self._chat_bucket(chat_id).acquire()
+        if edit is not None and edit.superseded:
+            return False
+        turn = asyncio.get_running_loop().create_future()
+        if edit is not None:
+            edit.turn = turn
+        self._sequence += 1
+        heapq.heappush(self._waiting, (priority, self._sequence, turn))
+        self._wakeup.set()
+        return await turn
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if not endpoint.startswith(("send", "edit", "copy", "forward")):
+            started = time.perf_counter()
+            try:
+                return await callback(*args, **kwargs)
+            finally:
+                metrics.observe("bot_telegram_seconds", endpoint, time.perf_counter() - started)
+
+        edit = key = None
+        if endpoint.startswith("edit"):
+            key = (endpoint, data.get("chat_id"), data.get("message_id"), data.get("inline_message_id"))
+            previous = self._pending_edits.get(key)
+            if previous is None and self.edit_buffer is not None and self.edit_buffer.is_unchanged(endpoint, data):
+                return True  # What Telegram answers for an edit it does not return the message for
+            edit = _PendingEdit(asyncio.get_running_loop())
+            self._pending_edits[key] = edit
+            if previous is not None and not previous.sending:
+                previous.superseded = True
+                if previous.turn is not None and not previous.turn.done():
+                    previous.turn.set_result(False)
+                edit.result.add_done_callback(functools.partial(_copy_future, previous.result))
+
+        try:
+            if not await self._wait_turn(data.get("chat_id"), send_priority.get(), edit):
+                self.coalesced += 1
+                return await edit.result
+            if edit is not None:
+                edit.sending = True
+            result = await self._call(callback, args, kwargs, endpoint, data.get("chat_id"))
+        except BaseException as e:
+            if edit is not None and not edit.result.done():
+                if isinstance(e, asyncio.CancelledError):
+                    edit.result.cancel()
+                else:
+                    edit.result.set_exception(e)
+                    edit.result.exception()  # Only callers of superseded edits need it
+            raise
+        finally:
+            if key is not None and self._pending_edits.get(key) is edit:
+                del self._pending_edits[key]
+        if edit is not None:
+            if self.edit_buffer is not None:
+                self.edit_buffer.record(endpoint, data)
+            if not edit.result.done():
+                edit.result.set_result(result)
+        return result
+
+    async def _call(self, callback, args, kwargs, endpoint, chat_id):
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                # A retry is another request as far as the flood limits go
+                await self._wait_turn(chat_id, send_priority.get(), None)
+            started = time.perf_counter()
+            try:
+                result = await callback(*args, **kwargs)
+                self.sent += 1
+                return result
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                retry_after = e.retry_after
+                delay = retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+                self.retry_afters += 1
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                logger.warning(f"Telegram flood limit hit, pausing sends for {delay:.1f}s.")
+                await asyncio.sleep(delay)
+            finally:
+                metrics.observe("bot_telegram_seconds", endpoint, time.perf_counter() - started)
+
+    def stats(self):
+        return {
+            'sent': self.sent, 'coalesced': self.coalesced, 'retry_afters': self.retry_afters,
+            'waiting': len(self._waiting), 'chats': len(self._chats),
+        }
+
+outbound_limiter = OutboundRateLimiter(
+    TELEGRAM_GLOBAL_RATE, TELEGRAM_PER_CHAT_RATE, TELEGRAM_PER_CHAT_BURST, TELEGRAM_GROUP_RATE, TELEGRAM_MAX_RETRIES,
+    edit_buffer=message_edits, global_burst=TELEGRAM_GLOBAL_BURST,
+)
+
+
+# --- Broadcasts (স্টাফদের পক্ষ থেকে সব ইউজারকে মেসেজ পাঠানো) ---
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+class BroadcastProgress:
+    """Counters and the resume point of one running broadcast.
+
+    Recipients are handled out of order by the senders, so the resume point is
+    the highest user_id below which every recipient has been handled. At most
+    BROADCAST_IN_FLIGHT recipients can be read past it.
+    """
+
+    def __init__(self, row, in_flight):
+        self.id = row['id']
+        self.created_by = row['created_by']
+        self.text = row['text']
+        self.premium_only = row['premium_only']
+        self.last_user_id = row['last_user_id']
+        self.sent = row['sent']
+        self.failed = row['failed']
+        self.blocked = row['blocked']
+        self.blocked_user_ids = []  # Marked in the database at the next checkpoint
+        self.checkpoint_lock = asyncio.Lock()  # Keeps checkpoints in order, so an older one never lands last
+        self.checkpoint_wanted = asyncio.Event()  # Set once BROADCAST_BLOCKED_BATCH blocked users are waiting
+        self._outstanding = deque()  # [user_id, outcome or None] in recipient order
+        self._slots = asyncio.Semaphore(in_flight)
+
+    async def begin(self, user_id):
+        await self._slots.acquire()
+        entry = [user_id, None]
+        self._outstanding.append(entry)
+        return entry
+
+    def handled(self, entry, outcome):
+        # Outcomes are counted as the resume point passes them, so a resumed broadcast counts nobody twice
+        entry[1] = outcome
+        while self._outstanding and self._outstanding[0][1] is not None:
+            user_id, outcome = self._outstanding.popleft()
+            self._slots.release()
+            self.last_user_id = user_id
+            if outcome == 'sent':
+                self.sent += 1
+            elif outcome == 'blocked':
+                self.blocked += 1
+                self.blocked_user_ids.append(user_id)
+                if len(self.blocked_user_ids) >= BROADCAST_BLOCKED_BATCH:
+                    self.checkpoint_wanted.set()
+            else:
+                self.failed += 1
+
+
+class BroadcastEngine:
+    """Sends staff broadcasts to every user with constant memory, and resumes them after a crash.
+
+    Recipients stream from the users table through a server-side cursor
+    (db.BroadcastRecipients) into a queue drained by BROADCAST_SENDERS senders.
+    Sends are bulk priority, so OutboundRateLimiter keeps them under Telegram's
+    limits and lets replies to taps go first.
+
+    Every BROADCAST_CHECKPOINT_SECONDS a heartbeat task saves the resume point
+    and counters, marks the users found to have blocked the bot in one UPDATE and
+    renews this worker's lease on the broadcast. It runs for the whole broadcast,
+    also while the feeder waits for free slots, the senders sit out a RetryAfter
+    or the last messages are draining. If the worker dies, the lease
+    runs out and the next resume() on any worker continues from the checkpoint,
+    so users handled after the last checkpoint may get the message twice.
+    """
+
+    def __init__(self):
+        self._running = {}  # broadcast id -> task
+
+    async def start(self, staff_id, text, premium_only, bot):
+        row = await db.create_broadcast(staff_id, text, premium_only, WORKER_ID, BROADCAST_LEASE_SECONDS)
+        self._launch(row, bot)
+        return row['id']
+
+    async def resume(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Takes over broadcasts whose worker stopped renewing its lease."""
+        for row in await db.claim_broadcasts(WORKER_ID, BROADCAST_LEASE_SECONDS):
+            logger.info(f"Resuming broadcast {row['id']} after user {row['last_user_id']}.")
+            self._launch(row, context.bot)
+
+    def _launch(self, row, bot):
+        task = asyncio.create_task(self._run(BroadcastProgress(row, BROADCAST_IN_FLIGHT), bot))
+        self._running[row['id']] = task
+        task.add_done_callback(lambda _: self._running.pop(row['id'], None))
+
+    async def _run(self, progress, bot):
+        send_priority.set(SEND_PRIORITY_BULK)
+        recipients = db.BroadcastRecipients(progress.last_user_id, progress.premium_only, BROADCAST_BATCH_SIZE, BROADCAST_CURSOR_WINDOW)
+        queue = asyncio.Queue()  # Bounded by BROADCAST_IN_FLIGHT through progress.begin()
+        senders = [asyncio.create_task(self._sender(queue, progress, bot)) for _ in range(BROADCAST_SENDERS)]
+        feeder = asyncio.create_task(self._feed(recipients, queue, progress))
+        heartbeat = asyncio.create_task(self._heartbeat(progress))
+        try:
+            # The heartbeat only returns once the broadcast is cancelled or taken over
+            await asyncio.wait((feeder, heartbeat), return_when=asyncio.FIRST_COMPLETED)
+            heartbeat.cancel()
+            if heartbeat.done() and not heartbeat.cancelled():
+                status = heartbeat.result()
+            else:
+                feeder.result()
+                status = await self._checkpoint(progress)
+                if status == 'running' and await db.finish_broadcast(progress.id):
+                    status = 'done'
+        except asyncio.CancelledError:
+            # Shutting down: save what was done and free the broadcast for the next worker
+            heartbeat.cancel()
+            await self._checkpoint(progress, lease_seconds=0)
+            raise
+        except Exception as e:
+            # The lease runs out and resume() picks the broadcast up again from its last checkpoint
+            logger.error(f"Broadcast {progress.id} stopped: {e}")
+            return
+        finally:
+            heartbeat.cancel()
+            feeder.cancel()
+            for sender in senders:
+                sender.cancel()
+            await recipients.close()
+
+        if status is None:
+            logger.warning(f"Broadcast {progress.id} was taken over by another worker.")
+            return
+        logger.info(f"Broadcast {progress.id} {status}: {progress.sent} sent, {progress.blocked} blocked, {progress.failed} failed.")
+        text = (f"📢 ব্রডকাস্ট #{progress.id} {'শেষ হয়েছে' if status == 'done' else 'বাতিল হয়েছে'}।\n\n"
+                f"পাঠানো হয়েছে: {progress.sent}\nব্লক করেছে: {progress.blocked}\nব্যর্থ: {progress.failed}")
+        send_priority.set(SEND_PRIORITY_INTERACTIVE)
+        try:
+            await bot.send_message(chat_id=progress.created_by, text=text)
+        except TelegramError as e:
+            logger.warning(f"Could not report broadcast {progress.id} to its creator: {e}")
+
+    async def _feed(self, recipients, queue, progress):
+        """Queues every recipient, then waits until the senders have handled them all."""
+        while True:
+            user_ids = await recipients.next_batch()
+            if not user_ids:
+                break
+            for user_id in user_ids:
+                queue.put_nowait(await progress.begin(user_id))
+        await queue.join()
+
+    async def _heartbeat(self, progress):
+        """Checkpoints while the broadcast runs. Returns its status once it is no longer 'running'."""
+        while True:
+            try:
+                await asyncio.wait_for(progress.checkpoint_wanted.wait(), BROADCAST_CHECKPOINT_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            # Shielded, so a run cancelled mid-checkpoint still lets it finish before its own
+            status = await asyncio.shield(self._checkpoint(progress))
+            if status != 'running':
+                return status
+
+    async def _sender(self, queue, progress, bot):
+        while True:
+            entry = await queue.get()
+            try:
+                await bot.send_message(chat_id=entry[0], text=progress.text)
+                outcome = 'sent'
+            except Forbidden:
+                outcome = 'blocked'
+            except BadRequest as e:
+                outcome = 'blocked' if "chat not found" in str(e).lower() else 'failed'
+            except Exception as e:
+                logger.warning(f"Broadcast {progress.id} could not reach {entry[0]}: {e}")
+                outcome = 'failed'
+            progress.handled(entry, outcome)
+            queue.task_done()
+
+    async def _checkpoint(self, progress, lease_seconds=BROADCAST_LEASE_SECONDS):
+        """Saves progress; returns the broadcast's status, or None if this worker lost it."""
+        async with progress.checkpoint_lock:
+            blocked_user_ids, progress.blocked_user_ids = progress.blocked_user_ids, []
+            progress.checkpoint_wanted.clear()
+            return await db.checkpoint_broadcast(
+                progress.id, WORKER_ID, progress.last_user_id, progress.sent, progress.failed, progress.blocked,
+                blocked_user_ids, lease_seconds
+            )
+
+    async def shutdown(self):
+        tasks = list(self._running.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self):
+        return {'running': len(self._running)}
+
+broadcast_engine = BroadcastEngine()
+
+
+async def is_broadcast_staff(user_id):
+    return await db.get_staff_role(user_id) in BROADCAST_STAFF_ROLES
+
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Staff only: /broadcast <text> sends the text to every user, /broadcast_premium only to premium users."""
+    user_id = update.effective_user.id
+    if not await is_broadcast_staff(user_id):
+        return
+    parts = update.message.text.split(None, 1)
+    if len(parts) < 2:
+        await update.message.reply_text("ব্যবহার: /broadcast <মেসেজ>")
+        return
+    premium_only = parts[0].split('@')[0] == "/broadcast_premium"
+    broadcast_id = await broadcast_engine.start(user_id, parts[1], premium_only, context.bot)
+    await update.message.reply_text(f"📢 ব্রডকাস্ট #{broadcast_id} শুরু হয়েছে। বাতিল করতে: /broadcast_cancel {broadcast_id}")
+
+async def broadcast_cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Staff only: /broadcast_cancel <id> stops a broadcast at its next checkpoint."""
+    if not await is_broadcast_staff(update.effective_user.id):
+        return
+    if not context.args or not context.args[0].isdigit():
+        await update.message.reply_text("ব্যবহার: /broadcast_cancel <id>")
+        return
+    if await db.finish_broadcast(int(context.args[0]), 'cancelled'):
+        await update.message.reply_text(f"🛑 ব্রডকাস্ট #{context.args[0]} বাতিল করা হচ্ছে।")
+    else:
+        await update.message.reply_text("❌ এই আইডির কোনো চলমান ব্রডকাস্ট নেই।")
+
+
+# --- Update Dispatcher (ভিন্ন ইউজারের আপডেট একসাথে, একই ইউজারের আপডেট ক্রমানুসারে) ---
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Runs different users' updates concurrently while each user's updates run one at a time, in order.
+
+    PTB caps the updates in flight at max_pending_updates. Each update then waits
+    for its user's lock (asyncio locks wake waiters first come, first served, so a
+    user's updates run in arrival order) and only then takes one of the
+    max_running_updates handler slots. An update that is waiting behind its own
+    user's earlier updates therefore does not hold a slot another user could use.
+    """
+
+    def __init__(self, max_pending_updates, max_running_updates):
+        super().__init__(max_pending_updates)
+        self.max_running_updates = max_running_updates
+        self._running = asyncio.Semaphore(max_running_updates)
+        self._users = {}  # user_id -> [lock, updates queued or running for that user]
+        self.queued = 0
+        self.running = 0
+        self.processed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.max_user_depth = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_process_update(self, update, coroutine) -> None:
+        user = update.effective_user if isinstance(update, Update) else None
+        queued_at = time.monotonic()
+        self.queued += 1
+        if user is None:
+            async with self._running:
+                self._record_start(queued_at)
+                await self._process(update, coroutine)
+            return
+
+        entry = self._users.get(user.id)
+        if entry is None:
+            entry = self._users[user.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        self.max_user_depth = max(self.max_user_depth, entry[1])
+        try:
+            async with entry[0]:
+                async with self._running:
+                    self._record_start(queued_at)
+                    await self._process(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._users[user.id]
+
+    async def _process(self, update, coroutine):
+        kind = update_kind(update)
+        task = asyncio.current_task()
+        if slow_update_profiler is not None:
+            slow_update_profiler.track(task)
+        started = time.perf_counter()
+        self.running += 1
+        try:
+            await coroutine
+        finally:
+            self.running -= 1
+            elapsed = time.perf_counter() - started
+            metrics.observe("bot_update_seconds", kind, elapsed)
+            if slow_update_profiler is not None:
+                slow_update_profiler.finish(task, elapsed, kind)
+
+    def _record_start(self, queued_at):
+        wait = time.monotonic() - queued_at
+        self.queued -= 1
+        self.processed += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def stats(self):
+        return {
+            'queued': self.queued,
+            'running': self.running,
+            'active_users': len(self._users),
+            'max_user_depth': self.max_user_depth,
+            'processed': self.processed,
+            'avg_wait_ms': round(self.total_wait / self.processed * 1000, 2) if self.processed else 0.0,
+            'max_wait_ms': round(self.max_wait * 1000, 2),
+        }
+
+COMMANDS = ("start", "broadcast", "broadcast_premium", "broadcast_cancel")  # The commands main() registers
+
+def update_kind(update):
+    """A label for an update: its callback route, its command, or its type. Unknown routes and commands share one label."""
+    if not isinstance(update, Update):
+        return "other"
+    if update.callback_query is not None:
+        route = (update.callback_query.data or "").partition(':')[0]
+        return f"callback:{route if route in CALLBACK_ROUTES else 'unknown'}"
+    if update.message is not None and update.message.text and update.message.text.startswith('/'):
+        command = update.message.text.split(None, 1)[0].split('@')[0][1:]
+        return f"command:{command if command in COMMANDS else 'unknown'}"
+    return "message" if update.message is not None else "other"
+
+update_processor = PerUserUpdateProcessor(UPDATE_MAX_PENDING, UPDATE_CONCURRENCY)
+
+
+for prefix, source in (
+    ("updates", update_processor), ("outbound", outbound_limiter), ("edits", message_edits),
+    ("inbox_watcher", inbox_watcher), ("sms", activation_tracker), ("mail", mail_service),
+    ("broadcasts", broadcast_engine), ("activity_log", db.activity_log), ("settings_cache", db.settings_cache),
+    ("premium", premium),
+):
+    metrics.component(prefix, source)
+
+
+async def log_update_metrics(context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.info(f"Update dispatcher: {update_processor.stats()}")
+    logger.info(f"Outbound messages: {outbound_limiter.stats()}")
+    logger.info(f"Message edits: {message_edits.stats()}")
+    logger.info(f"Inbox watcher: {inbox_watcher.stats()}")
+    logger.info(f"SMS activations: {activation_tracker.stats()}")
+    logger.info(f"Mail providers: {mail_service.stats()}")
+    logger.info(f"Broadcasts: {broadcast_engine.stats()}")
+    logger.info(f"Activity log writer: {db.activity_log.stats()}")
+    logger.info(f"Premium cache: {premium.stats()}")
+
+
+# --- Webhook Router (আপডেটগুলো ইউজার অনুযায়ী ওয়ার্কারদের মধ্যে ভাগ করা) ---
+def get_update_user_id(data):
+    """Finds the user an update belongs to in its raw JSON, without building an Update object."""
+    for key, value in data.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        sender = value.get("from") or value.get("user") or value.get("chat")
+        if isinstance(sender, dict) and "id" in sender:
+            return sender["id"]
+        chat = value["message"].get("chat") if isinstance(value.get("message"), dict) else None
+        if isinstance(chat, dict) and "id" in chat:
+            return chat["id"]
+    return 0
+
+
+class WebhookRouter:
+    """Receives Telegram's webhook calls and forwards each update to the worker that owns its user.
+
+    Updates are acknowledged as soon as they are queued. Each shard has several
+    lanes, each with one queue and one forwarding task. A user always maps to the
+    same lane, so their updates reach the same worker in the order Telegram sent
+    them, while different users are forwarded in parallel. A full lane answers 503
+    and Telegram retries later. Connect errors, timeouts and 5xx are retried up to
+    max_retries times; an update a worker rejects with 4xx is logged and dropped.
+    """
+
+    def __init__(self, shard_urls, secret_token, queue_size, lanes_per_shard, max_retries):
+        self.shard_urls = shard_urls
+        self.secret_token = secret_token
+        self.max_retries = max_retries
+        self.queues = [asyncio.Queue(maxsize=queue_size) for _ in range(len(shard_urls) * lanes_per_shard)]
+        self._client = httpx.AsyncClient(timeout=HTTP_TIMEOUT_SECONDS)
+
+    def route(self, body):
+        """Queues a raw update body for its user's lane; returns False if the lane is backed up.
+
+        Raises ValueError if the body is not a JSON object.
+        """
+        data = json.loads(body)
+        if not isinstance(data, dict):
+            raise ValueError("update is not a JSON object")
+        queue = self.queues[get_update_user_id(data) % len(self.queues)]
+        try:
+            queue.put_nowait(body)
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    async def forward(self, lane):
+        # lane % shards equals user_id % shards, so a user's shard does not depend on the lane count
+        shard = lane % len(self.shard_urls)
+        url, queue = self.shard_urls[shard], self.queues[lane]
+        headers = {"Content-Type": "application/json"}
+        if self.secret_token:
+            headers["X-Telegram-Bot-Api-Secret-Token"] = self.secret_token
+        while True:
+            body = await queue.get()
+            delay = 0.5
+            # Retry the same update before taking the next one, to keep per-user order
+            for attempt in range(self.max_retries + 1):
+                try:
+                    response = await self._client.post(url, content=body, headers=headers)
+                except httpx.TransportError as e:
+                    error = str(e) or type(e).__name__
+                except httpx.HTTPError as e:
+                    logger.error(f"Forwarding update to shard {shard} failed, dropping it: {e}")
+                    break
+                else:
+                    if response.status_code < 500:
+                        if response.is_error:
+                            logger.error(f"Shard {shard} rejected an update with HTTP {response.status_code}, dropping it")
+                        break
+                    error = f"HTTP {response.status_code}"
+                if attempt == self.max_retries:
+                    logger.error(f"Forwarding update to shard {shard} failed {attempt + 1} times, dropping it: {error}")
+                    break
+                logger.warning(f"Forwarding update to shard {shard} failed, retrying in {delay:.1f}s: {error}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+
+
+class SecretTokenHandler(tornado.web.RequestHandler):
+    """Base for webhook endpoints: rejects calls that do not carry WEBHOOK_SECRET_TOKEN, and every call if it is unset."""
+
+    def prepare(self):
+        token = self.request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not WEBHOOK_SECRET_TOKEN or not hmac.compare_digest(token, WEBHOOK_SECRET_TOKEN):
+            raise tornado.web.HTTPError(403)
+
+
+class WebhookRouterHandler(SecretTokenHandler):
+    def initialize(self, router):
+        self.router = router
+
+    async def post(self):
+        try:
+            accepted = self.router.route(self.request.body)
+        except (ValueError, TypeError):
+            raise tornado.web.HTTPError(400)
+        if not accepted:
+            raise tornado.web.HTTPError(503)
+
+
+class ShardUpdateHandler(SecretTokenHandler):
+    def initialize(self, application):
+        self.bot_application = application
+
+    async def post(self):
+        try:
+            update = Update.de_json(json.loads(self.request.body), self.bot_application.bot)
+        except (ValueError, TypeError):
+            raise tornado.web.HTTPError(400)
+        await self.bot_application.update_queue.put(update)
+
+
+async def run_webhook_router() -> None:
+    """Serves the public webhook and fans updates out to WEBHOOK_SHARD_URLS."""
+    router = WebhookRouter(WEBHOOK_SHARD_URLS, WEBHOOK_SECRET_TOKEN, WEBHOOK_SHARD_QUEUE_SIZE, WEBHOOK_FORWARD_LANES,
+                           WEBHOOK_FORWARD_RETRIES)
+    forwarders = [asyncio.create_task(router.forward(lane)) for lane in range(len(router.queues))]
+    tornado.web.Application([(rf"/{WEBHOOK_PATH}/?", WebhookRouterHandler, {"router": router})]).listen(
+        WEBHOOK_PORT, address=WEBHOOK_LISTEN
+    )
+    async with Bot(USER_BOT_TOKEN, base_url=TELEGRAM_API_URL) as bot:
+        await bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET_TOKEN, allowed_updates=Update.ALL_TYPES)
+    print(f"Webhook router is running with {len(WEBHOOK_SHARD_URLS)} shards...")
+    await asyncio.gather(*forwarders)
+
+
+async def run_shard_worker(application: Application) -> None:
+    """Runs the bot behind the router: takes forwarded updates and never touches the webhook setting."""
+    stop_event = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop_event.set)
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    server = tornado.web.Application([(rf"/{WEBHOOK_PATH}/?", ShardUpdateHandler, {"application": application})]).listen(
+        WEBHOOK_PORT, address=WEBHOOK_LISTEN
+    )
+    try:
+        await stop_event.wait()
+    finally:
+        server.stop()
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def build_application() -> Application:
+    """Builds the Application with the bot's update processor, rate limiter and handlers."""
+    application = (
+        Application.builder()
+        .token(USER_BOT_TOKEN)
+        .base_url(TELEGRAM_API_URL)
+        .concurrent_updates(update_processor)
+        .rate_limiter(outbound_limiter)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+
+    # Add handlers
+    application.add_handler(TypeHandler(Update, cancel_pending_ad_reveal), group=-2)
+    application.add_handler(TypeHandler(Update, log_cold_start), group=-1)
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler(["broadcast", "broadcast_premium"], broadcast_command))
+    application.add_handler(CommandHandler("broadcast_cancel", broadcast_cancel_command))
+    application.add_handler(CallbackQueryHandler(button_handler))
+    return application
 
 
 def main() -> None:
     """Initializes and runs the bot."""
+    if BOT_MODE in ("webhook", "router", "shard") and not WEBHOOK_SECRET_TOKEN:
+        # Without it anyone who can reach the port could post updates as any user, staff included
+        logger.error(f"FATAL: {BOT_MODE} mode needs WEBHOOK_SECRET_TOKEN.")
+        return
+    if BOT_MODE == "router":
+        if not WEBHOOK_URL or not WEBHOOK_SHARD_URLS:
+            logger.error("FATAL: router mode needs WEBHOOK_URL and WEBHOOK_SHARD_URLS.")
+            return
+        asyncio.run(run_webhook_router())
+        return
+
     # Ensure DATABASE_URL is set
     if not os.environ.get('DATABASE_URL'):
         logger.error("FATAL: DATABASE_URL environment variable is not set.")
         return
 
-    application = Application.builder().token(USER_BOT_TOKEN).build()
+    application = build_application()
 
-    # Add handlers
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CallbackQueryHandler(button_handler))
-
-    print("User Bot is running...")
-    application.run_polling()
+    # Schema check and pool warm-up overlap with the getMe call in Application.initialize()
+    db.start_bootstrap()
+    print(f"User Bot is running ({BOT_MODE})...")
+    if BOT_MODE == "shard":
+        asyncio.run(run_shard_worker(application))
+    elif BOT_MODE == "webhook":
+        # PTB validates the secret token, queues the update and answers Telegram right away
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, url_path=WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET_TOKEN, webhook_url=WEBHOOK_URL,
+        )
+    else:
+        application.run_polling()
 
 if __name__ == "__main__":
     main()